@@ -10,9 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+from datetime import timedelta
 from pathlib import Path
 import os
 
+from celery.schedules import crontab
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -30,6 +34,26 @@ ALLOWED_HOSTS = ["127.0.0.1"]
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
 ]
+# Request and response headers of the resumable upload protocol (src/uploads.py)
+CORS_ALLOW_HEADERS = (
+    *default_headers,
+    "tus-resumable",
+    "upload-length",
+    "upload-offset",
+    "upload-metadata",
+    "upload-checksum",
+)
+CORS_EXPOSE_HEADERS = [
+    "Location",
+    "Tus-Resumable",
+    "Tus-Version",
+    "Tus-Extension",
+    "Tus-Max-Size",
+    "Tus-Checksum-Algorithm",
+    "Upload-Offset",
+    "Upload-Length",
+    "Upload-Expires",
+]
 
 
 INSTALLED_APPS = [
@@ -42,6 +66,7 @@ INSTALLED_APPS = [
     "rest_framework",
     "corsheaders",
     "django_celery_results",
+    "django_celery_beat",
     "src",
 ]
 
@@ -49,6 +74,74 @@ CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
+CELERY_RESULT_EXPIRES = timedelta(days=1)
+
+# Interactive uploads and bulk work are kept on separate queues so a large
+# backlog never sits in front of a single photo. Run dedicated workers:
+#   celery -A AmberServices worker -Q interactive
+#   celery -A AmberServices worker -Q bulk
+SCHEDULER_INTERACTIVE_QUEUE = "interactive"
+SCHEDULER_BULK_QUEUE = "bulk"
+CELERY_TASK_DEFAULT_QUEUE = SCHEDULER_INTERACTIVE_QUEUE
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Beat keeps its schedule in the database so entries can be paused or
+# retimed from the admin; the entries below are synced into it on start:
+#   celery -A AmberServices beat
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+CELERY_BEAT_SCHEDULE = {
+    # Safety net for dispatches skipped while another dispatcher held the lock.
+    "dispatch-bulk-work": {
+        "task": "src.tasks.dispatch_bulk_work",
+        "schedule": 30.0,
+    },
+    # Housekeeping runs on the bulk queue, away from interactive uploads.
+    "expire-providers": {
+        "task": "src.tasks.expire_providers",
+        "schedule": crontab(minute="*/15"),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+    "expire-task-results": {
+        "task": "src.tasks.expire_task_results",
+        "schedule": crontab(minute=20),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+    "clear-expired-sessions": {
+        "task": "src.tasks.clear_expired_sessions",
+        "schedule": crontab(hour=3, minute=10),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+    "collect-orphaned-blobs": {
+        "task": "src.tasks.collect_orphaned_blobs",
+        "schedule": crontab(hour=3, minute=30),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+    "collect-orphaned-media": {
+        "task": "src.tasks.collect_orphaned_media",
+        "schedule": crontab(hour=3, minute=50),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+    "expire-uploads": {
+        "task": "src.tasks.expire_uploads",
+        "schedule": crontab(minute=40),
+        "options": {"queue": SCHEDULER_BULK_QUEUE},
+    },
+}
+
+REDIS_URL = CELERY_BROKER_URL
+
+# Uploads with more images than this go through the fair bulk lane
+SCHEDULER_INTERACTIVE_MAX_IMAGES = 3
+# Bulk tasks allowed in flight across all tenants, and per tenant by default.
+# These count tasks, not images: each bulk task carries a chunk of up to
+# BULK_TASK_CHUNK_SIZE images (ASYNC_BATCH_SIZE in async mode) or one retry.
+SCHEDULER_BULK_MAX_IN_FLIGHT = 50
+SCHEDULER_TENANT_MAX_IN_FLIGHT = 4
+# Per-username overrides, e.g. {"acme": 10}, of the in-flight limit and of the
+# tasks dispatched per round-robin turn
+SCHEDULER_TENANT_LIMITS = {}
+SCHEDULER_TENANT_WEIGHTS = {}
+# Seconds after which an unreleased in-flight slot is reclaimed
+SCHEDULER_SLOT_TIMEOUT = 900
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
@@ -93,6 +186,14 @@ STORAGES = {
             "location": BASE_DIR / "media",
         },
     },
+    "receipts": {
+        "BACKEND": "src.storage.ContentAddressedStorage",
+        "OPTIONS": {
+            "location": BASE_DIR / "media",
+            "base_url": "/media/",
+            "orphan_grace_seconds": 3600,
+        },
+    },
 }
 
 # Database
@@ -148,6 +249,109 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Rows fetched per database round trip when streaming receipt exports
+EXPORT_CHUNK_SIZE = 2000
+
+# Receipt search results per request, by default and at most
+SEARCH_DEFAULT_RESULTS = 20
+SEARCH_MAX_RESULTS = 100
+
+# Archive ingest: entries validated and inserted per batch
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_MAX_ENTRIES = 10000
+ARCHIVE_MAX_ENTRY_SIZE = 50 * 1024 * 1024
+
+# OCR resilience (src/resilience.py). A Vision call still running after the
+# OCR_HEDGE_QUANTILE latency of the last OCR_WINDOW_SIZE calls (clamped to the
+# hedge delays) is raced against local Tesseract. The circuit opens when the
+# error or slow-call rate over the window reaches its threshold, and lets a
+# probe through every OCR_BREAKER_RESET_SECONDS.
+OCR_VISION_TIMEOUT = 20
+OCR_DEADLINE_SECONDS = 30
+OCR_HEDGE_ENABLED = True
+OCR_HEDGE_QUANTILE = 0.95
+OCR_HEDGE_MIN_DELAY = 1.0
+OCR_HEDGE_MAX_DELAY = 8.0
+OCR_HEDGE_WORKERS = 8
+OCR_WINDOW_SIZE = 100
+OCR_SLOW_CALL_SECONDS = 10
+OCR_BREAKER_MIN_CALLS = 20
+OCR_BREAKER_ERROR_RATE = 0.5
+OCR_BREAKER_SLOW_RATE = 0.5
+OCR_BREAKER_RESET_SECONDS = 60
+
+# Periodic maintenance (src/maintenance.py) works in bounded batches and
+# resumes on the next run once MAINTENANCE_MAX_BATCHES is reached.
+MAINTENANCE_BATCH_SIZE = 500
+MAINTENANCE_MAX_BATCHES = 20
+MAINTENANCE_BATCH_PAUSE = 0.2
+# Unreferenced uploads younger than this may belong to a row not yet committed
+MEDIA_ORPHAN_GRACE_SECONDS = 24 * 3600
+
+# Receipt processing retries: exponential backoff from PROCESSING_RETRY_BACKOFF
+# seconds, capped at PROCESSING_RETRY_BACKOFF_MAX. A worker's claim on an image
+# lapses after PROCESSING_LEASE_SECONDS so a crashed attempt can be resumed.
+PROCESSING_MAX_RETRIES = 5
+PROCESSING_RETRY_BACKOFF = 10
+PROCESSING_RETRY_BACKOFF_MAX = 600
+PROCESSING_LEASE_SECONDS = 300
+
+# Local image-quality gate run before OCR; see src/quality.py for the metrics
+QUALITY_GATE_ENABLED = True
+QUALITY_MIN_SHARPNESS = 60.0
+QUALITY_MAX_DARK_FRACTION = 0.6
+QUALITY_MAX_BRIGHT_FRACTION = 0.97
+QUALITY_MIN_TEXT_REGIONS = 8
+
+# Maximum Hamming distance between 64-bit perceptual hashes for two uploads
+# of the same client to be compared as possibly the same receipt. A candidate
+# only counts as a duplicate once its OCR text carries the same amounts, dates
+# and times as the original's and at least DUPLICATE_MIN_TEXT_SIMILARITY of
+# its wording matches
+DUPLICATE_MAX_DISTANCE = 4
+DUPLICATE_MIN_TEXT_SIMILARITY = 0.9
+# Clients whose hash tables each worker process keeps in memory
+DUPLICATE_INDEX_MAX_CLIENTS = 256
+
+# Images per Celery task when bulk work is fanned out
+BULK_TASK_CHUNK_SIZE = 25
+
+# "prefork" runs one image per task call; "async" runs ASYNC_BATCH_SIZE
+# images per task on an event loop, with at most the given number of Vision
+# and OpenAI requests in flight per task
+PIPELINE_MODE = "prefork"
+ASYNC_BATCH_SIZE = 200
+ASYNC_OCR_CONCURRENCY = 50
+ASYNC_LLM_CONCURRENCY = 50
+
+# Receipt extraction cascade (src/cascade.py): COMPLETION_FAST_MODEL answers
+# first and the receipt is escalated to COMPLETION_MODEL only when its result
+# fails the schema or does not reconcile. Set COMPLETION_FAST_MODEL to None to
+# always use COMPLETION_MODEL. Results record the model that produced them.
+COMPLETION_FAST_MODEL = "gpt-4o-mini"
+COMPLETION_MODEL = "gpt-4"
+# Models that accept response_format={"type": "json_object"}
+COMPLETION_JSON_MODE_MODELS = ["gpt-4o-mini", "gpt-4o", "gpt-4-turbo"]
+COMPLETION_TEMPERATURE = 0
+COMPLETION_MAX_TOKENS = 1000
+# Learned vendor templates answer instead of the LLM once this many LLM
+# extractions of the vendor agreed with them
+VENDOR_TEMPLATES_ENABLED = True
+VENDOR_TEMPLATE_MIN_CONFIRMATIONS = 3
+# Recorded as the completion model of receipts read by a vendor template
+VENDOR_TEMPLATE_MODEL = "vendor-template"
+# Reprocessing runs: receipts per bulk task, and completions per minute
+REPROCESS_BATCH_SIZE = 20
+REPROCESS_RATE_PER_MINUTE = 60
+
+# Resumable uploads (src/uploads.py): per-file size limits, the most files a
+# batch may declare, and how long an unfinished upload may go without a new
+# chunk before it is discarded
+UPLOAD_MAX_IMAGE_SIZE = 5 * 1024 * 1024
+UPLOAD_MAX_PDF_SIZE = 100 * 1024 * 1024
+UPLOAD_MAX_BATCH_FILES = ARCHIVE_MAX_ENTRIES
+UPLOAD_EXPIRY_SECONDS = 24 * 3600
+
 # Media files
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
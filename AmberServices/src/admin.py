@@ -1,3 +1,50 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-# Register your models here.
+from .models import ProcessedImage, ReprocessRun, VendorTemplate
+from . import reprocessing
+
+
+@admin.register(ProcessedImage)
+class ProcessedImageAdmin(admin.ModelAdmin):
+    list_display = ("id", "user", "company_name", "transaction_date", "total_gross", "needs_review", "prompt_version", "completion_model")
+    list_filter = ("needs_review", "prompt_version", "completion_model")
+    actions = ["reprocess"]
+
+    @admin.action(description="Reprocess selected receipts with the current prompt")
+    def reprocess(self, request, queryset):
+        run = reprocessing.start_run(processed_ids=list(queryset.values_list("id", flat=True)))
+        self.message_user(request, f"Started reprocess run {run.id} over {run.total} stale receipts.")
+        if run.skipped:
+            self.message_user(request, f"Skipped {run.skipped} stale receipts with no stored image to read.", messages.WARNING)
+
+
+@admin.register(ReprocessRun)
+class ReprocessRunAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "prompt_version", "completion_model", "client", "done", "failed", "total", "skipped", "updated_at")
+    readonly_fields = ("prompt_version", "completion_model", "client", "processed_ids", "token", "cursor", "total", "skipped", "done", "failed", "last_error")
+    actions = ["pause", "resume"]
+
+    @admin.action(description="Pause selected runs")
+    def pause(self, request, queryset):
+        paused = sum(reprocessing.pause_run(run) for run in queryset)
+        self.message_user(request, f"Paused {paused} run(s).")
+
+    @admin.action(description="Resume selected runs")
+    def resume(self, request, queryset):
+        resumed = sum(reprocessing.resume_run(run) for run in queryset)
+        if resumed < len(queryset):
+            self.message_user(request, "Completed runs cannot be resumed.", messages.WARNING)
+        self.message_user(request, f"Resumed {resumed} run(s).")
+
+
+@admin.register(VendorTemplate)
+class VendorTemplateAdmin(admin.ModelAdmin):
+    list_display = ("key", "client", "company_name", "confirmations", "hits", "misses", "updated_at")
+    list_filter = ("client",)
+    search_fields = ("key", "company_name", "vat_number")
+    actions = ["distrust"]
+
+    @admin.action(description="Stop using selected templates until they are confirmed again")
+    def distrust(self, request, queryset):
+        updated = queryset.update(confirmations=0)
+        self.message_user(request, f"Reset {updated} template(s).")
@@ -0,0 +1,124 @@
+import mimetypes
+import os
+import shutil
+import zipfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from rest_framework import serializers
+
+from .models import Images, PDFs, receipt_storage
+from .serializers import SerializeImages, SerializePDF
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def is_ignored_entry(info):
+    basename = os.path.basename(info.filename)
+    return info.is_dir() or not basename or basename.startswith('.') or info.filename.startswith('__MACOSX/')
+
+
+def extract_entry(archive, info):
+    # Entries are streamed to a temporary file on disk; the storage backend
+    # later moves that file into place instead of copying it again.
+    name = os.path.basename(info.filename)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    upload = TemporaryUploadedFile(name, content_type, info.file_size, None)
+    with archive.open(info) as source:
+        shutil.copyfileobj(source, upload.file, COPY_BUFFER_SIZE)
+    upload.file.flush()
+    upload.seek(0)
+    return upload
+
+
+def validate_entry(serializer_class, field, upload):
+    # Same per-file rules as the single-upload endpoints, without
+    # re-checking provider and client for every entry.
+    serializer = serializer_class()
+    try:
+        value = serializer.fields[field].run_validation(upload)
+    except DjangoValidationError as e:
+        raise serializers.ValidationError(e.messages)
+    return getattr(serializer, f'validate_{field}')(value)
+
+
+def reference_files(names):
+    storage = receipt_storage()
+    for name in names:
+        storage.acquire(name)
+
+
+def ingest_archive(archive_file, provider, client):
+    """
+    Extract every entry of ``archive_file`` and bulk create ``Images``/``PDFs``
+    rows for the valid ones, ``ARCHIVE_BATCH_SIZE`` entries at a time.
+
+    Returns ``(images, pdfs, rejected)`` where ``rejected`` lists the entries
+    that failed validation together with the reason.
+    """
+    images, pdfs, rejected = [], [], []
+    source = archive_file.temporary_file_path() if hasattr(archive_file, 'temporary_file_path') else archive_file
+
+    with zipfile.ZipFile(source) as archive:
+        entries = [info for info in archive.infolist() if not is_ignored_entry(info)]
+        if len(entries) > settings.ARCHIVE_MAX_ENTRIES:
+            raise serializers.ValidationError(
+                f"Archive contains {len(entries)} files, the limit is {settings.ARCHIVE_MAX_ENTRIES}."
+            )
+
+        for start in range(0, len(entries), settings.ARCHIVE_BATCH_SIZE):
+            batch_images, batch_pdfs, uploads = [], [], []
+
+            for info in entries[start:start + settings.ARCHIVE_BATCH_SIZE]:
+                lowered = info.filename.lower()
+                if lowered.endswith(IMAGE_EXTENSIONS):
+                    model, serializer_class, field, target = Images, SerializeImages, 'image', batch_images
+                elif lowered.endswith('.pdf'):
+                    model, serializer_class, field, target = PDFs, SerializePDF, 'pdf', batch_pdfs
+                else:
+                    rejected.append({"entry": info.filename, "errors": ["Unsupported file type."]})
+                    continue
+
+                if info.file_size > settings.ARCHIVE_MAX_ENTRY_SIZE:
+                    rejected.append({"entry": info.filename, "errors": ["File is too large."]})
+                    continue
+
+                try:
+                    upload = extract_entry(archive, info)
+                except (zipfile.BadZipFile, OSError) as e:
+                    rejected.append({"entry": info.filename, "errors": [str(e)]})
+                    continue
+                uploads.append(upload)
+
+                try:
+                    upload = validate_entry(serializer_class, field, upload)
+                except serializers.ValidationError as e:
+                    rejected.append({"entry": info.filename, "errors": e.detail})
+                    continue
+
+                target.append(model(
+                    provider=provider,
+                    client=client,
+                    name=os.path.basename(info.filename)[:50],
+                    **{field: upload},
+                ))
+
+            try:
+                images.extend(Images.objects.bulk_create(batch_images))
+                pdfs.extend(PDFs.objects.bulk_create(batch_pdfs))
+            finally:
+                for upload in uploads:
+                    upload.close()
+            # bulk_create sends no post_save, so reference the blobs here.
+            names = [image.image.name for image in batch_images] + [pdf.pdf.name for pdf in batch_pdfs]
+            transaction.on_commit(lambda names=names: reference_files(names))
+
+    logger.info(f"Ingested archive for {client.username}: {len(images)} images, {len(pdfs)} PDFs, {len(rejected)} rejected")
+    return images, pdfs, rejected
@@ -0,0 +1,75 @@
+"""
+Asyncio execution of the receipt pipeline.
+
+A prefork worker spends nearly all of a receipt's time waiting on Vision and
+OpenAI. Here one task runs a whole batch of receipts on an event loop, with
+the network calls awaited concurrently and bounded by ``ASYNC_OCR_CONCURRENCY``
+and ``ASYNC_LLM_CONCURRENCY``. The checkpoint, quality and duplicate logic is
+the same as in ``pipeline``; its database work runs through ``sync_to_async``.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import cascade, pipeline, resilience
+from .tesseract import AsyncGoogleVisionOCR
+
+
+async def process_image(image, full_image_path, ocr, ocr_slots, llm_slots):
+    existing = await sync_to_async(pipeline.existing_result)(image)
+    if existing:
+        return existing
+
+    state = await sync_to_async(pipeline.prepare)(image, full_image_path)
+    try:
+        if not state.ocr_text:
+            async with ocr_slots:
+                ocr_text = await resilience.extract_text_async(full_image_path, lambda: ocr.extract_text_from_image(full_image_path))
+            await sync_to_async(pipeline.store_ocr)(state, ocr_text)
+        await sync_to_async(pipeline.check_duplicate)(image, full_image_path, state.ocr_text)
+
+        result = await sync_to_async(pipeline.checkpointed_completion)(state)
+        if result is None:
+            result = await sync_to_async(pipeline.template_completion)(state)
+        if result is None:
+            async with llm_slots:
+                extraction = await cascade.complete_async(state.ocr_text, ocr.get_completion)
+            result = await sync_to_async(pipeline.store_completion)(state, extraction)
+
+        processed = await sync_to_async(pipeline.persist_result)(state, result)
+    except Exception as e:
+        await sync_to_async(pipeline.release)(state, error=str(e))
+        raise
+
+    await sync_to_async(pipeline.release)(state)
+    return processed
+
+
+async def run_job(image_path, image_id, ocr, ocr_slots, llm_slots):
+    image = None
+    try:
+        relative_path, full_image_path = pipeline.resolve_image_path(image_path)
+        image = await sync_to_async(pipeline.find_image)(relative_path, image_id)
+        return image, await process_image(image, full_image_path, ocr, ocr_slots, llm_slots)
+    except Exception as e:
+        return image, e
+
+
+async def run_batch(jobs):
+    """
+    Process ``jobs`` (``(image_path, image_id)`` pairs) concurrently. Returns
+    one ``(image, ProcessedImage or exception)`` pair per job, in order.
+    """
+    ocr = AsyncGoogleVisionOCR()
+    ocr_slots = asyncio.Semaphore(settings.ASYNC_OCR_CONCURRENCY)
+    llm_slots = asyncio.Semaphore(settings.ASYNC_LLM_CONCURRENCY)
+    try:
+        return await asyncio.gather(*(
+            run_job(image_path, image_id, ocr, ocr_slots, llm_slots)
+            for image_path, image_id in jobs
+        ))
+    finally:
+        await sync_to_async(close_old_connections)()
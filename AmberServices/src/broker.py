@@ -0,0 +1,12 @@
+import redis
+from django.conf import settings
+
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
@@ -0,0 +1,293 @@
+"""
+Cheap-first receipt extraction.
+
+Each receipt goes to ``COMPLETION_FAST_MODEL`` first, deterministically and in
+JSON mode where the model supports it. The parsed result is checked against
+the receipt schema and reconciled with ``vat.calculate``; only when either
+fails is the receipt sent on to the stronger ``COMPLETION_MODEL``, whose
+schema-valid result is kept even if it does not reconcile (it is then flagged
+for review). If no tier gives a schema-valid result, the strongest parseable
+one is kept with the invalid values dropped, unknown categories set to
+``DEFAULT_CATEGORY`` and ``needs_review`` set: at temperature 0 a retry would
+only pay for the same answer again. Calls, escalations and their reasons are
+counted per model in the ``completions`` metrics.
+"""
+
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+from django.conf import settings
+
+from . import metrics, vat
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+METRICS = "completions"
+
+# Escalation reasons; the last tier is only rejected for the first three.
+NO_RESPONSE = "no_response"
+INVALID_JSON = "invalid_json"
+INVALID_SCHEMA = "invalid_schema"
+EMPTY = "empty"
+UNRECONCILED = "unreconciled"
+REJECTING = (NO_RESPONSE, INVALID_JSON, INVALID_SCHEMA)
+
+DEFAULT_CATEGORY = "general"
+
+
+def is_text(value):
+    return isinstance(value, str)
+
+
+def is_number(value):
+    return vat.to_decimal(value) is not None
+
+
+def is_flag(value):
+    return isinstance(value, bool)
+
+
+def is_date(value):
+    try:
+        date.fromisoformat(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def is_time(value):
+    for time_format in ("%H:%M", "%H:%M:%S"):
+        try:
+            datetime.strptime(value, time_format)
+            return True
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+def is_category(value):
+    return isinstance(value, str) and value.strip().lower() in vat.CATEGORY_RATES
+
+
+# Every field may be null; text-like fields may also be empty strings.
+SECTIONS = {
+    "company_details": {"name": is_text, "address": is_text, "vat_number": is_text},
+    "transaction_details": {"date": is_date, "time": is_time, "payment_method": is_text},
+    "totals": {"total_gross": is_number, "total_vat": is_number, "total_net": is_number},
+}
+ITEM_FIELDS = {
+    "description": is_text,
+    "quantity": is_number,
+    "unit_price": is_number,
+    "gross_price": is_number,
+    "vat_rate": is_number,
+    "category": is_category,
+    "tax_deductible": is_flag,
+}
+TOP_LEVEL_FIELDS = {"fuel_type": is_text, "is_invoice": is_flag}
+
+
+def is_valid(value, check):
+    return value is None or (value == "" and check in (is_text, is_date, is_time)) or check(value)
+
+
+def check_fields(values, checks, path, problems):
+    for name, check in checks.items():
+        value = values.get(name)
+        if not is_valid(value, check):
+            problems.append(f"{path}{name} has invalid value {value!r}")
+
+
+def validate(result):
+    """Return the ways ``result`` does not match the receipt schema."""
+    if not isinstance(result, dict):
+        return [f"Expected a JSON object, got {type(result).__name__}"]
+
+    problems = []
+    for section, checks in SECTIONS.items():
+        values = result.get(section)
+        if values is None:
+            continue
+        if not isinstance(values, dict):
+            problems.append(f"{section} is not an object")
+            continue
+        check_fields(values, checks, f"{section}.", problems)
+
+    items = result.get("items")
+    if items is not None and not isinstance(items, list):
+        problems.append("items is not a list")
+    for index, item in enumerate(items if isinstance(items, list) else []):
+        if not isinstance(item, dict):
+            problems.append(f"items[{index}] is not an object")
+            continue
+        check_fields(item, ITEM_FIELDS, f"items[{index}].", problems)
+
+    check_fields(result, TOP_LEVEL_FIELDS, "", problems)
+    return problems
+
+
+def repair_fields(values, checks):
+    repaired = dict(values)
+    for name, check in checks.items():
+        if not is_valid(values.get(name), check):
+            repaired[name] = DEFAULT_CATEGORY if check is is_category else None
+    return repaired
+
+
+def repair(result):
+    """A copy of a parsed ``result`` with every value ``validate`` objects to dropped, or defaulted for categories."""
+    if not isinstance(result, dict):
+        return {}
+    repaired = repair_fields(result, TOP_LEVEL_FIELDS)
+    for section, checks in SECTIONS.items():
+        values = result.get(section)
+        repaired[section] = repair_fields(values, checks) if isinstance(values, dict) else None
+    items = result.get("items") if isinstance(result.get("items"), list) else []
+    repaired["items"] = [repair_fields(item, ITEM_FIELDS) for item in items if isinstance(item, dict)]
+    return repaired
+
+
+def parse_completion(raw_completion):
+    text = raw_completion.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.lower().startswith("json"):
+            text = text[4:]
+    return json.loads(text)
+
+
+def judge(raw_completion):
+    """Return ``(result, reason, problems)``; ``reason`` is ``None`` when the result can be used as is."""
+    if not raw_completion:
+        return None, NO_RESPONSE, ["No completion returned"]
+    try:
+        result = parse_completion(raw_completion)
+    except ValueError as e:
+        return None, INVALID_JSON, [f"Not valid JSON: {e}"]
+
+    problems = validate(result)
+    if problems:
+        return result, INVALID_SCHEMA, problems
+
+    calculation = vat.calculate(result)
+    if not calculation.items and calculation.total_gross is None:
+        return result, EMPTY, ["No items and no total extracted"]
+    if not calculation.reconciled:
+        return result, UNRECONCILED, calculation.issues
+    return result, None, []
+
+
+def models(model=None):
+    """The models tried, in order, for a target ``model`` (default ``COMPLETION_MODEL``)."""
+    model = model or settings.COMPLETION_MODEL
+    fast_model = settings.COMPLETION_FAST_MODEL
+    if model == settings.COMPLETION_MODEL and fast_model and fast_model != model:
+        return [fast_model, model]
+    return [model]
+
+
+def json_mode(model):
+    return model in settings.COMPLETION_JSON_MODE_MODELS
+
+
+@dataclass
+class Extraction:
+    result: dict = None
+    model: str = None
+    problems: list = field(default_factory=list)
+    escalations: list = field(default_factory=list)
+    # What ``judge`` found wrong with the last tier's answer, if anything.
+    reason: str = None
+    # Set when ``result`` had to be repaired to fit the schema.
+    needs_review: bool = False
+    # ``(result, model, problems, needs_review)`` to keep if the last tier is
+    # rejected: the first schema-valid answer, else the strongest repaired one.
+    fallback: tuple = None
+
+
+def record(model, started, reason, final):
+    accepted = reason is None or final and reason not in REJECTING
+    counters = {
+        f"{model}|calls": 1,
+        f"{model}|latency_ms": int((time.monotonic() - started) * 1000),
+        f"{model}|{'accepted' if accepted else 'escalated' if not final else 'failed'}": 1,
+    }
+    if reason is not None:
+        counters[f"{model}|reason:{reason}"] = 1
+    metrics.incr(METRICS, counters)
+    return accepted
+
+
+def step(extraction, model, started, raw_completion, final):
+    """Judge one tier's answer into ``extraction``; returns whether to stop."""
+    result, reason, problems = judge(raw_completion)
+    extraction.problems = problems
+    extraction.reason = reason
+    if record(model, started, reason, final):
+        extraction.result = result
+        extraction.model = model
+        return True
+
+    if extraction.fallback is None or extraction.fallback[3]:
+        if reason == INVALID_SCHEMA:
+            extraction.fallback = (repair(result), model, problems, True)
+        elif reason not in REJECTING:
+            extraction.fallback = (result, model, problems, False)
+
+    if not final:
+        extraction.escalations.append(reason)
+        logger.info(f"Escalating from {model} ({reason}): {'; '.join(problems)}")
+    elif extraction.fallback is not None:
+        extraction.result, extraction.model, extraction.problems, extraction.needs_review = extraction.fallback
+        logger.warning(f"{model} failed ({reason}), keeping the {extraction.model} result{' for review' if extraction.needs_review else ''}")
+    return False
+
+
+def complete(ocr_text, request_completion, model=None):
+    """
+    Run the cascade for ``ocr_text`` with ``request_completion(ocr_text,
+    model=, json_mode=)``. ``Extraction.result`` is ``None`` when no tier
+    produced a parseable result; ``Extraction.reason`` then says why.
+    """
+    extraction = Extraction()
+    tiers = models(model)
+    for index, tier in enumerate(tiers):
+        started = time.monotonic()
+        raw_completion = request_completion(ocr_text, model=tier, json_mode=json_mode(tier))
+        if step(extraction, tier, started, raw_completion, index == len(tiers) - 1):
+            break
+    return extraction
+
+
+async def complete_async(ocr_text, request_completion, model=None):
+    """``complete`` for a coroutine ``request_completion``."""
+    extraction = Extraction()
+    tiers = models(model)
+    for index, tier in enumerate(tiers):
+        started = time.monotonic()
+        raw_completion = await request_completion(ocr_text, model=tier, json_mode=json_mode(tier))
+        if step(extraction, tier, started, raw_completion, index == len(tiers) - 1):
+            break
+    return extraction
+
+
+def summary():
+    """Per-model calls, outcomes, escalation rate, mean latency and escalation reasons."""
+    models_seen = {}
+    for key, value in metrics.read(METRICS).items():
+        model, _, counter = key.partition("|")
+        stats = models_seen.setdefault(model, {"calls": 0, "accepted": 0, "escalated": 0, "failed": 0, "latency_ms": 0, "reasons": {}})
+        if counter.startswith("reason:"):
+            stats["reasons"][counter[len("reason:"):]] = value
+        else:
+            stats[counter] = value
+
+    for stats in models_seen.values():
+        calls = stats["calls"]
+        stats["escalation_rate"] = round(stats["escalated"] / calls, 4) if calls else 0.0
+        stats["mean_latency_ms"] = round(stats.pop("latency_ms") / calls) if calls else 0
+    return models_seen
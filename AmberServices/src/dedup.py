@@ -0,0 +1,209 @@
+"""
+Near-duplicate detection for receipt photos.
+
+Every image gets a 64-bit perceptual hash: the signs of its low-frequency DCT
+coefficients against their median. It survives re-encoding, small rotations
+and lighting changes far better than a difference hash on receipt paper.
+
+Lookups use an in-memory multi-index hash table per client: the hash is split
+into four 16-bit bands, and if two hashes differ in at most ``d`` bits, at
+least one band differs in at most ``d // 4`` bits. Probing each band's table
+with every value within that radius finds all candidates with a few hundred
+dict lookups instead of a scan. Tables are built lazily per worker process and
+topped up incrementally from ``ImageFingerprint`` (rows only ever get added;
+deleted images are detected when a match is verified).
+
+Receipts of one vendor share a layout and can hash within a few bits of each
+other, so a hash match is only a candidate. ``confirm`` accepts it once OCR
+has run, when the original was processed successfully and both texts carry
+the same amounts, dates and times.
+"""
+
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import combinations
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .models import ImageFingerprint, Images, ProcessedImage, ProcessingState
+from .quality import load_grayscale
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+# Amounts, dates and times: digit groups joined by separators.
+FIGURE_PATTERN = re.compile(r"\d+(?:[.,:/-]\d+)+")
+
+
+def perceptual_hash(path):
+    gray = load_grayscale(path)
+    if gray is None:
+        return None
+
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    coefficients = cv2.dct(small)[:8, :8].flatten()
+    bits = coefficients > np.median(coefficients[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def to_signed(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def bands(value):
+    return [(value >> (band * BAND_BITS)) & BAND_MASK for band in range(BANDS)]
+
+
+@lru_cache(maxsize=None)
+def probe_masks(radius):
+    masks = [0]
+    for distance in range(1, radius + 1):
+        for positions in combinations(range(BAND_BITS), distance):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+
+def band_probes(band_value, radius):
+    return [band_value ^ mask for mask in probe_masks(radius)]
+
+
+class HashIndex:
+    def __init__(self):
+        self.tables = [defaultdict(list) for _ in range(BANDS)]
+        self.last_id = 0
+
+    def add(self, fingerprint_id, image_id, value):
+        for band, band_value in enumerate(bands(value)):
+            self.tables[band][band_value].append((image_id, value))
+        self.last_id = max(self.last_id, fingerprint_id)
+
+    def search(self, value, max_distance):
+        radius = max_distance // BANDS
+        seen = set()
+        best = None
+        for band, band_value in enumerate(bands(value)):
+            table = self.tables[band]
+            for probe in band_probes(band_value, radius):
+                for image_id, candidate in table.get(probe, ()):
+                    if image_id in seen:
+                        continue
+                    seen.add(image_id)
+                    distance = (candidate ^ value).bit_count()
+                    if distance <= max_distance and (best is None or distance < best[1]):
+                        best = (image_id, distance)
+        return best
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def index_for(client_id):
+    with _lock:
+        index = _indexes.pop(client_id, None) or HashIndex()
+        _indexes[client_id] = index
+        while len(_indexes) > settings.DUPLICATE_INDEX_MAX_CLIENTS:
+            _indexes.popitem(last=False)
+
+        # Only originals are indexed, so every match points at a root image.
+        new_rows = (
+            ImageFingerprint.objects.filter(client_id=client_id, duplicate_of__isnull=True, id__gt=index.last_id)
+            .order_by("id")
+            .values_list("id", "image_id", "phash")
+        )
+        for fingerprint_id, image_id, phash in new_rows:
+            index.add(fingerprint_id, image_id, to_unsigned(phash))
+        return index
+
+
+def find_near_duplicate(client_id, value):
+    match = index_for(client_id).search(value, settings.DUPLICATE_MAX_DISTANCE)
+    if match is None or Images.objects.filter(id=match[0]).exists():
+        return match
+
+    # The matched image was deleted since the table was built; rebuild once.
+    with _lock:
+        _indexes.pop(client_id, None)
+    match = index_for(client_id).search(value, settings.DUPLICATE_MAX_DISTANCE)
+    if match is None or Images.objects.filter(id=match[0]).exists():
+        return match
+    return None
+
+
+def register(image, full_image_path):
+    """
+    Fingerprint ``image`` once and link it to an earlier near-identical upload
+    by the same client. Returns the ``ImageFingerprint``; its ``duplicate_of``
+    is set when a match was found.
+    """
+    existing = ImageFingerprint.objects.filter(image=image).first()
+    if existing is not None:
+        return existing
+
+    value = perceptual_hash(full_image_path)
+    if value is None:
+        return None
+
+    match = find_near_duplicate(image.client_id, value)
+    fingerprint = ImageFingerprint.objects.create(
+        image=image,
+        client_id=image.client_id,
+        phash=to_signed(value),
+        duplicate_of_id=match[0] if match else None,
+    )
+    if match:
+        logger.info(f"Image {image.id} is a near-duplicate of image {match[0]} (distance {match[1]})")
+    return fingerprint
+
+
+def processed_for(image_id):
+    return ProcessedImage.objects.filter(image_id=image_id).order_by("id").first()
+
+
+def same_receipt(ocr_text, original_text):
+    """Whether two OCR texts read the same receipt: the same figures and mostly the same words."""
+    if not ocr_text or not original_text:
+        return False
+    if sorted(FIGURE_PATTERN.findall(ocr_text)) != sorted(FIGURE_PATTERN.findall(original_text)):
+        return False
+    words = SequenceMatcher(None, ocr_text.lower().split(), original_text.lower().split(), autojunk=False)
+    return words.ratio() >= settings.DUPLICATE_MIN_TEXT_SIMILARITY
+
+
+def confirm(fingerprint, ocr_text):
+    """
+    Return the original's ``ProcessedImage`` if the candidate match of
+    ``fingerprint`` holds up against ``ocr_text``. Otherwise the image is
+    made an original of its own and ``None`` is returned.
+    """
+    original_id = fingerprint.duplicate_of_id
+    processed = processed_for(original_id)
+    original_text = ProcessingState.objects.filter(image_id=original_id).values_list("ocr_text", flat=True).first()
+    if processed is not None and same_receipt(ocr_text, original_text):
+        return processed
+
+    logger.info(f"Image {fingerprint.image_id} is not a duplicate of image {original_id} after all")
+    ImageFingerprint.objects.filter(pk=fingerprint.pk).update(duplicate_of=None)
+    fingerprint.duplicate_of_id = None
+    with _lock:
+        index = _indexes.get(fingerprint.client_id)
+        if index is not None:
+            # Its row is older than rows the table may already have loaded.
+            index.add(fingerprint.id, fingerprint.image_id, to_unsigned(fingerprint.phash))
+    return None
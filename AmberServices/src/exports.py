@@ -0,0 +1,187 @@
+import csv
+import re
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+
+RECEIPT_COLUMNS = [
+    ("receipt_id", "id"),
+    ("transaction_date", "transaction_date"),
+    ("transaction_time", "transaction_time"),
+    ("company_name", "company_name"),
+    ("vat_number", "vat_number"),
+    ("address", "address"),
+    ("payment_method", "payment_method"),
+    ("fuel_type", "fuel_type"),
+    ("is_invoice", "is_invoice"),
+    ("total_gross", "total_gross"),
+    ("total_vat", "total_vat"),
+    ("total_net", "total_net"),
+    ("needs_review", "needs_review"),
+]
+
+# The LLM output is not strictly keyed, so each item column accepts a few spellings.
+ITEM_COLUMNS = [
+    ("item_description", ("description", "name")),
+    ("item_quantity", ("quantity", "qty")),
+    ("item_unit_price", ("unit_price",)),
+    ("item_gross", ("gross_price", "gross", "price")),
+    ("item_vat_rate", ("vat_rate",)),
+    ("item_vat", ("vat_amount", "vat")),
+    ("item_net", ("net_price", "net")),
+    ("item_tax_deductible", ("tax_deductible", "deductible")),
+]
+
+HEADER = [name for name, _ in RECEIPT_COLUMNS] + [name for name, _ in ITEM_COLUMNS]
+RECEIPT_FIELDS = [field for _, field in RECEIPT_COLUMNS] + ["items"]
+
+
+def item_value(item, keys):
+    for key in keys:
+        if key in item:
+            return item[key]
+    return None
+
+
+def is_deductible(item):
+    value = item_value(item, ("tax_deductible", "deductible"))
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1")
+    return bool(value)
+
+
+def receipt_rows(receipts, deductible=None):
+    """
+    Flatten receipts (dicts from ``.values(*RECEIPT_FIELDS)``) into one row per
+    line item. ``deductible`` keeps only items whose flag matches it.
+    """
+    for receipt in receipts:
+        base = [receipt[field] for _, field in RECEIPT_COLUMNS]
+        items = [item for item in (receipt["items"] or []) if isinstance(item, dict)]
+
+        if deductible is not None:
+            items = [item for item in items if is_deductible(item) == deductible]
+            if not items:
+                continue
+
+        if not items:
+            yield base + [None] * len(ITEM_COLUMNS)
+            continue
+
+        for item in items:
+            yield base + [item_value(item, keys) for _, keys in ITEM_COLUMNS]
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+# Spreadsheets evaluate CSV text starting with these as a formula; text from
+# OCR and the LLM must never run as one.
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+PLAIN_NUMBER = re.compile(r"[+-]?\d+(?:[.,]\d+)?")
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) and not PLAIN_NUMBER.fullmatch(value):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(HEADER)
+    for row in rows:
+        yield writer.writerow([csv_value(value) for value in row])
+
+
+class _Pipe:
+    # Write-only sink for zipfile; having no tell() makes zipfile stream
+    # entries with data descriptors instead of seeking back.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+XLSX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+
+XLSX_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+XLSX_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Receipts" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+XLSX_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+
+XLSX_SHEET_HEADER = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>"""
+
+XLSX_SHEET_FOOTER = "</sheetData></worksheet>"
+
+ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def xlsx_cell(value):
+    # Text is always an inline string cell, which is never evaluated as a formula.
+    if value is None:
+        return "<c/>"
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f"<c><v>{value}</v></c>"
+    text = escape(ILLEGAL_XML_CHARS.sub("", str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_row(values):
+    return "<row>" + "".join(xlsx_cell(value) for value in values) + "</row>"
+
+
+def stream_xlsx(rows, flush_every=500):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", XLSX_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", XLSX_ROOT_RELS)
+        archive.writestr("xl/workbook.xml", XLSX_WORKBOOK)
+        archive.writestr("xl/_rels/workbook.xml.rels", XLSX_WORKBOOK_RELS)
+
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((XLSX_SHEET_HEADER + xlsx_row(HEADER)).encode())
+            yield pipe.drain()
+
+            for count, row in enumerate(rows, start=1):
+                sheet.write(xlsx_row(row).encode())
+                if count % flush_every == 0:
+                    yield pipe.drain()
+
+            sheet.write(XLSX_SHEET_FOOTER.encode())
+
+    yield pipe.drain()
@@ -0,0 +1,199 @@
+"""
+Periodic housekeeping run by Celery beat (see ``CELERY_BEAT_SCHEDULE``).
+
+Jobs work in batches of ``MAINTENANCE_BATCH_SIZE`` rows, keys or files,
+pause ``MAINTENANCE_BATCH_PAUSE`` seconds between batches and stop after
+``MAINTENANCE_MAX_BATCHES``, so a large backlog is worked off over several
+runs instead of in one burst against the database or Redis. Jobs that walk
+Redis or the media tree keep their position in Redis and resume from it.
+Provider expiry is the exception: it is one UPDATE over a small table.
+"""
+
+import os
+import time
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.utils.timezone import now
+
+from .broker import get_redis
+from .models import Blob, Images, PDFs, Providers, UploadSession, receipt_storage
+from .storage import BLOB_PREFIX
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+RESULT_PATTERNS = ("celery-task-meta-*", "celery-taskset-meta-*", "chord-unlock-*")
+RESULT_CURSOR_KEY = "amber:maintenance:results-cursor"
+MEDIA_CURSOR_KEY = "amber:maintenance:media-cursor"
+MEDIA_ROOTS = (BLOB_PREFIX, "images", "pdf")
+
+
+def batches():
+    for batch in range(settings.MAINTENANCE_MAX_BATCHES):
+        if batch:
+            time.sleep(settings.MAINTENANCE_BATCH_PAUSE)
+        yield batch
+
+
+def delete_in_batches(queryset):
+    deleted = 0
+    for _ in batches():
+        ids = list(queryset.order_by("pk").values_list("pk", flat=True)[:settings.MAINTENANCE_BATCH_SIZE])
+        if not ids:
+            break
+        deleted += queryset.model.objects.filter(pk__in=ids).delete()[0]
+    return deleted
+
+
+def expire_providers():
+    """Deactivate every provider past ``expires_at`` in a single UPDATE."""
+    deactivated = Providers.objects.filter(is_active=True, expires_at__lt=now()).update(is_active=False)
+    if deactivated:
+        logger.info(f"Deactivated {deactivated} expired providers")
+    return deactivated
+
+
+def expire_task_results():
+    """
+    Give result-backend keys written without a TTL (before
+    ``CELERY_RESULT_EXPIRES`` was set, or by ``GroupResult.save``) one, so
+    Redis memory stays bounded.
+    """
+    redis = get_redis()
+    ttl = int(settings.CELERY_RESULT_EXPIRES.total_seconds())
+    updated = 0
+    for pattern in RESULT_PATTERNS:
+        cursor_key = f"{RESULT_CURSOR_KEY}:{pattern}"
+        cursor = int(redis.get(cursor_key) or 0)
+        for _ in batches():
+            cursor, keys = redis.scan(cursor, match=pattern, count=settings.MAINTENANCE_BATCH_SIZE)
+            if keys:
+                with redis.pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        # NX: only keys that have no expiry yet.
+                        pipe.expire(key, ttl, nx=True)
+                    updated += sum(pipe.execute())
+            if cursor == 0:
+                break
+        redis.set(cursor_key, cursor)
+    if updated:
+        logger.info(f"Set a TTL on {updated} task result keys")
+    return updated
+
+
+def clean_database_results():
+    # django_celery_results tables, used whenever results are stored in the DB.
+    from django_celery_results.models import GroupResult, TaskResult
+
+    cutoff = now() - settings.CELERY_RESULT_EXPIRES
+    return (
+        delete_in_batches(TaskResult.objects.filter(date_done__lt=cutoff))
+        + delete_in_batches(GroupResult.objects.filter(date_done__lt=cutoff))
+    )
+
+
+def clear_expired_sessions():
+    return delete_in_batches(Session.objects.filter(expire_date__lt=now()))
+
+
+def collect_orphaned_blobs():
+    storage = receipt_storage()
+    removed = 0
+    for _ in batches():
+        collected = storage.collect_garbage(batch_size=settings.MAINTENANCE_BATCH_SIZE)
+        removed += collected
+        if collected < settings.MAINTENANCE_BATCH_SIZE:
+            break
+    return removed
+
+
+def media_files(start_after):
+    """
+    Yield media-relative paths of files under ``MEDIA_ROOTS`` after
+    ``start_after``. Paths are ordered component by component, the order
+    they are compared in, so a resumed walk never skips a file.
+    """
+    start = tuple(start_after.split("/")) if start_after else ()
+    for root in MEDIA_ROOTS:
+        yield from walk_sorted(root, start)
+
+
+def walk_sorted(directory, start):
+    try:
+        entries = sorted(os.scandir(os.path.join(settings.MEDIA_ROOT, directory)), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        name = f"{directory}/{entry.name}"
+        parts = tuple(name.split("/"))
+        if entry.is_dir(follow_symlinks=False):
+            # Skip directories whose files all come before the cursor.
+            if parts >= start[:len(parts)]:
+                yield from walk_sorted(name, start)
+        elif parts > start:
+            yield name
+
+
+def collect_orphaned_media():
+    """
+    Delete files under the legacy upload directories that no ``Images`` or
+    ``PDFs`` row references any more, such as files of rows deleted before
+    uploads were reference-counted, and blob files without a ``Blob`` row,
+    left behind when the transaction that stored them was rolled back.
+    Files younger than ``MEDIA_ORPHAN_GRACE_SECONDS`` are kept, as their row
+    may not be committed yet.
+    """
+    redis = get_redis()
+    start_after = (redis.get(MEDIA_CURSOR_KEY) or b"").decode()
+    cutoff = time.time() - settings.MEDIA_ORPHAN_GRACE_SECONDS
+    files = media_files(start_after)
+    removed = 0
+
+    for _ in batches():
+        names = [name for _, name in zip(range(settings.MAINTENANCE_BATCH_SIZE), files)]
+        if not names:
+            # Walked the whole tree; start over on the next run.
+            start_after = ""
+            break
+
+        referenced = set(Images.objects.filter(image__in=names).values_list("image", flat=True))
+        referenced |= set(PDFs.objects.filter(pdf__in=names).values_list("pdf", flat=True))
+        referenced |= set(Blob.objects.filter(name__in=names).values_list("name", flat=True))
+        for name in names:
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            try:
+                if name not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        start_after = names[-1]
+
+    redis.set(MEDIA_CURSOR_KEY, start_after)
+    if removed:
+        logger.info(f"Removed {removed} orphaned media files")
+    return removed
+
+
+def expire_uploads():
+    """Delete resumable upload sessions, and the staging files of unfinished ones, past ``expires_at``."""
+    from .uploads import staging_path
+
+    expired = UploadSession.objects.filter(expires_at__lt=now())
+    deleted = 0
+    for _ in batches():
+        sessions = list(expired.order_by("pk")[:settings.MAINTENANCE_BATCH_SIZE])
+        if not sessions:
+            break
+        for session in sessions:
+            if session.completed_at is None:
+                try:
+                    os.remove(staging_path(session))
+                except FileNotFoundError:
+                    pass
+        deleted += UploadSession.objects.filter(pk__in=[session.pk for session in sessions]).delete()[0]
+    if deleted:
+        logger.info(f"Deleted {deleted} expired upload sessions")
+    return deleted
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from src import search
+
+
+class Command(BaseCommand):
+    help = "Create the receipt full-text search index and fill it from existing receipts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Receipts indexed per statement batch.")
+
+    def handle(self, *args, **options):
+        if not search.supported():
+            raise CommandError("Full-text search needs SQLite (FTS5) or PostgreSQL.")
+
+        search.ensure_schema()
+        indexed = 0
+        for indexed in search.index_all(options["batch_size"]):
+            self.stdout.write(f"Indexed {indexed} receipts")
+
+        search.prune()
+        search.optimize()
+        self.stdout.write(self.style.SUCCESS(f"Search index contains {indexed} receipts."))
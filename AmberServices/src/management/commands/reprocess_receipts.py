@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from src.models import ReprocessRun
+from src import reprocessing
+
+
+class Command(BaseCommand):
+    help = "Re-run receipt extraction from stored OCR text after a prompt or model change."
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest="action", required=True)
+
+        start = subcommands.add_parser("start", help="Start a run over all stale receipts.")
+        start.add_argument("--username", help="Only reprocess receipts of this user.")
+        start.add_argument("--model", help="Completion model; defaults to COMPLETION_MODEL.")
+        start.add_argument("--batch-size", type=int, help="Receipts per task.")
+        start.add_argument("--rate", type=int, help="Maximum completions per minute.")
+        start.add_argument("--wait", action="store_true", help="Report progress until the run finishes.")
+
+        for action in ("pause", "resume", "status"):
+            subparser = subcommands.add_parser(action, help=f"{action.capitalize()} a run.")
+            subparser.add_argument("run_id", type=int, nargs="?" if action == "status" else None)
+            if action == "resume":
+                subparser.add_argument("--wait", action="store_true", help="Report progress until the run finishes.")
+
+    def handle(self, *args, **options):
+        action = options["action"]
+
+        if action == "start":
+            client = None
+            if options["username"]:
+                client = User.objects.filter(username=options["username"]).first()
+                if client is None:
+                    raise CommandError(f"User {options['username']} not found.")
+            run = reprocessing.start_run(
+                client=client,
+                completion_model=options["model"],
+                batch_size=options["batch_size"],
+                rate_per_minute=options["rate"],
+            )
+            self.stdout.write(f"Started reprocess run {run.id} over {run.total} receipts.")
+            if run.skipped:
+                self.stdout.write(self.style.WARNING(f"Skipped {run.skipped} stale receipts with no stored image to read."))
+
+        elif action == "status" and options["run_id"] is None:
+            for run in ReprocessRun.objects.order_by("-id")[:20]:
+                self.report(run)
+            return
+
+        else:
+            run = ReprocessRun.objects.filter(pk=options["run_id"]).first()
+            if run is None:
+                raise CommandError(f"Reprocess run {options['run_id']} not found.")
+            if action == "pause" and not reprocessing.pause_run(run):
+                raise CommandError(f"Reprocess run {run.id} is not running.")
+            if action == "resume" and not reprocessing.resume_run(run):
+                raise CommandError(f"Reprocess run {run.id} is already completed.")
+
+        run.refresh_from_db()
+        self.report(run)
+        if options.get("wait"):
+            self.wait(run)
+
+    def report(self, run):
+        self.stdout.write(
+            f"Run {run.id} [{run.status}] prompt v{run.prompt_version} / {run.completion_model}: "
+            f"{run.done} done, {run.failed} failed of {run.total}"
+            + (f", {run.skipped} skipped" if run.skipped else "")
+            + (f" (last error: {run.last_error})" if run.last_error else "")
+        )
+
+    def wait(self, run):
+        while run.status == ReprocessRun.RUNNING:
+            time.sleep(5)
+            run.refresh_from_db()
+            self.report(run)
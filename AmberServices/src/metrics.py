@@ -0,0 +1,35 @@
+"""
+Process-independent counters kept in Redis hashes, one hash per metric
+family. Counting is best effort: a Redis outage is logged and never fails
+the work being counted.
+"""
+
+import redis
+
+from .broker import get_redis
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+KEY_PREFIX = "amber:metrics"
+
+
+def incr(family, counters):
+    """Add ``counters`` (``{field: amount}``) to the ``family`` hash."""
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for field, amount in counters.items():
+                pipe.hincrby(f"{KEY_PREFIX}:{family}", field, amount)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not record {family} metrics: {e}")
+
+
+def read(family):
+    values = get_redis().hgetall(f"{KEY_PREFIX}:{family}")
+    return {field.decode(): int(value) for field, value in values.items()}
+
+
+def reset(family):
+    get_redis().delete(f"{KEY_PREFIX}:{family}")
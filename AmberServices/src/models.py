@@ -1,6 +1,7 @@
 from django.db import models
 import uuid
 from django.contrib.auth.models import User
+from django.core.files.storage import storages
 from django.utils.timezone import now
 
 
@@ -23,6 +24,27 @@ class Providers(models.Model):
             self.save()
 
 
+class Blob(models.Model):
+    digest = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["ref_count", "released_at"]),
+        ]
+
+    def __str__(self):
+        return f"Blob: {self.name} - References: {self.ref_count}"
+
+
+def receipt_storage():
+    return storages["receipts"]
+
+
 def upload_to_images(instance, filename):
     return f'images/{instance.client.username}/Receipts/{filename}'
 
@@ -35,7 +57,7 @@ class Images(models.Model):
     provider = models.ForeignKey(Providers, on_delete=models.CASCADE)
     client = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=50)
-    image = models.ImageField(upload_to=upload_to_images)
+    image = models.ImageField(upload_to=upload_to_images, storage=receipt_storage)
 
     def __str__(self):
         return f"Image: {self.name} by {self.client}"
@@ -45,7 +67,7 @@ class PDFs(models.Model):
     provider = models.ForeignKey(Providers, on_delete=models.CASCADE)
     client = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=50)
-    pdf = models.FileField(upload_to=upload_to_pdfs)
+    pdf = models.FileField(upload_to=upload_to_pdfs, storage=receipt_storage)
 
     def __str__(self):
         return f"PDF: {self.name} by {self.client}"
@@ -66,11 +88,153 @@ class ProcessedImage(models.Model):
     total_gross = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     total_vat = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     total_net = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    needs_review = models.BooleanField(default=False)
+    vat_issues = models.JSONField(null=True, blank=True)
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    prompt_version = models.PositiveIntegerField(null=True, blank=True)
+    completion_model = models.CharField(max_length=50, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"ProcessedImage for {self.user.username} - {self.company_name or 'Unknown Company'}"
 
+class ImageFingerprint(models.Model):
+    image = models.OneToOneField(Images, on_delete=models.CASCADE, related_name="fingerprint")
+    client = models.ForeignKey(User, on_delete=models.CASCADE)
+    phash = models.BigIntegerField()
+    duplicate_of = models.ForeignKey(Images, null=True, blank=True, on_delete=models.SET_NULL, related_name="near_duplicates")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["client", "id"]),
+        ]
+
+    def __str__(self):
+        return f"ImageFingerprint for {self.image} - {self.phash:#x}"
+
+class ProcessingState(models.Model):
+    PENDING = "pending"
+    OCR_DONE = "ocr_done"
+    COMPLETION_DONE = "completion_done"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    REJECTED = "rejected"
+    STAGES = [
+        (PENDING, "Pending"),
+        (OCR_DONE, "OCR done"),
+        (COMPLETION_DONE, "Completion done"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Failed"),
+        (REJECTED, "Rejected"),
+    ]
+
+    image = models.OneToOneField(Images, on_delete=models.CASCADE, related_name="processing")
+    stage = models.CharField(max_length=20, choices=STAGES, default=PENDING)
+    quality_metrics = models.JSONField(null=True, blank=True)
+    rejection_reason = models.CharField(max_length=255, null=True, blank=True)
+    ocr_text = models.TextField(null=True, blank=True)
+    raw_completion = models.TextField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"ProcessingState for {self.image} - {self.stage}"
+
+class VendorTemplate(models.Model):
+    # Templates are learned from, and applied to, one client's receipts only:
+    # the catalog carries that client's categories and deductibility.
+    client = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=100)
+    company_name = models.CharField(max_length=255, null=True, blank=True)
+    vat_number = models.CharField(max_length=50, null=True, blank=True)
+    address = models.TextField(null=True, blank=True)
+    layout = models.JSONField(default=dict)
+    catalog = models.JSONField(default=dict)
+    confirmations = models.PositiveIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    misses = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["client", "key"], name="unique_vendor_template_per_client"),
+        ]
+
+    def __str__(self):
+        return f"VendorTemplate {self.key} - {self.company_name or 'Unknown Company'}"
+
+class ReprocessRun(models.Model):
+    RUNNING = "running"
+    PAUSED = "paused"
+    COMPLETED = "completed"
+    STATUSES = [
+        (RUNNING, "Running"),
+        (PAUSED, "Paused"),
+        (COMPLETED, "Completed"),
+    ]
+
+    prompt_version = models.PositiveIntegerField()
+    completion_model = models.CharField(max_length=50)
+    client = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    processed_ids = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUSES, default=RUNNING)
+    # Only the batch chain holding the current token may advance the cursor.
+    token = models.CharField(max_length=36, blank=True)
+    cursor = models.BigIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    # Stale results left out of ``total`` because their image is not stored.
+    skipped = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    batch_size = models.PositiveIntegerField()
+    rate_per_minute = models.PositiveIntegerField()
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"ReprocessRun {self.id} - {self.status} ({self.done + self.failed}/{self.total})"
+
+class UploadSession(models.Model):
+    IMAGE = "image"
+    PDF = "pdf"
+    KINDS = [
+        (IMAGE, "Image"),
+        (PDF, "PDF"),
+    ]
+
+    upload_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    provider = models.ForeignKey(Providers, on_delete=models.CASCADE)
+    client = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    filename = models.CharField(max_length=255)
+    # Uploads sharing a batch go through the fair bulk lane together, once
+    # all ``batch_size`` of them finished.
+    batch = models.CharField(max_length=100, blank=True)
+    batch_size = models.PositiveIntegerField(null=True, blank=True)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    image = models.ForeignKey(Images, null=True, blank=True, on_delete=models.SET_NULL)
+    pdf = models.ForeignKey(PDFs, null=True, blank=True, on_delete=models.SET_NULL)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    expires_at = models.DateTimeField()
+    completed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["expires_at"]),
+        ]
+
+    def __str__(self):
+        return f"UploadSession {self.upload_id} - {self.filename} ({self.offset}/{self.length})"
+
 class SecretKey(models.Model):
     user = models.CharField(max_length=255, blank=True)
     key = models.CharField(default=uuid.uuid4, editable=False, unique=True, max_length=255)
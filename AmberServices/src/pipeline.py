@@ -0,0 +1,315 @@
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from .models import Images, ProcessedImage, ProcessingState
+from .quality import assess_image
+from . import cascade, dedup, resilience, vat, vendors
+from .cascade import parse_completion
+from .tesseract import PROMPT_VERSION, GoogleVisionOCR
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class TransientError(Exception):
+    """A failure worth retrying; every stage finished before it is checkpointed."""
+
+
+class ProcessingInProgress(TransientError):
+    """Another worker currently holds the lease on this image."""
+
+
+class UnusableCompletion(Exception):
+    """The models answered, but nothing parseable; retrying would pay for the same answer."""
+
+
+class ImageRejected(Exception):
+    """The image failed the local quality gate; retrying cannot help."""
+
+
+class DuplicateImage(Exception):
+    """The image is a near-duplicate of an earlier upload by the same client."""
+
+    def __init__(self, original_id, processed):
+        super().__init__(f"Near-duplicate of image {original_id}")
+        self.original_id = original_id
+        self.processed = processed
+
+
+def check_duplicate(image, full_image_path, ocr_text):
+    """Raise ``DuplicateImage`` if ``image`` is a confirmed near-duplicate of a processed upload."""
+    fingerprint = dedup.register(image, full_image_path)
+    if fingerprint is None or not fingerprint.duplicate_of_id:
+        return
+    processed = dedup.confirm(fingerprint, ocr_text)
+    if processed is not None:
+        raise DuplicateImage(fingerprint.duplicate_of_id, processed)
+
+
+def find_image(relative_path, image_id=None):
+    # Identical uploads share one blob, so the path alone is ambiguous.
+    if image_id is not None:
+        return Images.objects.get(id=image_id)
+    return Images.objects.get(image=relative_path)
+
+
+def resolve_image_path(image_path):
+    if image_path.startswith('./media'):
+        image_path = image_path[len('./media/'):]
+
+    if image_path.startswith(settings.MEDIA_ROOT):
+        relative_path = os.path.relpath(image_path, settings.MEDIA_ROOT)
+    else:
+        relative_path = image_path
+
+    full_image_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, relative_path))
+
+    if not os.path.exists(full_image_path):
+        raise FileNotFoundError(f"No such file or directory: '{full_image_path}'")
+
+    return relative_path, full_image_path
+
+
+def idempotency_key(image):
+    return f"image:{image.id}"
+
+
+def acquire(image):
+    state, _ = ProcessingState.objects.get_or_create(image=image)
+
+    # A lease instead of a row lock: the paid calls below take seconds and
+    # must not run inside a transaction.
+    claimed = ProcessingState.objects.filter(
+        Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now()),
+        pk=state.pk,
+    ).update(
+        lease_expires_at=now() + timedelta(seconds=settings.PROCESSING_LEASE_SECONDS),
+        attempts=F("attempts") + 1,
+    )
+    if not claimed:
+        raise ProcessingInProgress(f"Image {image.id} is already being processed")
+
+    state.refresh_from_db()
+    return state
+
+
+def release(state, stage=None, error=None):
+    state.lease_expires_at = None
+    state.last_error = error
+    if stage:
+        state.stage = stage
+    state.save(update_fields=["lease_expires_at", "last_error", "stage", "updated_at"])
+
+
+def check_quality(image, full_image_path):
+    """
+    Run the local quality gate once per image and record the outcome on its
+    ``ProcessingState``. Returns the rejection reason, or ``None``.
+    """
+    state, _ = ProcessingState.objects.get_or_create(image=image)
+    if state.quality_metrics is not None or not settings.QUALITY_GATE_ENABLED:
+        return state.rejection_reason
+
+    reason, metrics = assess_image(full_image_path)
+    state.quality_metrics = metrics
+    state.rejection_reason = reason
+    fields = ["quality_metrics", "rejection_reason", "updated_at"]
+    if reason:
+        state.stage = ProcessingState.REJECTED
+        fields.append("stage")
+        logger.info(f"Rejected image {image.id}: {reason}")
+    state.save(update_fields=fields)
+    return reason
+
+
+def discard_file(image):
+    """
+    Release the blob of an image nothing will process, keeping the row and
+    its ``ProcessingState`` as the record of why it was rejected.
+    """
+    field_file = image.image
+    storage, name = field_file.storage, field_file.name
+    if not name:
+        return
+    Images.objects.filter(pk=image.pk).update(image="")
+    field_file.name = ""
+    # Like the signals, only give up the reference once the row change commits.
+    transaction.on_commit(lambda: storage.delete(name))
+
+
+def store_ocr(state, ocr_text):
+    if not ocr_text:
+        raise TransientError(f"No text extracted for image {state.image_id}")
+
+    state.ocr_text = ocr_text
+    state.stage = ProcessingState.OCR_DONE
+    state.save(update_fields=["ocr_text", "stage", "updated_at"])
+    return ocr_text
+
+
+def run_ocr(state, full_image_path):
+    if state.ocr_text:
+        return state.ocr_text
+
+    ocr = GoogleVisionOCR(image_path=full_image_path)
+    return store_ocr(state, resilience.extract_text(full_image_path, ocr.extract_text_from_image))
+
+
+def checkpointed_completion(state):
+    if not state.raw_completion:
+        return None
+
+    try:
+        return parse_completion(state.raw_completion)
+    except ValueError:
+        logger.warning(f"Discarding unparseable completion checkpoint for image {state.image_id}")
+        return None
+
+
+def checkpoint_extraction(image_id, extraction):
+    """Return the result of a cascade ``extraction`` and its checkpoint JSON, recording the model that produced it."""
+    if extraction.result is None:
+        message = f"No usable completion for image {image_id}: {'; '.join(extraction.problems)}"
+        # Only a missing answer (an API error or timeout) may go differently next time.
+        if extraction.reason == cascade.NO_RESPONSE:
+            raise TransientError(message)
+        raise UnusableCompletion(message)
+    result = {**extraction.result, "completion_model": extraction.model}
+    if extraction.needs_review:
+        result["needs_review"] = True
+    return result, json.dumps(result)
+
+
+def store_completion(state, extraction):
+    result, state.raw_completion = checkpoint_extraction(state.image_id, extraction)
+    state.stage = ProcessingState.COMPLETION_DONE
+    state.save(update_fields=["raw_completion", "stage", "updated_at"])
+
+    learn_vendor(state.ocr_text, result, state.image.client_id)
+    return result
+
+
+def learn_vendor(ocr_text, result, client_id):
+    if result.get("needs_review"):
+        return
+    # Template learning is an optimisation and must never fail a receipt.
+    try:
+        vendors.learn(ocr_text, result, client_id)
+    except Exception as e:
+        logger.warning(f"Vendor template learning failed: {e}", exc_info=True)
+
+
+def template_completion(state):
+    if not settings.VENDOR_TEMPLATES_ENABLED:
+        return None
+
+    result = vendors.extract(state.ocr_text, state.image.client_id)
+    if result is None:
+        return None
+
+    state.raw_completion = json.dumps(result)
+    state.stage = ProcessingState.COMPLETION_DONE
+    state.save(update_fields=["raw_completion", "stage", "updated_at"])
+    logger.info(f"Image {state.image_id} read with vendor template {result['template']}")
+    return result
+
+
+def run_completion(state, full_image_path):
+    result = checkpointed_completion(state) or template_completion(state)
+    if result is not None:
+        return result
+
+    ocr = GoogleVisionOCR(image_path=full_image_path)
+    return store_completion(state, cascade.complete(state.ocr_text, ocr.get_completion))
+
+
+def processed_fields(result):
+    company = result.get("company_details") or {}
+    transaction_details = result.get("transaction_details") or {}
+    calculation = vat.calculate(result)
+    if not calculation.reconciled:
+        logger.warning(f"VAT does not reconcile: {'; '.join(calculation.issues)}")
+    return {
+        "company_name": company.get("name"),
+        "address": company.get("address"),
+        "vat_number": company.get("vat_number"),
+        "transaction_date": transaction_details.get("date") or None,
+        "transaction_time": transaction_details.get("time") or None,
+        "payment_method": transaction_details.get("payment_method"),
+        "items": calculation.items,
+        "fuel_type": result.get("fuel_type"),
+        "is_invoice": bool(result.get("is_invoice")),
+        "total_gross": calculation.total_gross,
+        "total_vat": calculation.total_vat,
+        "total_net": calculation.total_net,
+        "needs_review": not calculation.reconciled or bool(result.get("needs_review")),
+        "vat_issues": (calculation.issues + calculation.assumptions) or None,
+        "prompt_version": PROMPT_VERSION,
+        "completion_model": settings.VENDOR_TEMPLATE_MODEL if result.get("template") else result.get("completion_model") or settings.COMPLETION_MODEL,
+    }
+
+
+def persist_result(state, result):
+    image = state.image
+    with transaction.atomic():
+        processed, created = ProcessedImage.objects.get_or_create(
+            idempotency_key=idempotency_key(image),
+            defaults={"user": image.client, "image": image, **processed_fields(result)},
+        )
+        state.stage = ProcessingState.COMPLETED
+        state.save(update_fields=["stage", "updated_at"])
+
+    if not created:
+        logger.info(f"Image {image.id} was already processed, reusing ProcessedImage {processed.id}")
+    return processed
+
+
+def existing_result(image):
+    return ProcessedImage.objects.filter(idempotency_key=idempotency_key(image)).first()
+
+
+def prepare(image, full_image_path):
+    """Run the local checks, then claim the image for the paid stages."""
+    reason = check_quality(image, full_image_path)
+    if reason:
+        raise ImageRejected(reason)
+    return acquire(image)
+
+
+def process_image(image, full_image_path):
+    """
+    Run OCR, completion and persistence for ``image``, resuming after the last
+    checkpoint a previous attempt stored. Returns the ``ProcessedImage``.
+    """
+    existing = existing_result(image)
+    if existing:
+        return existing
+
+    state = prepare(image, full_image_path)
+    try:
+        run_ocr(state, full_image_path)
+        # Before the completion: a confirmed duplicate needs no LLM call.
+        check_duplicate(image, full_image_path, state.ocr_text)
+        result = run_completion(state, full_image_path)
+        processed = persist_result(state, result)
+    except Exception as e:
+        release(state, error=str(e))
+        raise
+
+    release(state)
+    return processed
+
+
+def mark_failed(image, error):
+    ProcessingState.objects.filter(image=image).update(
+        stage=ProcessingState.FAILED,
+        last_error=error,
+        lease_expires_at=None,
+        updated_at=now(),
+    )
@@ -0,0 +1,89 @@
+"""
+Cheap local checks run before any paid OCR or LLM call. Every metric is taken
+on a copy scaled to ``ANALYSIS_SIZE`` on its longest side, so thresholds do not
+depend on the camera resolution and a check takes a few milliseconds.
+"""
+
+import cv2
+import numpy as np
+from django.conf import settings
+from PIL import Image, UnidentifiedImageError
+
+
+ANALYSIS_SIZE = 1024
+
+
+def load_grayscale(path):
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        # OpenCV cannot read GIFs, which the upload endpoints accept.
+        try:
+            with Image.open(path) as image:
+                gray = np.asarray(image.convert("L"))
+        except (OSError, UnidentifiedImageError):
+            return None
+
+    scale = ANALYSIS_SIZE / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def sharpness(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def exposure(gray):
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    total = histogram.sum()
+    return {
+        "brightness": float(gray.mean()),
+        "dark_fraction": float(histogram[:40].sum() / total),
+        "bright_fraction": float(histogram[250:].sum() / total),
+    }
+
+
+def text_regions(gray):
+    # Printed lines show up as wide, short blobs once the strokes are joined
+    # horizontally; count those instead of running OCR.
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    joined = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 1)))
+    contours, _ = cv2.findContours(joined, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    count = 0
+    area = 0
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if 6 <= h <= 80 and w >= 2 * h and cv2.countNonZero(binary[y:y + h, x:x + w]) > 0.2 * w * h:
+            count += 1
+            area += w * h
+
+    return {
+        "text_regions": count,
+        "text_density": float(area / gray.size),
+    }
+
+
+def assess_image(path):
+    """
+    Return ``(reason, metrics)`` for the image at ``path``. ``reason`` is a
+    message suitable for the uploader when the image should be rejected, and
+    ``None`` when it passes.
+    """
+    gray = load_grayscale(path)
+    if gray is None:
+        return "The file could not be decoded as an image.", {}
+
+    metrics = {"sharpness": sharpness(gray), **exposure(gray), **text_regions(gray)}
+
+    if metrics["dark_fraction"] > settings.QUALITY_MAX_DARK_FRACTION:
+        return "The image is too dark. Retake the photo in better light.", metrics
+    if metrics["bright_fraction"] > settings.QUALITY_MAX_BRIGHT_FRACTION:
+        return "The image is overexposed. Avoid glare or direct flash.", metrics
+    if metrics["sharpness"] < settings.QUALITY_MIN_SHARPNESS:
+        return "The image is too blurry. Hold the camera steady and retake the photo.", metrics
+    if metrics["text_regions"] < settings.QUALITY_MIN_TEXT_REGIONS:
+        return "No printed text was found. The image does not look like a receipt.", metrics
+
+    return None, metrics
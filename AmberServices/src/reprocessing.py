@@ -0,0 +1,167 @@
+"""
+Re-running the completion step over stored receipts after the prompt or model
+changes.
+
+Only results whose ``prompt_version``/``completion_model`` differ from the
+run's target are selected. The OCR text checkpointed on ``ProcessingState`` is
+reused, so a run mostly costs LLM calls; receipts processed before OCR text was
+checkpointed are read again first. Stale results with no stored image to read
+are counted as ``skipped`` on the run and left as they are. A run walks
+the selection in id order behind a persistent cursor, one small batch per
+task on the bulk queue, spacing batches to stay under ``rate_per_minute``.
+Pausing stops the chain after the current receipt; resuming starts a new chain
+from the cursor under a fresh token, so a late task from the old chain exits
+instead of double-processing.
+"""
+
+import time
+
+from celery.utils import uuid
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import ProcessedImage, ProcessingState, ReprocessRun
+from .pipeline import checkpoint_extraction, learn_vendor, processed_fields, run_ocr
+from . import cascade
+from .signals import refresh_search_index
+from .tesseract import PROMPT_VERSION, request_completion
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def stale_results(prompt_version, completion_model, client=None, processed_ids=None):
+    # Results the cascade's cheaper tier produced are current for its target
+    # model, and so are vendor template results: the template is kept in step
+    # with the LLM and re-running them would put recurring vendors back on it.
+    current_models = [*cascade.models(completion_model), settings.VENDOR_TEMPLATE_MODEL]
+    results = ProcessedImage.objects.exclude(prompt_version=prompt_version, completion_model__in=current_models)
+    if client is not None:
+        results = results.filter(user=client)
+    if processed_ids is not None:
+        results = results.filter(id__in=processed_ids)
+    return results
+
+
+def readable(results):
+    """The ``results`` whose image file is still stored, so OCR text can be read again if missing."""
+    return results.filter(image__isnull=False).exclude(image__image="")
+
+
+def run_results(run):
+    return readable(stale_results(run.prompt_version, run.completion_model, run.client_id, run.processed_ids))
+
+
+def start_run(client=None, processed_ids=None, completion_model=None, batch_size=None, rate_per_minute=None):
+    run = ReprocessRun(
+        prompt_version=PROMPT_VERSION,
+        completion_model=completion_model or settings.COMPLETION_MODEL,
+        client=client,
+        processed_ids=processed_ids,
+        batch_size=batch_size or settings.REPROCESS_BATCH_SIZE,
+        rate_per_minute=rate_per_minute or settings.REPROCESS_RATE_PER_MINUTE,
+        token=uuid(),
+    )
+    stale = stale_results(run.prompt_version, run.completion_model, run.client_id, run.processed_ids)
+    run.total = readable(stale).count()
+    run.skipped = stale.count() - run.total
+    if run.skipped:
+        logger.warning(f"Reprocess run skips {run.skipped} stale receipts with no stored image to read")
+    if not run.total:
+        run.status = ReprocessRun.COMPLETED
+    run.save()
+
+    if run.status == ReprocessRun.RUNNING:
+        schedule_batch(run.id, run.token)
+    return run
+
+
+def schedule_batch(run_id, token, countdown=0):
+    from .tasks import reprocess_batch
+    reprocess_batch.apply_async((run_id, token), countdown=countdown, queue=settings.SCHEDULER_BULK_QUEUE)
+
+
+def pause_run(run):
+    return ReprocessRun.objects.filter(pk=run.pk, status=ReprocessRun.RUNNING).update(status=ReprocessRun.PAUSED)
+
+
+def resume_run(run):
+    """
+    Restart ``run`` from its cursor. Also revives a run whose chain was lost
+    to a worker crash, since the new token retires any surviving task.
+    """
+    token = uuid()
+    resumed = ReprocessRun.objects.filter(
+        pk=run.pk, status__in=[ReprocessRun.RUNNING, ReprocessRun.PAUSED],
+    ).update(status=ReprocessRun.RUNNING, token=token)
+    if resumed:
+        schedule_batch(run.pk, token)
+    return resumed
+
+
+def reprocess_result(run, processed):
+    state, _ = ProcessingState.objects.get_or_create(
+        image_id=processed.image_id, defaults={"stage": ProcessingState.COMPLETED},
+    )
+    # Receipts processed before OCR text was checkpointed are read again first.
+    ocr_text = run_ocr(state, processed.image.image.path)
+    extraction = cascade.complete(ocr_text, request_completion, run.completion_model)
+    result, raw_completion = checkpoint_extraction(processed.image_id, extraction)
+
+    learn_vendor(ocr_text, result, processed.image.client_id)
+    fields = {**processed_fields(result), "prompt_version": run.prompt_version}
+    with transaction.atomic():
+        ProcessedImage.objects.filter(pk=processed.pk).update(**fields)
+        ProcessingState.objects.filter(pk=state.pk).update(raw_completion=raw_completion, stage=ProcessingState.COMPLETED)
+        # update() sends no post_save, so index like the signal does: after
+        # commit, and never failing the paid-for result.
+        transaction.on_commit(lambda: refresh_search_index(processed.pk))
+
+
+def advance(run, token, cursor, succeeded, error=None):
+    counter = "done" if succeeded else "failed"
+    update = {"cursor": cursor, counter: F(counter) + 1}
+    if error is not None:
+        update["last_error"] = error
+    # Count the receipt even if the run was paused meanwhile, then report
+    # whether this chain may continue.
+    ReprocessRun.objects.filter(pk=run.pk, token=token).update(**update)
+    return ReprocessRun.objects.filter(pk=run.pk, token=token, status=ReprocessRun.RUNNING).exists()
+
+
+def run_batch(run_id, token):
+    """
+    Reprocess the next batch of ``run_id`` and schedule the following one.
+    Returns the number of receipts handled.
+    """
+    run = ReprocessRun.objects.filter(pk=run_id, token=token, status=ReprocessRun.RUNNING).first()
+    if run is None:
+        return 0
+
+    started = time.monotonic()
+    handled = 0
+    batch = run_results(run).select_related("image").filter(id__gt=run.cursor).order_by("id")[:run.batch_size]
+    for processed in batch:
+        try:
+            reprocess_result(run, processed)
+            still_running = advance(run, token, processed.id, True)
+        except Exception as e:
+            # Failed receipts stay stale, so a later run picks them up again.
+            logger.warning(f"Reprocess run {run.id} failed on ProcessedImage {processed.id}: {e}")
+            still_running = advance(run, token, processed.id, False, str(e))
+        handled += 1
+        if not still_running:
+            logger.info(f"Reprocess run {run.id} stopped at ProcessedImage {processed.id}")
+            return handled
+
+    if handled < run.batch_size:
+        ReprocessRun.objects.filter(pk=run.pk, token=token, status=ReprocessRun.RUNNING).update(
+            status=ReprocessRun.COMPLETED,
+        )
+        logger.info(f"Reprocess run {run.id} completed")
+        return handled
+
+    countdown = max(0.0, handled * 60 / run.rate_per_minute - (time.monotonic() - started))
+    schedule_batch(run.id, token, countdown=countdown)
+    return handled
@@ -0,0 +1,250 @@
+"""
+Keeps OCR latency bounded while Google Vision is slow or failing.
+
+Every Vision call is timed into a rolling window. Once a call has been
+running longer than the window's ``OCR_HEDGE_QUANTILE`` latency, a second
+request is sent to a local Tesseract engine and whichever returns text first
+wins. When too many recent calls failed or were slow, the circuit breaker
+opens and receipts go straight to Tesseract until a probe call to Vision
+succeeds again. Nothing waits longer than ``OCR_DEADLINE_SECONDS``.
+
+The window and breaker are per worker process.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pytesseract
+from django.conf import settings
+from PIL import Image
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Latency and outcome of the last ``size`` calls."""
+
+    def __init__(self, size):
+        self.calls = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, duration, ok):
+        with self.lock:
+            self.calls.append((duration, ok))
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.calls)
+
+    def quantile(self, q, min_calls=1):
+        durations = sorted(duration for duration, ok in self.snapshot() if ok)
+        if len(durations) < min_calls:
+            return None
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+    def rates(self, slow_after):
+        """Return ``(calls, error rate, slow call rate)`` over the window."""
+        calls = self.snapshot()
+        if not calls:
+            return 0, 0.0, 0.0
+        errors = sum(1 for _, ok in calls if not ok)
+        slow = sum(1 for duration, ok in calls if ok and duration >= slow_after)
+        return len(calls), errors / len(calls), slow / len(calls)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, tracker, min_calls, error_rate, slow_rate, slow_after, reset_after):
+        self.tracker = tracker
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_after = slow_after
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether the next call may go to the provider. While half open, only one probe is let through."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_after:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, duration, ok):
+        self.tracker.record(duration, ok)
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if ok and duration < self.slow_after:
+                    self.state = self.CLOSED
+                    self.tracker.clear()
+                    logger.info("OCR circuit closed: Vision recovered")
+                else:
+                    self.trip()
+                return
+
+            if self.state == self.CLOSED:
+                calls, error_rate, slow_rate = self.tracker.rates(self.slow_after)
+                if calls >= self.min_calls and (error_rate >= self.error_rate or slow_rate >= self.slow_rate):
+                    logger.warning(f"OCR circuit opened: {error_rate:.0%} errors, {slow_rate:.0%} slow over {calls} calls")
+                    self.trip()
+
+    def release_probe(self):
+        """Let the next call probe again after a half-open probe was cancelled unanswered."""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+
+_breaker = None
+_executor = None
+
+
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            LatencyTracker(settings.OCR_WINDOW_SIZE),
+            min_calls=settings.OCR_BREAKER_MIN_CALLS,
+            error_rate=settings.OCR_BREAKER_ERROR_RATE,
+            slow_rate=settings.OCR_BREAKER_SLOW_RATE,
+            slow_after=settings.OCR_SLOW_CALL_SECONDS,
+            reset_after=settings.OCR_BREAKER_RESET_SECONDS,
+        )
+    return _breaker
+
+
+def get_executor():
+    # Created on first use so prefork children do not share the parent's threads.
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.OCR_HEDGE_WORKERS, thread_name_prefix="ocr")
+    return _executor
+
+
+def hedge_delay(breaker):
+    delay = breaker.tracker.quantile(settings.OCR_HEDGE_QUANTILE, min_calls=settings.OCR_BREAKER_MIN_CALLS)
+    if delay is None:
+        return settings.OCR_HEDGE_MAX_DELAY
+    return min(max(delay, settings.OCR_HEDGE_MIN_DELAY), settings.OCR_HEDGE_MAX_DELAY)
+
+
+def observe(breaker, started):
+    """Done callback recording a Vision call, including calls the hedge beat."""
+    def record(future):
+        # A call cancelled while still running, typically by ``asyncio.run``
+        # shutting down after the hedge answered, says nothing about Vision.
+        # It is not recorded, but a cancelled probe must not leave the
+        # breaker half open for good.
+        if future.cancelled():
+            breaker.release_probe()
+            return
+        ok = future.exception() is None and bool(future.result())
+        breaker.record(time.monotonic() - started, ok)
+    return record
+
+
+def local_text(image_path):
+    """Tesseract OCR laid out like ``format_annotation``, or ``None``."""
+    try:
+        with Image.open(image_path) as image:
+            text = pytesseract.image_to_string(image, config="--psm 4", timeout=settings.OCR_DEADLINE_SECONDS)
+    except Exception as e:
+        logger.error(f"Local OCR failed for {image_path}: {e}")
+        return None
+
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines:
+        return None
+    return "\n" + "".join(f"{line[:41].ljust(41)}\n" for line in lines)
+
+
+def first_text(done):
+    for future in done:
+        if not future.cancelled() and future.exception() is None and future.result():
+            return future.result()
+    return None
+
+
+def extract_text(image_path, vision_extract):
+    """Run ``vision_extract()`` hedged with local OCR; ``None`` if neither produced text in time."""
+    breaker = get_breaker()
+    if not breaker.allow():
+        logger.info(f"OCR circuit open, using local OCR for {image_path}")
+        return local_text(image_path)
+
+    executor = get_executor()
+    deadline = time.monotonic() + settings.OCR_DEADLINE_SECONDS
+    vision = executor.submit(vision_extract)
+    vision.add_done_callback(observe(breaker, time.monotonic()))
+
+    pending = {vision}
+    if settings.OCR_HEDGE_ENABLED:
+        done, pending = wait(pending, timeout=hedge_delay(breaker))
+        text = first_text(done)
+        if text:
+            return text
+        logger.info(f"Vision slow or failed for {image_path}, hedging with local OCR")
+        pending.add(executor.submit(local_text, image_path))
+
+    while pending:
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        text = first_text(done)
+        if text:
+            return text
+
+    logger.error(f"No OCR text for {image_path} within {settings.OCR_DEADLINE_SECONDS}s")
+    return None
+
+
+async def extract_text_async(image_path, vision_extract):
+    """Asyncio counterpart of ``extract_text``; ``vision_extract()`` returns a coroutine."""
+    breaker = get_breaker()
+    if not breaker.allow():
+        logger.info(f"OCR circuit open, using local OCR for {image_path}")
+        return await asyncio.to_thread(local_text, image_path)
+
+    deadline = time.monotonic() + settings.OCR_DEADLINE_SECONDS
+    vision = asyncio.ensure_future(vision_extract())
+    vision.add_done_callback(observe(breaker, time.monotonic()))
+
+    pending = {vision}
+    if settings.OCR_HEDGE_ENABLED:
+        done, pending = await asyncio.wait(pending, timeout=hedge_delay(breaker))
+        text = first_text(done)
+        if text:
+            return text
+        logger.info(f"Vision slow or failed for {image_path}, hedging with local OCR")
+        pending.add(asyncio.ensure_future(asyncio.to_thread(local_text, image_path)))
+
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        text = first_text(done)
+        if text:
+            return text
+
+    logger.error(f"No OCR text for {image_path} within {settings.OCR_DEADLINE_SECONDS}s")
+    return None
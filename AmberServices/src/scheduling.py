@@ -0,0 +1,216 @@
+"""
+Tenant-fair scheduling for bulk receipt processing.
+
+Interactive uploads go straight to the interactive queue. Bulk work is parked
+in one Redis list per tenant (the uploading user) and released onto the bulk
+queue by ``dispatch``, which walks the active tenants round-robin, giving each
+up to its weight per round while keeping it under its in-flight limit. A large
+backlog therefore only ever occupies its own share of the bulk workers.
+
+In-flight work is tracked as a sorted set of task ids scored by a deadline, so
+slots of a worker that died are reclaimed once ``SCHEDULER_SLOT_TIMEOUT``
+passes even if the release callback never runs.
+"""
+
+import json
+import time
+
+from celery import signature
+from celery.result import GroupResult
+from celery.utils import uuid
+from django.conf import settings
+
+from .broker import get_redis
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+RING_KEY = "amber:fair:ring"
+ACTIVE_KEY = "amber:fair:active"
+INFLIGHT_KEY = "amber:fair:inflight"
+LOCK_KEY = "amber:fair:dispatch-lock"
+PENDING_KEY = "amber:fair:dispatch-pending"
+LOCK_TIMEOUT = 30
+
+
+def queue_key(tenant):
+    return f"amber:fair:queue:{tenant}"
+
+
+def inflight_key(tenant):
+    return f"amber:fair:inflight:{tenant}"
+
+
+def handle_key(group_id):
+    return f"amber:fair:handle:{group_id}"
+
+
+# Drop a tenant from the ring only if no work was pushed since we saw it empty.
+DEACTIVATE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[1])
+    redis.call('LREM', KEYS[3], 0, ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+# Delete the dispatch lock only while it still holds our token; after a
+# dispatcher outlived LOCK_TIMEOUT it may belong to another one.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def tenant_weight(tenant):
+    return max(1, settings.SCHEDULER_TENANT_WEIGHTS.get(tenant, 1))
+
+
+def tenant_limit(tenant):
+    return settings.SCHEDULER_TENANT_LIMITS.get(tenant, settings.SCHEDULER_TENANT_MAX_IN_FLIGHT)
+
+
+def submit_interactive(task_signature):
+    return task_signature.apply_async(queue=settings.SCHEDULER_INTERACTIVE_QUEUE)
+
+
+def submit_bulk(tenant, signatures, sizes=None):
+    """
+    Park ``signatures`` in the tenant's backlog and return a saved
+    ``GroupResult`` that tracks all of them as one progress handle.
+    ``sizes`` is the number of items each signature carries (default one),
+    kept with the handle's owner for ``bulk_handle``.
+    """
+    results = [task_signature.freeze() for task_signature in signatures]
+    group_result = GroupResult(uuid(), results)
+    group_result.save()
+
+    redis = get_redis()
+    handle = {"tenant": tenant, "sizes": sizes or [1] * len(signatures)}
+    redis.set(handle_key(group_result.id), json.dumps(handle), ex=int(settings.CELERY_RESULT_EXPIRES.total_seconds()))
+    park(redis, tenant, signatures)
+
+    dispatch()
+    return group_result
+
+
+def resubmit(tenant, task_signature):
+    """
+    Park a retry of bulk work in the tenant's backlog, so it is dispatched
+    and counted in flight like the rest of its work. Returns its task id.
+    """
+    result = task_signature.freeze()
+    park(get_redis(), tenant, [task_signature])
+    dispatch()
+    return result.id
+
+
+def park(redis, tenant, signatures):
+    with redis.pipeline() as pipe:
+        pipe.rpush(queue_key(tenant), *[json.dumps(dict(task_signature)) for task_signature in signatures])
+        pipe.sadd(ACTIVE_KEY, tenant)
+        _, added = pipe.execute()
+    if added:
+        redis.rpush(RING_KEY, tenant)
+
+
+def bulk_handle(group_id):
+    """The ``{"tenant", "sizes"}`` a bulk progress handle was submitted with, or ``None``."""
+    handle = get_redis().get(handle_key(group_id))
+    return json.loads(handle) if handle else None
+
+
+def release(tenant, token):
+    redis = get_redis()
+    with redis.pipeline() as pipe:
+        pipe.zrem(inflight_key(tenant), token)
+        pipe.zrem(INFLIGHT_KEY, token)
+        pipe.execute()
+
+
+def dispatch():
+    """
+    Move as much parked bulk work onto the bulk queue as the in-flight limits
+    allow. Only one dispatcher runs at a time. A call that finds the lock
+    taken leaves a pending flag instead, and the lock holder runs another
+    round for it after releasing the lock, so slots freed meanwhile are
+    refilled right away rather than on the next beat.
+    """
+    redis = get_redis()
+    release_lock = redis.register_script(RELEASE_LOCK_SCRIPT)
+    deactivate = redis.register_script(DEACTIVATE_SCRIPT)
+    dispatched = 0
+
+    # Flag before trying the lock, and check the flag after releasing it:
+    # either this call gets the lock or the holder sees the flag.
+    redis.set(PENDING_KEY, "1", ex=LOCK_TIMEOUT)
+    while redis.exists(PENDING_KEY):
+        token = uuid()
+        if not redis.set(LOCK_KEY, token, nx=True, ex=LOCK_TIMEOUT):
+            break
+        try:
+            redis.delete(PENDING_KEY)
+            dispatched += dispatch_round(redis, deactivate)
+        finally:
+            release_lock(keys=[LOCK_KEY], args=[token])
+
+    if dispatched:
+        logger.info(f"Dispatched {dispatched} bulk tasks")
+    return dispatched
+
+
+def dispatch_round(redis, deactivate):
+    dispatched = 0
+    now = time.time()
+    redis.zremrangebyscore(INFLIGHT_KEY, 0, now)
+    # Rotate so the same tenant does not always open the round.
+    redis.lmove(RING_KEY, RING_KEY, "LEFT", "RIGHT")
+
+    progress = True
+    while progress:
+        progress = False
+        for tenant in [value.decode() for value in redis.lrange(RING_KEY, 0, -1)]:
+            redis.zremrangebyscore(inflight_key(tenant), 0, now)
+            limit = tenant_limit(tenant)
+
+            for _ in range(tenant_weight(tenant)):
+                if redis.zcard(INFLIGHT_KEY) >= settings.SCHEDULER_BULK_MAX_IN_FLIGHT:
+                    return dispatched
+                if redis.zcard(inflight_key(tenant)) >= limit:
+                    break
+
+                payload = redis.lpop(queue_key(tenant))
+                if payload is None:
+                    deactivate(keys=[queue_key(tenant), ACTIVE_KEY, RING_KEY], args=[tenant])
+                    break
+
+                send(redis, tenant, signature(json.loads(payload)))
+                dispatched += 1
+                progress = True
+    return dispatched
+
+
+def send(redis, tenant, task_signature):
+    token = task_signature.options["task_id"]
+    deadline = time.time() + settings.SCHEDULER_SLOT_TIMEOUT
+    with redis.pipeline() as pipe:
+        pipe.zadd(inflight_key(tenant), {token: deadline})
+        pipe.zadd(INFLIGHT_KEY, {token: deadline})
+        pipe.execute()
+
+    callback = signature(
+        "src.tasks.release_bulk_slot",
+        args=(tenant, token),
+        immutable=True,
+        queue=settings.SCHEDULER_INTERACTIVE_QUEUE,
+    )
+    task_signature.apply_async(
+        queue=settings.SCHEDULER_BULK_QUEUE,
+        link=callback,
+        link_error=callback,
+    )
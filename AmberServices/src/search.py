@@ -0,0 +1,228 @@
+"""
+Full-text search over receipts.
+
+Each ``ProcessedImage`` gets one row in ``src_receipt_search`` holding its
+vendor, address, item descriptions, transaction date (spelled out, so "march"
+finds March receipts) and the OCR text kept on ``ProcessingState``. On SQLite
+the table is an FTS5 index ranked with bm25; on PostgreSQL it holds a weighted
+``tsvector`` under a GIN index ranked with ``ts_rank_cd``. Every query term is
+matched as a prefix, and all terms must match.
+
+The table is created by ``ensure_schema`` after ``migrate`` and kept current
+by the ``ProcessedImage`` signals; ``manage.py build_search_index`` fills it
+for existing receipts.
+
+On SQLite the owner is stored as an indexed ``u<id>`` token and matched as
+part of the FTS query, so a search only ever visits the user's own rows
+before ranking and the limit are applied.
+"""
+
+import re
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils.dateparse import parse_date
+
+from .models import ProcessedImage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TABLE = "src_receipt_search"
+MAX_TERMS = 8
+
+SQLITE_SCHEMA = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5(
+        user_id, vendor, address, items, dates, ocr_text,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """,
+]
+
+POSTGRES_SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {TABLE} (
+        processed_id bigint PRIMARY KEY REFERENCES {ProcessedImage._meta.db_table} (id) ON DELETE CASCADE,
+        user_id bigint NOT NULL,
+        document tsvector NOT NULL
+    )
+    """,
+    f"CREATE INDEX IF NOT EXISTS {TABLE}_document ON {TABLE} USING GIN (document)",
+    f"CREATE INDEX IF NOT EXISTS {TABLE}_user ON {TABLE} (user_id)",
+]
+
+# Vendor matches rank above items and dates, which rank above the raw OCR text.
+SQLITE_RANK = f"bm25({TABLE}, 0.0, 10.0, 4.0, 6.0, 6.0, 1.0)"
+SQLITE_TEXT_COLUMNS = "{vendor address items dates ocr_text}"
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') || "
+    "setweight(to_tsvector('simple', %s), 'B') || setweight(to_tsvector('simple', %s), 'B') || "
+    "setweight(to_tsvector('simple', %s), 'D')"
+)
+
+
+def is_postgres():
+    return connection.vendor == "postgresql"
+
+
+def supported():
+    return connection.vendor in ("sqlite", "postgresql")
+
+
+def ensure_schema():
+    """Create the search table if needed; returns whether it was created, and so is empty."""
+    if not supported():
+        logger.warning(f"Full-text search is not available on {connection.vendor}")
+        return False
+    with connection.cursor() as cursor:
+        created = TABLE not in connection.introspection.table_names(cursor)
+        for statement in POSTGRES_SCHEMA if is_postgres() else SQLITE_SCHEMA:
+            cursor.execute(statement)
+    return created
+
+
+def index_all(batch_size=1000):
+    """Index every receipt, in id order; yields the running count after each batch."""
+    indexed = 0
+    last_id = 0
+    while True:
+        ids = list(ProcessedImage.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return
+        indexed += index_receipts(ids)
+        last_id = ids[-1]
+        yield indexed
+
+
+def owner_token(user_id):
+    return f"u{user_id}"
+
+
+def item_text(items):
+    if not isinstance(items, list):
+        return ""
+    words = []
+    for item in items:
+        if isinstance(item, dict):
+            words.extend(str(value) for value in item.values() if isinstance(value, str))
+        elif isinstance(item, str):
+            words.append(item)
+    return " ".join(words)
+
+
+def date_text(value):
+    if isinstance(value, str):
+        value = parse_date(value)
+    if not isinstance(value, date):
+        return ""
+    return f"{value:%B %b %Y %Y-%m-%d %d/%m/%Y}"
+
+
+def documents(processed_ids):
+    rows = ProcessedImage.objects.filter(id__in=processed_ids).values_list(
+        "id", "user_id", "company_name", "address", "items", "transaction_date", "image__processing__ocr_text",
+    )
+    for processed_id, user_id, company_name, address, items, transaction_date, ocr_text in rows:
+        yield processed_id, user_id, [
+            company_name or "",
+            address or "",
+            item_text(items),
+            date_text(transaction_date),
+            ocr_text or "",
+        ]
+
+
+def index_receipts(processed_ids):
+    processed_ids = list(processed_ids)
+    if not processed_ids or not supported():
+        return 0
+
+    rows = list(documents(processed_ids))
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_postgres():
+            cursor.executemany(
+                f"INSERT INTO {TABLE} (processed_id, user_id, document) VALUES (%s, %s, {POSTGRES_DOCUMENT}) "
+                f"ON CONFLICT (processed_id) DO UPDATE SET user_id = EXCLUDED.user_id, document = EXCLUDED.document",
+                [(processed_id, user_id, *fields) for processed_id, user_id, fields in rows],
+            )
+        else:
+            remove_receipts(processed_ids, cursor)
+            cursor.executemany(
+                f"INSERT INTO {TABLE} (rowid, user_id, vendor, address, items, dates, ocr_text) "
+                f"VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [(processed_id, owner_token(user_id), *fields) for processed_id, user_id, fields in rows],
+            )
+    return len(rows)
+
+
+def remove_receipts(processed_ids, cursor=None):
+    if not processed_ids or not supported():
+        return
+    column = "processed_id" if is_postgres() else "rowid"
+    placeholders = ", ".join(["%s"] * len(processed_ids))
+    statement = f"DELETE FROM {TABLE} WHERE {column} IN ({placeholders})"
+    if cursor is not None:
+        cursor.execute(statement, processed_ids)
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(statement, processed_ids)
+
+
+def prune():
+    # Rows of receipts deleted while indexing was failing.
+    column = "processed_id" if is_postgres() else "rowid"
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE {column} NOT IN (SELECT id FROM {ProcessedImage._meta.db_table})")
+
+
+def query_terms(query):
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+def postgres_query(terms):
+    """A ``to_tsquery`` expression matching every one of ``terms`` as a prefix."""
+    return " & ".join(f"{term}:*" for term in terms)
+
+
+def sqlite_query(user_id, terms):
+    """An FTS5 query matching every one of ``terms`` as a prefix among ``user_id``'s rows."""
+    match = " ".join(f'"{term}"*' for term in terms)
+    return f'user_id : "{owner_token(user_id)}" AND {SQLITE_TEXT_COLUMNS} : ({match})'
+
+
+def search(user_id, query, limit):
+    """
+    Return ``(processed_id, rank)`` pairs for ``user_id``'s receipts matching
+    every term of ``query`` as a prefix, best match first.
+    """
+    terms = query_terms(query)
+    if not terms or not supported():
+        return []
+
+    with connection.cursor() as cursor:
+        if is_postgres():
+            cursor.execute(
+                f"SELECT processed_id, ts_rank_cd(document, query) AS rank "
+                f"FROM {TABLE}, to_tsquery('simple', %s) query "
+                f"WHERE user_id = %s AND document @@ query ORDER BY rank DESC, processed_id DESC LIMIT %s",
+                [postgres_query(terms), user_id, limit],
+            )
+            return [(processed_id, float(rank)) for processed_id, rank in cursor.fetchall()]
+
+        cursor.execute(
+            f"SELECT rowid, {SQLITE_RANK} AS score FROM {TABLE} "
+            f"WHERE {TABLE} MATCH %s ORDER BY score, rowid DESC LIMIT %s",
+            [sqlite_query(user_id, terms), limit],
+        )
+        return [(processed_id, -score) for processed_id, score in cursor.fetchall()]
+
+
+def optimize():
+    with connection.cursor() as cursor:
+        if is_postgres():
+            cursor.execute(f"ANALYZE {TABLE}")
+        else:
+            cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
@@ -1,3 +1,5 @@
+import zipfile
+
 from rest_framework import serializers
 
 from django.contrib.auth.models import User
@@ -149,3 +151,43 @@ class SerializePDF(serializers.ModelSerializer):
         data['client'] = client
 
         return data
+
+
+class SerializeArchive(serializers.Serializer):
+    provider = serializers.CharField()
+    client = serializers.CharField()
+    archive = serializers.FileField()
+
+    def validate_archive(self, value):
+        if not value.name.lower().endswith('.zip'):
+            raise serializers.ValidationError("Uploaded file must be a ZIP archive.")
+        if not zipfile.is_zipfile(value):
+            raise serializers.ValidationError("Uploaded file is not a valid ZIP archive.")
+        value.seek(0)
+        return value
+
+    def validate_provider(self, value):
+        if isinstance(value, Providers):
+            return value
+
+        try:
+            provider = Providers.objects.get(signature=value, is_active=True)
+            return provider
+        except Providers.DoesNotExist:
+            raise serializers.ValidationError(f"Provider with signature '{value}' does not exist or is inactive.")
+
+    def validate_client(self, value):
+        if isinstance(value, User):
+            return value
+
+        try:
+            client = User.objects.get(username=value)
+            return client
+        except User.DoesNotExist:
+            raise serializers.ValidationError(f"Client with username '{value}' does not exist.")
+
+    def validate(self, data):
+        if data['provider'].client != data['client']:
+            raise serializers.ValidationError("The specified provider does not belong to the specified client.")
+
+        return data
@@ -0,0 +1,79 @@
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Images, PDFs, ProcessedImage
+from . import search
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+FILE_FIELDS = {Images: "image", PDFs: "pdf"}
+
+
+# Blob references follow committed rows only: they are taken and released
+# in on_commit callbacks, so a rolled back save or delete changes nothing.
+
+@receiver(pre_save, sender=Images)
+@receiver(pre_save, sender=PDFs)
+def remember_previous_file(sender, instance, **kwargs):
+    field = FILE_FIELDS[sender]
+    # Only a newly uploaded file takes a fresh reference on the blob store.
+    instance._file_changed = not getattr(instance, field)._committed
+    instance._previous_file_name = None
+    if instance.pk and instance._file_changed:
+        instance._previous_file_name = (
+            sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+        )
+
+
+@receiver(post_save, sender=Images)
+@receiver(post_save, sender=PDFs)
+def reference_saved_file(sender, instance, created, **kwargs):
+    field_file = getattr(instance, FILE_FIELDS[sender])
+    storage, name = field_file.storage, field_file.name
+    previous = getattr(instance, "_previous_file_name", None)
+    if name and (created or getattr(instance, "_file_changed", False)):
+        transaction.on_commit(lambda: storage.acquire(name))
+    if previous:
+        transaction.on_commit(lambda: storage.delete(previous))
+    instance._file_changed = False
+    instance._previous_file_name = None
+
+
+@receiver(post_delete, sender=Images)
+@receiver(post_delete, sender=PDFs)
+def release_deleted_file(sender, instance, **kwargs):
+    field_file = getattr(instance, FILE_FIELDS[sender])
+    storage, name = field_file.storage, field_file.name
+    if name:
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+def refresh_search_index(processed_id):
+    # The search index must never fail a receipt; build_search_index repairs it.
+    try:
+        search.index_receipts([processed_id])
+    except DatabaseError as e:
+        logger.error(f"Failed to index ProcessedImage {processed_id} for search: {e}")
+
+
+@receiver(post_save, sender=ProcessedImage)
+def index_processed_image(sender, instance, **kwargs):
+    transaction.on_commit(lambda: refresh_search_index(instance.pk))
+
+
+@receiver(post_delete, sender=ProcessedImage)
+def unindex_processed_image(sender, instance, **kwargs):
+    try:
+        search.remove_receipts([instance.pk])
+    except DatabaseError as e:
+        logger.error(f"Failed to remove ProcessedImage {instance.pk} from search: {e}")
+
+
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    if sender.name == "src" and search.ensure_schema():
+        for _ in search.index_all():
+            pass
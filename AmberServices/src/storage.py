@@ -0,0 +1,146 @@
+import hashlib
+import os
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+BLOB_PREFIX = "blobs"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every upload once, under ``blobs/<ab>/<cd>/<sha256><ext>``.
+
+    The directory part produced by ``upload_to`` is ignored; identical files
+    share one blob whose ``Blob.ref_count`` tracks how many rows point at it.
+    Saving a file only stores the blob; the row pointing at it takes its
+    reference with ``acquire`` once committed (see ``signals``), so a row that
+    is rolled back never leaves a reference behind. ``delete`` only drops a
+    reference, the file itself is removed later by ``collect_garbage`` once
+    nothing has used it for ``orphan_grace_seconds``. Names that are not blobs
+    (files uploaded before this backend) keep the plain ``FileSystemStorage``
+    behaviour.
+    """
+
+    def __init__(self, *args, shard_depth=2, shard_width=2, orphan_grace_seconds=3600, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_depth = shard_depth
+        self.shard_width = shard_width
+        self.orphan_grace = timedelta(seconds=orphan_grace_seconds)
+
+    def blob_name(self, digest, filename):
+        shards = [digest[i * self.shard_width:(i + 1) * self.shard_width] for i in range(self.shard_depth)]
+        extension = os.path.splitext(filename)[1].lower()
+        return "/".join([BLOB_PREFIX, *shards, f"{digest}{extension}"])
+
+    def is_blob(self, name):
+        return bool(name) and name.startswith(f"{BLOB_PREFIX}/")
+
+    def digest(self, content):
+        sha = hashlib.sha256()
+        size = 0
+        for chunk in content.chunks():
+            sha.update(chunk)
+            size += len(chunk)
+        content.seek(0)
+        return sha.hexdigest(), size
+
+    def _save(self, name, content):
+        digest, size = self.digest(content)
+        return self._store(digest, size, name, lambda blob_name: super(ContentAddressedStorage, self)._save(blob_name, content))
+
+    def adopt(self, path, filename):
+        """Move an already written file (e.g. an assembled upload) into the store without copying it."""
+        sha = hashlib.sha256()
+        with open(path, "rb") as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+                sha.update(chunk)
+
+        def place(blob_name):
+            full_path = self.path(blob_name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(path, full_path)
+            return blob_name
+
+        name = self._store(sha.hexdigest(), os.path.getsize(path), filename, place)
+        if os.path.exists(path):
+            os.remove(path)
+        return name
+
+    def _store(self, digest, size, filename, write):
+        Blob = apps.get_model("src", "Blob")
+
+        with transaction.atomic():
+            blob, _ = Blob.objects.get_or_create(
+                digest=digest,
+                defaults={"name": self.blob_name(digest, filename), "size": size, "released_at": now()},
+            )
+            # Lock the row so a concurrent garbage collection cannot remove the
+            # file between the existence check and the write.
+            blob = Blob.objects.select_for_update().get(pk=blob.pk)
+            if blob.ref_count == 0:
+                # Nothing references the blob until the new row commits; keep
+                # it out of garbage collection for another grace period.
+                Blob.objects.filter(pk=blob.pk).update(released_at=now())
+
+            if not self.exists(blob.name):
+                stored_name = write(blob.name)
+                if stored_name != blob.name:
+                    super().delete(stored_name)
+
+        return blob.name
+
+    def acquire(self, name):
+        """Take a reference on blob ``name`` for a committed row."""
+        if not self.is_blob(name):
+            return 0
+        Blob = apps.get_model("src", "Blob")
+        acquired = Blob.objects.filter(name=name).update(ref_count=F("ref_count") + 1, released_at=None)
+        if not acquired:
+            logger.error(f"Blob {name} was collected before a reference was taken on it")
+        return acquired
+
+    def release(self, name):
+        Blob = apps.get_model("src", "Blob")
+        return Blob.objects.filter(name=name, ref_count__gt=0).update(
+            ref_count=F("ref_count") - 1,
+            released_at=now(),
+        )
+
+    def delete(self, name):
+        if self.is_blob(name):
+            self.release(name)
+        else:
+            super().delete(name)
+
+    def collect_garbage(self, batch_size=500, grace=None):
+        Blob = apps.get_model("src", "Blob")
+        cutoff = now() - (grace if grace is not None else self.orphan_grace)
+
+        orphans = list(
+            Blob.objects.filter(ref_count=0, released_at__lt=cutoff)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:batch_size]
+        )
+
+        removed = 0
+        for pk in orphans:
+            with transaction.atomic():
+                blob = Blob.objects.select_for_update().filter(pk=pk, ref_count=0).first()
+                if blob is None:
+                    continue
+                super().delete(blob.name)
+                blob.delete()
+                removed += 1
+
+        if removed:
+            logger.info(f"Removed {removed} orphaned blobs")
+        return removed
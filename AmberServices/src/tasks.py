@@ -1,73 +1,254 @@
-import os
+import asyncio
+
 from celery import shared_task
+from celery.result import AsyncResult, GroupResult
 from django.conf import settings
-from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
-from .models import Images, ProcessedImage
-from .tesseract import GoogleVisionOCR
+from django.db import DatabaseError
+from .models import Images
+from . import async_pipeline, maintenance, pipeline, reprocessing, scheduling
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def process_image_task(image_path):
-    try:
-        logger.info(f"MEDIA_ROOT: {settings.MEDIA_ROOT}")
+def retry_countdown(retries):
+    return min(settings.PROCESSING_RETRY_BACKOFF * (2 ** retries), settings.PROCESSING_RETRY_BACKOFF_MAX)
 
 
-        if image_path.startswith('./media'):
-            image_path = image_path[len('./media/'):]
+def success_outcome(image_path, processed):
+    logger.info(f"Successfully processed image at path {image_path}")
+    return {"image_path": image_path, "status": "success", "processed_image": processed.id}
 
-        if image_path.startswith(settings.MEDIA_ROOT):
-            relative_path = os.path.relpath(image_path, settings.MEDIA_ROOT)
-        else:
-            relative_path = image_path
-
-        full_image_path = os.path.normpath(os.path.join(settings.MEDIA_ROOT, relative_path))
-
-        if not os.path.exists(full_image_path):
-            raise FileNotFoundError(f"No such file or directory: '{full_image_path}'")
-
-        ocr = GoogleVisionOCR(image_path=full_image_path)
-        ocr_text = ocr.extract_text_from_image()
-        if not ocr_text:
-            raise ValueError(f"No text extracted for image at path {image_path}")
-
-        processed_result = ocr.get_completion(ocr_text)
-        if not processed_result:
-            raise ValueError(f"Failed to process OCR data for image at path {image_path} {processed_result}")
-
-        image = Images.objects.get(image=relative_path)
-        with transaction.atomic():
-            ProcessedImage.objects.create(
-                user=image.client,
-                image=image.id,
-                company_name=processed_result.get("company_details", {}).get("name"),
-                address=processed_result.get("company_details", {}).get("address"),
-                vat_number=processed_result.get("company_details", {}).get("vat_number"),
-                transaction_date=processed_result.get("transaction_details", {}).get("date"),
-                transaction_time=processed_result.get("transaction_details", {}).get("time"),
-                payment_method=processed_result.get("transaction_details", {}).get("payment_method"),
-                items=processed_result.get("items"),
-                fuel_type=processed_result.get("fuel_type"),
-                is_invoice=processed_result.get("is_invoice"),
-                total_gross=processed_result.get("totals", {}).get("total_gross"),
-                total_vat=processed_result.get("totals", {}).get("total_vat"),
-                total_net=processed_result.get("totals", {}).get("total_net"),
-            )
-
-        logger.info(f"Successfully processed image at path {image_path}")
-        return {"image_path": image_path, "status": "success"}
-
-    except FileNotFoundError as e:
+
+def failure_outcome(image_path, image_id, image, e, retries, requeue):
+    """
+    Map a pipeline exception to the task result. Transient failures under the
+    retry limit call ``requeue(countdown)``, which either raises or returns
+    the id of the task retrying the image.
+    """
+    if isinstance(e, (pipeline.TransientError, DatabaseError)):
+        if retries >= settings.PROCESSING_MAX_RETRIES:
+            logger.error(f"Giving up on image at path {image_path} after {retries} retries: {e}")
+            if image is not None and not isinstance(e, pipeline.ProcessingInProgress):
+                pipeline.mark_failed(image, str(e))
+            return {"image_path": image_path, "status": "error", "error": str(e)}
+
+        countdown = retry_countdown(retries)
+        logger.warning(f"Retrying image at path {image_path} in {countdown}s: {e}")
+        return {"image_path": image_path, "status": "retrying", "error": str(e), "task_id": requeue(countdown)}
+
+    if isinstance(e, pipeline.DuplicateImage):
+        return {
+            "image_path": image_path,
+            "status": "duplicate",
+            "duplicate_of": e.original_id,
+            "processed_image": e.processed.id if e.processed else None,
+        }
+
+    if isinstance(e, pipeline.ImageRejected):
+        return {"image_path": image_path, "status": "rejected", "error": str(e)}
+
+    if isinstance(e, FileNotFoundError):
         logger.error(str(e))
         return {"image_path": image_path, "status": "error", "error": str(e)}
 
-    except Images.DoesNotExist:
+    if isinstance(e, Images.DoesNotExist):
         logger.error(f"Image not found in the database: {image_path}")
         return {"image_path": image_path, "status": "error", "error": "Image not found in database"}
 
+    logger.error(f"Error processing image at path {image_path}: {e}", exc_info=e)
+    if image is not None:
+        pipeline.mark_failed(image, str(e))
+    return {"image_path": image_path, "status": "error", "error": str(e)}
+
+
+def requeue_single(image_path, image_id, retries, tenant):
+    # Retry one image on its own rather than failing the rest of its batch,
+    # through the tenant's backlog so the retry holds one of its bulk slots.
+    def requeue(countdown):
+        retry = process_image_task.signature(
+            (image_path, image_id, tenant),
+            countdown=countdown,
+            retries=retries + 1,
+        )
+        if tenant is None:
+            # Bulk work queued before jobs carried their tenant.
+            return retry.apply_async(queue=settings.SCHEDULER_BULK_QUEUE).id
+        return scheduling.resubmit(tenant, retry)
+    return requeue
+
+
+@shared_task(bind=True, max_retries=None)
+def process_image_task(self, image_path, image_id=None, tenant=None):
+    image = None
+    try:
+        relative_path, full_image_path = pipeline.resolve_image_path(image_path)
+        image = pipeline.find_image(relative_path, image_id)
+        processed = pipeline.process_image(image, full_image_path)
+        return success_outcome(image_path, processed)
+
     except Exception as e:
-        logger.error(f"Error processing image at path {image_path}: {e}", exc_info=True)
-        return {"image_path": image_path, "status": "error", "error": str(e)}
+        retries = self.request.retries
+        if self.request.called_directly:
+            # Running inside a bulk chunk.
+            return failure_outcome(image_path, image_id, image, e, retries, requeue_single(image_path, image_id, retries, tenant))
+
+        def requeue(countdown):
+            raise self.retry(exc=e, countdown=countdown)
+
+        return failure_outcome(image_path, image_id, image, e, retries, requeue)
+
+
+@shared_task
+def process_image_batch_async(jobs, tenant=None):
+    """
+    Process a batch of ``(image_path, image_id)`` jobs on one event loop; see
+    ``async_pipeline``. Failed images are retried individually.
+    """
+    results = asyncio.run(async_pipeline.run_batch(jobs))
+
+    outcomes = []
+    for (image_path, image_id), (image, result) in zip(jobs, results):
+        if not isinstance(result, Exception):
+            outcomes.append(success_outcome(image_path, result))
+            continue
+        outcomes.append(failure_outcome(image_path, image_id, image, result, 0, requeue_single(image_path, image_id, 0, tenant)))
+    return outcomes
+
+
+@shared_task
+def collect_orphaned_blobs():
+    return {"removed": maintenance.collect_orphaned_blobs()}
+
+
+@shared_task
+def collect_orphaned_media():
+    return {"removed": maintenance.collect_orphaned_media()}
+
+
+@shared_task
+def expire_providers():
+    return {"deactivated": maintenance.expire_providers()}
+
+
+@shared_task
+def expire_task_results():
+    return {"expiring": maintenance.expire_task_results(), "deleted": maintenance.clean_database_results()}
+
+
+@shared_task
+def clear_expired_sessions():
+    return {"deleted": maintenance.clear_expired_sessions()}
+
+
+@shared_task
+def expire_uploads():
+    return {"deleted": maintenance.expire_uploads()}
+
+
+def image_job(image):
+    return (".." + image.image.url, image.id)
+
+
+def enqueue_interactive(image):
+    return scheduling.submit_interactive(process_image_task.s(*image_job(image)))
+
+
+def submit_image(image):
+    """
+    Run the instant local quality check on a new upload and queue it on the
+    interactive lane. Returns ``(result, rejection_reason)``; a rejected
+    upload keeps its row and ``ProcessingState`` but gives up its file.
+    Duplicates are only recognised once OCR ran, by the task.
+    """
+    image_path = image.image.url
+    # The quality gate takes milliseconds, so the uploader hears about a
+    # blurry or dark photo now instead of after a failed OCR call.
+    reason = pipeline.check_quality(image, image.image.path)
+    if reason:
+        pipeline.discard_file(image)
+        return None, reason
+    return {"image_path": image_path, "task_id": enqueue_interactive(image).id}, None
+
+
+def enqueue_bulk(tenant, images):
+    jobs = [image_job(image) for image in images]
+    if settings.PIPELINE_MODE == "async":
+        size = settings.ASYNC_BATCH_SIZE
+        batches = [process_image_batch_async.s(jobs[i:i + size], tenant) for i in range(0, len(jobs), size)]
+    else:
+        size = settings.BULK_TASK_CHUNK_SIZE
+        batches = process_image_task.chunks([(*job, tenant) for job in jobs], size).group().tasks
+    sizes = [len(jobs[i:i + size]) for i in range(0, len(jobs), size)]
+    return scheduling.submit_bulk(tenant, batches, sizes)
+
+
+def final_outcome(outcome):
+    """Follow a retried image to its latest attempt; ``None`` while that is still running."""
+    while outcome.get("status") == "retrying":
+        if not outcome.get("task_id"):
+            return None
+        attempt = AsyncResult(outcome["task_id"])
+        if not attempt.ready():
+            return None
+        if not attempt.successful():
+            return {"image_path": outcome["image_path"], "status": "error", "error": str(attempt.result)}
+        outcome = attempt.result
+    return outcome
+
+
+def bulk_progress(progress_id, tenant):
+    """
+    Per-image progress of an ``enqueue_bulk`` handle, or ``None`` when
+    ``tenant`` has no such handle. Images of a batch task that has not
+    finished, or whose retry has not, are pending; every image of a batch
+    task that crashed failed.
+    """
+    handle = scheduling.bulk_handle(progress_id)
+    result = GroupResult.restore(progress_id) if handle and handle["tenant"] == tenant else None
+    if result is None:
+        return None
+
+    outcomes = {}
+    pending = failed = 0
+    for batch, size in zip(result.results, handle["sizes"]):
+        if batch.successful():
+            for outcome in batch.result or []:
+                outcome = final_outcome(outcome)
+                if outcome is None:
+                    pending += 1
+                else:
+                    outcomes[outcome.get("status")] = outcomes.get(outcome.get("status"), 0) + 1
+        elif batch.failed():
+            failed += size
+        else:
+            pending += size
+
+    failed += outcomes.get("error", 0)
+    images = sum(handle["sizes"])
+    return {
+        "images": images,
+        "processed": images - pending,
+        "succeeded": outcomes.get("success", 0),
+        "duplicates": outcomes.get("duplicate", 0),
+        "rejected": outcomes.get("rejected", 0),
+        "failed": failed,
+        "pending": pending,
+        "ready": pending == 0,
+    }
+
+
+@shared_task
+def dispatch_bulk_work():
+    return {"dispatched": scheduling.dispatch()}
+
+
+@shared_task
+def release_bulk_slot(tenant, token):
+    scheduling.release(tenant, token)
+    return {"dispatched": scheduling.dispatch()}
+
+
+@shared_task
+def reprocess_batch(run_id, token):
+    return {"run": run_id, "handled": reprocessing.run_batch(run_id, token)}
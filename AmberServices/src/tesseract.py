@@ -1,5 +1,7 @@
 import logging
+import aiofiles
 from celery import shared_task
+from django.conf import settings
 from google.cloud import vision
 from google.oauth2 import service_account
 from .models import SecretKey
@@ -20,6 +22,90 @@ def set_openai_key():
 set_openai_key.delay()
 
 
+def format_annotation(response):
+    if response.error.message:
+        raise Exception(f"Error with Google Vision API: {response.error.message}")
+
+    ascii_text = "\n"
+    for page in response.full_text_annotation.pages:
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                line = []
+                for word in paragraph.words:
+                    word_text = "".join(symbol.text for symbol in word.symbols)
+                    line.append(word_text)
+                paragraph_text = " ".join(line)
+                ascii_text += f"{paragraph_text[:41].ljust(41)}\n"
+
+    return ascii_text
+
+
+# Bump whenever build_prompt changes so stale results can be reprocessed.
+PROMPT_VERSION = 2
+
+
+def build_prompt(ocr_text):
+    # Only transcription: VAT rates and amounts are derived in src/vat.py.
+    return f"""
+    You are Amberscan. Extract what is printed on this Irish receipt or invoice. Do not calculate anything:
+    copy amounts exactly as printed and use null for anything not printed.
+        - **company**: name, address, VAT number.
+        - **transaction**: date (YYYY-MM-DD), time (HH:MM), payment method (Cash/Card).
+        - **items**: description, quantity, unit price, gross price, and the VAT rate only if printed for the item.
+          Give each item a category: fuel, heating_fuel, electricity, gas, food, restaurant, accommodation,
+          newspapers, books, children_clothing, medicine, alcohol or general.
+          Flag each item as tax-deductible (`true` or `false`) under Irish rules.
+        - **fuel type** (Diesel, Petrol) if applicable.
+        - **is_invoice**: true only if the exact words "invoice", "bill" or "bill number" appear.
+        - **totals**: the printed total, and the printed VAT and net totals if shown.
+    Output JSON only:
+    {{
+        "company_details": {{"name": "", "address": "", "vat_number": ""}},
+        "transaction_details": {{"date": "", "time": "", "payment_method": ""}},
+        "items": [{{"description": "", "quantity": 1, "unit_price": 0.00, "gross_price": 0.00, "vat_rate": null, "category": "general", "tax_deductible": false}}],
+        "fuel_type": null,
+        "is_invoice": false,
+        "totals": {{"total_gross": 0.00, "total_vat": null, "total_net": null}}
+    }}
+    ---
+    Receipt Data:
+    {ocr_text}
+    """
+
+
+def completion_messages(prompt):
+    return [
+        {"role": "system", "content": "You are Amberscan, a financial assistant for VAT compliance. Respond only in JSON."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def completion_options(model, json_mode):
+    options = {
+        "model": model,
+        "temperature": settings.COMPLETION_TEMPERATURE,
+        "max_tokens": settings.COMPLETION_MAX_TOKENS,
+    }
+    if json_mode:
+        options["response_format"] = {"type": "json_object"}
+    return options
+
+
+def request_completion(ocr_text, model="gpt-4", json_mode=False):
+    prompt = build_prompt(ocr_text)
+    try:
+        from openai import OpenAI
+        client = OpenAI()
+        response = client.chat.completions.create(
+            messages=completion_messages(prompt),
+            **completion_options(model, json_mode)
+        )
+        return response.choices[0].message.content
+    except Exception as e:
+        logging.error(f"Failed to get completion: {e}")
+        return None
+
+
 class GoogleVisionOCR:
     def __init__(self, credentials_path='./media/key/serious-cabinet-441714-j0-dbdb45c99a95.json', image_path="./media/images/"):
         self.credentials = service_account.Credentials.from_service_account_file(credentials_path)
@@ -32,81 +118,14 @@ class GoogleVisionOCR:
                 content = image_file.read()
 
             image = vision.Image(content=content)
-            response = self.client.text_detection(image=image)
-
-            if response.error.message:
-                raise Exception(f"Error with Google Vision API: {response.error.message}")
-
-            ascii_text = "\n"
-            for page in response.full_text_annotation.pages:
-                for block in page.blocks:
-                    for paragraph in block.paragraphs:
-                        line = []
-                        for word in paragraph.words:
-                            word_text = "".join(symbol.text for symbol in word.symbols)
-                            line.append(word_text)
-                        paragraph_text = " ".join(line)
-                        ascii_text += f"{paragraph_text[:41].ljust(41)}\n"
-
-            return ascii_text
+            response = self.client.text_detection(image=image, timeout=settings.OCR_VISION_TIMEOUT)
+            return format_annotation(response)
         except Exception as e:
             logging.error(f"Failed to process image {self.image_path}: {e}")
             return None
 
-    def get_completion(self, ocr_text, model="gpt-4"):
-        prompt = f"""
-        You are Amberscan, an advanced AI for analyzing receipts and invoices under Irish tax laws. Your task is to:
-        1. Extract and organize receipt details:
-            - Identify the **company name**, address, and VAT number.
-            - Extract **transaction details**: date, time, payment method.
-            - Identify **items**: description, quantity, unit price, gross price.
-            - Identify **fuel type** (e.g., Diesel, Petrol) if applicable.
-            - Determine if the receipt is an invoice by checking for the exact words "invoice," "bill," or "bill number."
-        2. Perform VAT calculations using Irish rates:
-            - Assign appropriate VAT rates (0%, 9%, 13.5%, 23%).
-            - Calculate gross, VAT, and net amounts for each item.
-        3. Flag items as tax-deductible (`true` or `false`) based on Irish laws.
-        4. Output results as JSON:
-        {{
-            "company_details": {{
-                "name": "Company Name",
-                "address": "Company Address",
-                "vat_number": "VAT123456"
-            }},
-            "transaction_details": {{
-                "date": "YYYY-MM-DD",
-                "time": "HH:MM",
-                "payment_method": "Cash/Card"
-            }},
-            "items": [...],
-            "fuel_type": "Diesel/Petrol/None",
-            "is_invoice": true,
-            "totals": {{
-                "total_gross": 100.00,
-                "total_vat": 18.70,
-                "total_net": 81.30
-            }}
-        }}
-        ---
-        Receipt Data:
-        {ocr_text}
-        """
-        try:
-            from openai import OpenAI
-            client = OpenAI()
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are Amberscan, a financial assistant for VAT compliance. Respond only in JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=1000
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.error(f"Failed to get completion: {e}")
-            return None
+    def get_completion(self, ocr_text, model="gpt-4", json_mode=False):
+        return request_completion(ocr_text, model, json_mode)
 
     @shared_task
     def process_image(self):
@@ -126,3 +145,43 @@ class GoogleVisionOCR:
             result = self.process_image.delay(path)
             results.append(result)
         return results
+
+
+class AsyncGoogleVisionOCR:
+    """
+    Asyncio counterpart of ``GoogleVisionOCR``: one instance is shared by
+    every receipt of a batch, so a single process keeps many Vision and
+    OpenAI requests in flight at once. Create it inside the running loop.
+    """
+
+    def __init__(self, credentials_path='./media/key/serious-cabinet-441714-j0-dbdb45c99a95.json'):
+        from openai import AsyncOpenAI
+        self.credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        self.client = vision.ImageAnnotatorAsyncClient(credentials=self.credentials)
+        self.openai = AsyncOpenAI()
+
+    async def extract_text_from_image(self, image_path):
+        try:
+            async with aiofiles.open(image_path, "rb") as image_file:
+                content = await image_file.read()
+
+            request = vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+            )
+            response = await self.client.batch_annotate_images(requests=[request], timeout=settings.OCR_VISION_TIMEOUT)
+            return format_annotation(response.responses[0])
+        except Exception as e:
+            logging.error(f"Failed to process image {image_path}: {e}")
+            return None
+
+    async def get_completion(self, ocr_text, model="gpt-4", json_mode=False):
+        try:
+            response = await self.openai.chat.completions.create(
+                messages=completion_messages(build_prompt(ocr_text)),
+                **completion_options(model, json_mode)
+            )
+            return response.choices[0].message.content
+        except Exception as e:
+            logging.error(f"Failed to get completion: {e}")
+            return None
@@ -0,0 +1,183 @@
+import json
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import cascade, pipeline
+from .utils import receipt_result as receipt
+
+
+def invalid_category():
+    return receipt(items=[{"description": "Coffee", "gross_price": 3.5, "vat_rate": 13.5, "category": "beverages"}])
+
+
+def unreconciled():
+    return receipt(totals={"total_gross": 9.99, "total_vat": None, "total_net": None})
+
+
+class ValidateTests(SimpleTestCase):
+    def test_valid_receipt(self):
+        self.assertEqual(cascade.validate(receipt()), [])
+
+    def test_nulls_and_empty_text_are_allowed(self):
+        self.assertEqual(cascade.validate(receipt(company_details=None, transaction_details={"date": "", "time": None})), [])
+
+    def test_reports_each_invalid_value(self):
+        problems = cascade.validate(receipt(
+            transaction_details={"date": "15/03/2024"},
+            items=[{"gross_price": "n/a", "category": "beverages"}, "coffee"],
+            is_invoice="no",
+        ))
+
+        self.assertEqual(problems, [
+            "transaction_details.date has invalid value '15/03/2024'",
+            "items[0].gross_price has invalid value 'n/a'",
+            "items[0].category has invalid value 'beverages'",
+            "items[1] is not an object",
+            "is_invoice has invalid value 'no'",
+        ])
+
+    def test_rejects_non_objects(self):
+        self.assertEqual(cascade.validate([]), ["Expected a JSON object, got list"])
+        self.assertEqual(cascade.validate(receipt(totals=3.5, items={})), ["totals is not an object", "items is not a list"])
+
+
+class JudgeTests(SimpleTestCase):
+    def test_accepts_a_reconciled_receipt(self):
+        result, reason, problems = cascade.judge(json.dumps(receipt()))
+        self.assertEqual((result, reason, problems), (receipt(), None, []))
+
+    def test_strips_code_fences(self):
+        self.assertIsNone(cascade.judge(f"```json\n{json.dumps(receipt())}\n```")[1])
+
+    def test_reasons(self):
+        cases = [
+            ("", cascade.NO_RESPONSE),
+            (None, cascade.NO_RESPONSE),
+            ("The total is 3.50", cascade.INVALID_JSON),
+            (json.dumps(invalid_category()), cascade.INVALID_SCHEMA),
+            (json.dumps(receipt(items=[], totals=None)), cascade.EMPTY),
+            (json.dumps(unreconciled()), cascade.UNRECONCILED),
+        ]
+        for raw_completion, reason in cases:
+            self.assertEqual(cascade.judge(raw_completion)[1], reason, raw_completion)
+
+
+class RepairTests(SimpleTestCase):
+    def test_defaults_unknown_categories_and_drops_invalid_values(self):
+        repaired = cascade.repair(receipt(
+            transaction_details={"date": "15/03/2024", "time": "12:30"},
+            items=[{"description": "Coffee", "gross_price": "n/a", "category": "beverages"}, "tea"],
+            totals="3.50",
+        ))
+
+        self.assertEqual(repaired["transaction_details"], {"date": None, "time": "12:30"})
+        self.assertEqual(repaired["items"], [{"description": "Coffee", "gross_price": None, "category": "general"}])
+        self.assertIsNone(repaired["totals"])
+        self.assertEqual(cascade.validate(repaired), [])
+
+    def test_non_objects_repair_to_an_empty_result(self):
+        self.assertEqual(cascade.repair(["Coffee"]), {})
+
+
+@override_settings(COMPLETION_FAST_MODEL="fast", COMPLETION_MODEL="strong", COMPLETION_JSON_MODE_MODELS=["fast"])
+@mock.patch("src.cascade.metrics.incr")
+class CascadeTests(SimpleTestCase):
+    def run_cascade(self, *answers):
+        """Run the cascade with each tier answering the next of ``answers``, encoded as JSON unless a string or None."""
+        answers = [answer if answer is None or isinstance(answer, str) else json.dumps(answer) for answer in answers]
+        request_completion = mock.Mock(side_effect=answers)
+        extraction = cascade.complete("TESCO\nCOFFEE 3.50", request_completion)
+        return extraction, [call.kwargs["model"] for call in request_completion.call_args_list]
+
+    def test_fast_answer_is_accepted(self, incr):
+        extraction, calls = self.run_cascade(receipt())
+
+        self.assertEqual(calls, ["fast"])
+        self.assertEqual((extraction.result, extraction.model, extraction.escalations), (receipt(), "fast", []))
+        self.assertFalse(extraction.needs_review)
+        self.assertEqual(incr.call_args.args[1]["fast|accepted"], 1)
+
+    def test_json_mode_is_requested_per_model(self, incr):
+        request_completion = mock.Mock(side_effect=["", json.dumps(receipt())])
+        cascade.complete("TESCO", request_completion)
+        self.assertEqual([call.kwargs["json_mode"] for call in request_completion.call_args_list], [True, False])
+
+    def test_escalates_invalid_and_unreconciled_answers(self, incr):
+        for fast_answer, reason in ((invalid_category(), cascade.INVALID_SCHEMA), (unreconciled(), cascade.UNRECONCILED), ("{", cascade.INVALID_JSON)):
+            extraction, calls = self.run_cascade(fast_answer, receipt())
+
+            self.assertEqual(calls, ["fast", "strong"])
+            self.assertEqual((extraction.result, extraction.model, extraction.escalations), (receipt(), "strong", [reason]))
+            self.assertFalse(extraction.needs_review)
+
+    def test_unreconciled_strong_answer_is_kept(self, incr):
+        extraction, _ = self.run_cascade(unreconciled(), unreconciled())
+
+        self.assertEqual((extraction.result, extraction.model), (unreconciled(), "strong"))
+        self.assertEqual(extraction.reason, cascade.UNRECONCILED)
+        self.assertFalse(extraction.needs_review)
+
+    def test_fast_answer_is_kept_when_strong_tier_fails(self, incr):
+        extraction, _ = self.run_cascade(unreconciled(), None)
+
+        self.assertEqual((extraction.result, extraction.model, extraction.reason), (unreconciled(), "fast", cascade.NO_RESPONSE))
+        self.assertFalse(extraction.needs_review)
+
+    def test_strongest_invalid_answer_is_repaired_for_review(self, incr):
+        strong_answer = receipt(items=[{"description": "Latte", "gross_price": 3.5, "vat_rate": 13.5, "category": "coffee"}])
+        extraction, _ = self.run_cascade(invalid_category(), strong_answer)
+
+        self.assertEqual(extraction.model, "strong")
+        self.assertEqual(extraction.result["items"][0]["description"], "Latte")
+        self.assertEqual(extraction.result["items"][0]["category"], cascade.DEFAULT_CATEGORY)
+        self.assertTrue(extraction.needs_review)
+        self.assertEqual(incr.call_args.args[1]["strong|failed"], 1)
+
+    def test_schema_valid_fast_answer_beats_a_repaired_one(self, incr):
+        extraction, _ = self.run_cascade(unreconciled(), invalid_category())
+
+        self.assertEqual((extraction.result, extraction.model), (unreconciled(), "fast"))
+        self.assertFalse(extraction.needs_review)
+
+    def test_invalid_answer_without_fallback_is_repaired(self, incr):
+        extraction, _ = self.run_cascade(None, invalid_category())
+
+        self.assertEqual(extraction.model, "strong")
+        self.assertEqual(extraction.result["items"][0]["category"], cascade.DEFAULT_CATEGORY)
+        self.assertTrue(extraction.needs_review)
+
+    def test_no_result_without_a_parseable_answer(self, incr):
+        extraction, _ = self.run_cascade("I cannot read this receipt", None)
+
+        self.assertIsNone(extraction.result)
+        self.assertEqual(extraction.reason, cascade.NO_RESPONSE)
+        self.assertEqual(extraction.escalations, [cascade.INVALID_JSON])
+
+
+class CheckpointTests(SimpleTestCase):
+    def test_missing_answer_is_transient(self):
+        extraction = cascade.Extraction(reason=cascade.NO_RESPONSE, problems=["No completion returned"])
+        with self.assertRaises(pipeline.TransientError):
+            pipeline.checkpoint_extraction(1, extraction)
+
+    def test_unparseable_answer_is_not_retried(self):
+        extraction = cascade.Extraction(reason=cascade.INVALID_JSON, problems=["Not valid JSON"])
+        with self.assertRaises(pipeline.UnusableCompletion) as raised:
+            pipeline.checkpoint_extraction(1, extraction)
+        self.assertNotIsInstance(raised.exception, pipeline.TransientError)
+
+    def test_repaired_result_is_flagged_for_review(self):
+        extraction = cascade.Extraction(result=receipt(), model="strong", reason=cascade.INVALID_SCHEMA, needs_review=True)
+
+        result, raw_completion = pipeline.checkpoint_extraction(1, extraction)
+
+        self.assertTrue(result["needs_review"])
+        self.assertEqual(json.loads(raw_completion), result)
+        self.assertTrue(pipeline.processed_fields(result)["needs_review"])
+
+    def test_reconciled_result_is_not_flagged(self):
+        result, _ = pipeline.checkpoint_extraction(1, cascade.Extraction(result=receipt(), model="fast"))
+
+        self.assertNotIn("needs_review", result)
+        self.assertFalse(pipeline.processed_fields(result)["needs_review"])
@@ -0,0 +1,105 @@
+from .. import dedup, pipeline
+from ..models import ImageFingerprint, Images, ProcessedImage, ProcessingState
+from .utils import StorageTestCase, receipt_png, upload
+
+
+HEADER = ["CORNER CAFE", "12 High Street", "VAT GB123456789", ""]
+MORNING = "\n".join(HEADER + ["14/03/2024 08:12", "Flat white 3.20", "Croissant 2.50", "TOTAL 5.70"])
+AFTERNOON = "\n".join(HEADER + ["15/03/2024 16:40", "Flat white 3.20", "Muffin 2.80", "TOTAL 6.00"])
+
+
+class SameReceiptTests(StorageTestCase):
+    def test_identical_text(self):
+        self.assertTrue(dedup.same_receipt(MORNING, MORNING))
+
+    def test_whitespace_and_case_do_not_matter(self):
+        self.assertTrue(dedup.same_receipt(MORNING.upper(), "  " + MORNING.replace("\n", "  \n")))
+
+    def test_different_figures(self):
+        self.assertFalse(dedup.same_receipt(MORNING, AFTERNOON))
+        self.assertFalse(dedup.same_receipt(MORNING, MORNING.replace("5.70", "5.79")))
+
+    def test_same_figures_different_wording(self):
+        other = "\n".join(["PETROL STATION", "Unleaded", "14/03/2024 08:12", "3.20 2.50 5.70"])
+        self.assertFalse(dedup.same_receipt(MORNING, other))
+
+    def test_missing_text(self):
+        self.assertFalse(dedup.same_receipt(MORNING, None))
+        self.assertFalse(dedup.same_receipt("", MORNING))
+
+
+class NearDuplicateTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        dedup._indexes.clear()
+        self.addCleanup(dedup._indexes.clear)
+
+    def create_image(self, text, name):
+        image = Images.objects.create(
+            provider=self.provider,
+            client=self.user,
+            name=name,
+            image=upload(receipt_png(text.splitlines()), f"{name}.png"),
+        )
+        ProcessingState.objects.create(image=image, ocr_text=text)
+        return image
+
+    def process(self, image):
+        return ProcessedImage.objects.create(user=self.user, image=image, idempotency_key=pipeline.idempotency_key(image))
+
+    def check(self, image):
+        pipeline.check_duplicate(image, image.image.path, image.processing.ocr_text)
+
+    def test_same_layout_receipts_that_differ_are_both_processed(self):
+        morning = self.create_image(MORNING, "morning")
+        self.check(morning)
+        self.process(morning)
+
+        afternoon = self.create_image(AFTERNOON, "afternoon")
+        # Printed on the same layout, the receipts are a pHash candidate
+        # match; only the text check tells them apart.
+        match = dedup.find_near_duplicate(self.user.id, dedup.perceptual_hash(afternoon.image.path))
+        self.assertEqual(match[0], morning.id)
+
+        self.check(afternoon)
+        self.assertIsNone(ImageFingerprint.objects.get(image=afternoon).duplicate_of_id)
+
+    def test_unconfirmed_image_becomes_an_original(self):
+        morning = self.create_image(MORNING, "morning")
+        self.check(morning)
+        self.process(morning)
+        afternoon = self.create_image(AFTERNOON, "afternoon")
+        self.check(afternoon)
+        self.process(afternoon)
+
+        again = self.create_image(AFTERNOON, "again")
+        with self.assertRaises(pipeline.DuplicateImage) as raised:
+            self.check(again)
+        self.assertEqual(raised.exception.original_id, afternoon.id)
+
+    def test_same_receipt_is_a_duplicate(self):
+        original = self.create_image(MORNING, "original")
+        self.check(original)
+        processed = self.process(original)
+
+        copy = self.create_image(MORNING, "copy")
+        with self.assertRaises(pipeline.DuplicateImage) as raised:
+            self.check(copy)
+        self.assertEqual(raised.exception.original_id, original.id)
+        self.assertEqual(raised.exception.processed, processed)
+        self.assertEqual(ImageFingerprint.objects.get(image=copy).duplicate_of_id, original.id)
+
+    def test_copy_of_an_unprocessed_original_is_processed(self):
+        original = self.create_image(MORNING, "original")
+        self.check(original)
+        ProcessingState.objects.filter(image=original).update(stage=ProcessingState.FAILED)
+
+        copy = self.create_image(MORNING, "copy")
+        self.check(copy)
+        self.assertIsNone(ImageFingerprint.objects.get(image=copy).duplicate_of_id)
+
+    def test_distant_hashes_are_not_candidates(self):
+        index = dedup.HashIndex()
+        index.add(1, 1, 0)
+        self.assertEqual(index.search(0b1111, 4), (1, 4))
+        self.assertIsNone(index.search(0b11111, 4))
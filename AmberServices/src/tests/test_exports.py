@@ -0,0 +1,46 @@
+import csv
+import io
+import zipfile
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .. import exports
+from ..views import sign
+
+
+class ReceiptExportTests(TestCase):
+    def setUp(self):
+        User.objects.create_user("alice", password="secret")
+        self.params = {"username": "alice", "signature": sign("alice")}
+
+    def test_exports_csv(self):
+        response = self.client.get(reverse("receipt_export"), self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+
+    def test_rejects_malformed_date(self):
+        response = self.client.get(reverse("receipt_export"), {**self.params, "date_from": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_impossible_date(self):
+        response = self.client.get(reverse("receipt_export"), {**self.params, "date_to": "2024-02-30"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("date_to", response.json()["error"])
+
+
+class FormulaTests(SimpleTestCase):
+    row = ["=HYPERLINK(\"http://evil\",\"x\")", "+1+2", "@SUM(A1)", "-2+3", "-3.50", "Tesco", 12.5, None]
+
+    def test_csv_text_is_never_a_formula(self):
+        lines = list(csv.reader(io.StringIO("".join(exports.stream_csv([self.row])))))
+
+        self.assertEqual(lines[1], ["'=HYPERLINK(\"http://evil\",\"x\")", "'+1+2", "'@SUM(A1)", "'-2+3", "-3.50", "Tesco", "12.5", ""])
+
+    def test_xlsx_text_is_an_inline_string(self):
+        with zipfile.ZipFile(io.BytesIO(b"".join(exports.stream_xlsx([self.row])))) as archive:
+            sheet = archive.read("xl/worksheets/sheet1.xml").decode()
+
+        self.assertIn('<c t="inlineStr"><is><t xml:space="preserve">+1+2</t></is></c>', sheet)
+        self.assertNotIn("<f>", sheet)
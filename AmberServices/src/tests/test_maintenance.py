@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+
+from .. import maintenance
+from ..models import Providers
+
+
+class MediaFilesTests(TestCase):
+    # In path order; as plain strings "bob+work/..", "bob-2/.." and
+    # "bob.smith/.." sort before "bob/..", since '+', '-' and '.' < '/'.
+    names = [
+        "images/bob/Receipts/a.jpg",
+        "images/bob/Receipts/z.jpg",
+        "images/bob/z.jpg",
+        "images/bob+work/Receipts/c.jpg",
+        "images/bob-2/Receipts/a.jpg",
+        "images/bob.smith/Receipts/b.jpg",
+        "pdf/bob/Receipts/a.pdf",
+    ]
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        for name in self.names:
+            path = os.path.join(self.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+        os.makedirs(os.path.join(self.media_root, "blobs"))
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_walks_every_file_in_path_order(self):
+        self.assertEqual(list(maintenance.media_files("")), self.names)
+
+    def test_resumes_after_every_position(self):
+        for position, name in enumerate(self.names):
+            self.assertEqual(list(maintenance.media_files(name)), self.names[position + 1:], name)
+
+    def test_resumes_after_a_deleted_file(self):
+        self.assertEqual(list(maintenance.media_files("images/bob-2/Receipts/0.jpg")), self.names[4:])
+
+
+class ExpireProvidersTests(TestCase):
+    def test_deactivates_only_expired_providers(self):
+        user = User.objects.create_user("alice", password="secret")
+        expired = [Providers.objects.create(client=user, expires_at=now() - timedelta(days=1)) for _ in range(3)]
+        current = Providers.objects.create(client=user, expires_at=now() + timedelta(days=1))
+        unlimited = Providers.objects.create(client=user)
+
+        self.assertEqual(maintenance.expire_providers(), 3)
+        self.assertEqual(maintenance.expire_providers(), 0)
+        self.assertEqual(set(Providers.objects.filter(is_active=True)), {current, unlimited})
+        self.assertFalse(any(provider.is_active for provider in Providers.objects.filter(pk__in=[p.pk for p in expired])))
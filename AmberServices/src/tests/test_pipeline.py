@@ -0,0 +1,190 @@
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import override_settings
+from django.utils.timezone import now
+
+from .. import pipeline, tasks
+from ..models import Blob, Images, ProcessedImage, ProcessingState
+from .utils import StorageTestCase, png, receipt_result, upload
+
+OCR_TEXT = "TESCO\nBaggot Street\nCOFFEE 3.50\nTOTAL 3.50"
+
+
+@override_settings(
+    QUALITY_GATE_ENABLED=False,
+    VENDOR_TEMPLATES_ENABLED=False,
+    COMPLETION_FAST_MODEL=None,
+    COMPLETION_MODEL="gpt-4",
+)
+class CheckpointTests(StorageTestCase):
+    """Every paid call is checkpointed, so a retried image never pays for a stage twice."""
+
+    def setUp(self):
+        super().setUp()
+        self.image = Images.objects.create(provider=self.provider, client=self.user, name="receipt", image=upload(png()))
+        self.path = self.storage.path(self.image.image.name)
+
+        self.extract_text = self.patch("src.pipeline.resilience.extract_text", return_value=OCR_TEXT)
+        self.get_completion = self.patch("src.pipeline.GoogleVisionOCR").return_value.get_completion
+        self.get_completion.return_value = json.dumps(receipt_result())
+        self.patch("src.pipeline.dedup.register", return_value=None)
+        self.patch("src.cascade.metrics.incr")
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def state(self):
+        return ProcessingState.objects.get(image=self.image)
+
+    def test_processes_and_releases_the_lease(self):
+        processed = pipeline.process_image(self.image, self.path)
+
+        self.assertEqual(processed.company_name, "Tesco")
+        self.assertEqual(processed.idempotency_key, f"image:{self.image.id}")
+        state = self.state()
+        self.assertEqual((state.stage, state.attempts, state.lease_expires_at), (ProcessingState.COMPLETED, 1, None))
+        self.assertEqual(state.ocr_text, OCR_TEXT)
+
+    def test_failed_ocr_is_retried(self):
+        self.extract_text.return_value = None
+        with self.assertRaises(pipeline.TransientError):
+            pipeline.process_image(self.image, self.path)
+
+        state = self.state()
+        self.assertEqual(state.stage, ProcessingState.PENDING)
+        self.assertIsNone(state.lease_expires_at)
+        self.assertIn("No text extracted", state.last_error)
+        self.get_completion.assert_not_called()
+
+    def test_resumes_after_ocr_without_a_second_ocr_call(self):
+        self.get_completion.return_value = None
+        with self.assertRaises(pipeline.TransientError):
+            pipeline.process_image(self.image, self.path)
+        self.assertEqual(self.state().stage, ProcessingState.OCR_DONE)
+
+        self.get_completion.return_value = json.dumps(receipt_result())
+        pipeline.process_image(self.image, self.path)
+
+        self.assertEqual(self.extract_text.call_count, 1)
+        self.assertEqual(self.get_completion.call_count, 2)
+        self.assertEqual(self.state().attempts, 2)
+
+    def test_resumes_after_completion_without_a_second_paid_call(self):
+        with mock.patch.object(ProcessedImage.objects, "get_or_create", side_effect=DatabaseError("connection lost")):
+            with self.assertRaises(DatabaseError):
+                pipeline.process_image(self.image, self.path)
+        state = self.state()
+        self.assertEqual(state.stage, ProcessingState.COMPLETION_DONE)
+        self.assertEqual(json.loads(state.raw_completion)["completion_model"], "gpt-4")
+
+        processed = pipeline.process_image(self.image, self.path)
+
+        self.assertEqual(processed.total_gross, 3.5)
+        self.assertEqual(self.extract_text.call_count, 1)
+        self.assertEqual(self.get_completion.call_count, 1)
+
+    def test_held_lease_raises_in_progress(self):
+        pipeline.acquire(self.image)
+
+        with self.assertRaises(pipeline.ProcessingInProgress):
+            pipeline.process_image(self.image, self.path)
+        self.extract_text.assert_not_called()
+
+    def test_expired_lease_is_taken_over(self):
+        pipeline.acquire(self.image)
+        ProcessingState.objects.filter(image=self.image).update(lease_expires_at=now() - timedelta(seconds=1))
+
+        pipeline.process_image(self.image, self.path)
+
+        self.assertEqual(self.state().attempts, 2)
+
+    def test_redelivered_task_reuses_the_processed_image(self):
+        first = pipeline.process_image(self.image, self.path)
+        again = pipeline.process_image(self.image, self.path)
+
+        self.assertEqual(first.pk, again.pk)
+        self.assertEqual(ProcessedImage.objects.count(), 1)
+        self.assertEqual((self.extract_text.call_count, self.get_completion.call_count), (1, 1))
+
+    def test_concurrent_persist_creates_one_processed_image(self):
+        state = pipeline.acquire(self.image)
+        first = pipeline.persist_result(state, receipt_result())
+        second = pipeline.persist_result(state, receipt_result(fuel_type="Diesel"))
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertIsNone(ProcessedImage.objects.get().fuel_type)
+
+
+@override_settings(PROCESSING_MAX_RETRIES=2, PROCESSING_RETRY_BACKOFF=10, PROCESSING_RETRY_BACKOFF_MAX=600)
+class RetryTests(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image = Images.objects.create(provider=self.provider, client=self.user, name="receipt", image=upload(png()))
+        ProcessingState.objects.create(image=self.image, stage=ProcessingState.OCR_DONE)
+
+    def outcome(self, error, retries):
+        requeue = mock.Mock(return_value="retry-task")
+        return tasks.failure_outcome("/media/receipt.png", self.image.id, self.image, error, retries, requeue), requeue
+
+    def test_transient_errors_are_retried_with_backoff(self):
+        outcome, requeue = self.outcome(pipeline.TransientError("timeout"), 1)
+
+        self.assertEqual(outcome["status"], "retrying")
+        self.assertEqual(outcome["task_id"], "retry-task")
+        requeue.assert_called_once_with(20)
+
+    def test_gives_up_after_max_retries(self):
+        outcome, requeue = self.outcome(pipeline.TransientError("timeout"), 2)
+
+        self.assertEqual(outcome["status"], "error")
+        requeue.assert_not_called()
+        state = ProcessingState.objects.get(image=self.image)
+        self.assertEqual((state.stage, state.last_error), (ProcessingState.FAILED, "timeout"))
+
+    def test_in_progress_image_is_not_marked_failed(self):
+        outcome, _ = self.outcome(pipeline.ProcessingInProgress("leased"), 2)
+
+        self.assertEqual(outcome["status"], "error")
+        self.assertEqual(ProcessingState.objects.get(image=self.image).stage, ProcessingState.OCR_DONE)
+
+    def test_unusable_completion_fails_without_retry(self):
+        outcome, requeue = self.outcome(pipeline.UnusableCompletion("not JSON"), 0)
+
+        self.assertEqual(outcome["status"], "error")
+        requeue.assert_not_called()
+        self.assertEqual(ProcessingState.objects.get(image=self.image).stage, ProcessingState.FAILED)
+
+    def test_bulk_retry_goes_through_the_tenant_lane(self):
+        with mock.patch("src.tasks.scheduling.resubmit", return_value="retry-task") as resubmit:
+            task_id = tasks.requeue_single("/media/receipt.png", self.image.id, 1, "alice")(20)
+
+        self.assertEqual(task_id, "retry-task")
+        tenant, retry = resubmit.call_args.args
+        self.assertEqual(tenant, "alice")
+        self.assertEqual(tuple(retry.args), ("/media/receipt.png", self.image.id, "alice"))
+        self.assertEqual((retry.options["countdown"], retry.options["retries"]), (20, 2))
+
+
+@override_settings(QUALITY_GATE_ENABLED=True)
+class InteractiveRejectionTests(StorageTestCase):
+    def test_rejection_reason_survives_and_the_blob_is_released(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Images.objects.create(provider=self.provider, client=self.user, name="dark", image=upload(png((0, 0, 0), (400, 600))))
+        blob_name = image.image.name
+
+        with self.captureOnCommitCallbacks(execute=True), mock.patch("src.tasks.enqueue_interactive") as enqueue:
+            result, reason = tasks.submit_image(image)
+
+        self.assertIsNone(result)
+        self.assertTrue(reason)
+        enqueue.assert_not_called()
+        state = ProcessingState.objects.get(image_id=image.id)
+        self.assertEqual((state.stage, state.rejection_reason), (ProcessingState.REJECTED, reason))
+        self.assertIsNotNone(state.quality_metrics)
+        self.assertEqual(Images.objects.get(pk=image.pk).image.name, "")
+        self.assertEqual(Blob.objects.get(name=blob_name).ref_count, 0)
@@ -0,0 +1,99 @@
+import json
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from .. import reprocessing
+from ..models import Images, ProcessedImage, ProcessingState, Providers, ReprocessRun
+from ..tesseract import PROMPT_VERSION
+from .utils import receipt_result
+
+
+class ReprocessingTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="secret")
+        self.provider = Providers.objects.create(client=self.user, signature="alice-signature")
+
+    def result(self, completion_model, prompt_version=PROMPT_VERSION, ocr_text="TOTAL 1.00"):
+        image = Images.objects.create(provider=self.provider, client=self.user, name="receipt", image="receipt.png")
+        if ocr_text is not None:
+            ProcessingState.objects.create(image=image, ocr_text=ocr_text)
+        return ProcessedImage.objects.create(
+            user=self.user, image=image, completion_model=completion_model, prompt_version=prompt_version,
+        )
+
+
+class StaleResultsTests(ReprocessingTestCase):
+    def stale(self):
+        return set(reprocessing.stale_results(PROMPT_VERSION, settings.COMPLETION_MODEL))
+
+    def test_current_models_are_not_stale(self):
+        self.result(settings.COMPLETION_MODEL)
+        self.result(settings.COMPLETION_FAST_MODEL)
+        self.assertEqual(self.stale(), set())
+
+    def test_vendor_template_results_are_not_stale(self):
+        self.result(settings.VENDOR_TEMPLATE_MODEL)
+        self.assertEqual(self.stale(), set())
+
+    def test_other_models_and_prompts_are_stale(self):
+        old_model = self.result("gpt-3.5-turbo")
+        old_prompt = self.result(settings.VENDOR_TEMPLATE_MODEL, PROMPT_VERSION - 1)
+        self.assertEqual(self.stale(), {old_model, old_prompt})
+
+    def test_results_without_checkpointed_ocr_text_are_stale(self):
+        legacy = self.result("gpt-3.5-turbo", ocr_text=None)
+        self.assertEqual(self.stale(), {legacy})
+
+
+@override_settings(COMPLETION_FAST_MODEL=None, COMPLETION_MODEL="gpt-4")
+@mock.patch("src.cascade.metrics.incr")
+@mock.patch("src.reprocessing.schedule_batch")
+class RunTests(ReprocessingTestCase):
+    def run_all(self, run):
+        with mock.patch("src.reprocessing.request_completion", return_value=json.dumps(receipt_result())), \
+                mock.patch("src.pipeline.GoogleVisionOCR"), \
+                mock.patch("src.pipeline.resilience.extract_text", return_value="TESCO\nTOTAL 3.50") as extract_text:
+            reprocessing.run_batch(run.id, run.token)
+        run.refresh_from_db()
+        return extract_text
+
+    def test_results_processed_before_ocr_checkpoints_are_read_again(self, schedule_batch, incr):
+        checkpointed = self.result("gpt-3.5-turbo")
+        legacy = self.result("gpt-3.5-turbo", ocr_text=None)
+
+        run = reprocessing.start_run()
+        self.assertEqual((run.total, run.skipped), (2, 0))
+        extract_text = self.run_all(run)
+
+        self.assertEqual((run.status, run.done, run.failed), (ReprocessRun.COMPLETED, 2, 0))
+        extract_text.assert_called_once()
+        self.assertEqual(extract_text.call_args.args[0], legacy.image.image.path)
+        state = ProcessingState.objects.get(image=legacy.image)
+        self.assertEqual((state.ocr_text, state.stage), ("TESCO\nTOTAL 3.50", ProcessingState.COMPLETED))
+        self.assertEqual(ProcessingState.objects.get(image=checkpointed.image).ocr_text, "TOTAL 1.00")
+        for processed in (checkpointed, legacy):
+            processed.refresh_from_db()
+            self.assertEqual((processed.completion_model, processed.company_name), ("gpt-4", "Tesco"))
+
+    def test_results_without_a_stored_image_are_counted_as_skipped(self, schedule_batch, incr):
+        kept = self.result("gpt-3.5-turbo")
+        discarded = self.result("gpt-3.5-turbo", ocr_text=None)
+        Images.objects.filter(pk=discarded.image_id).update(image="")
+        ProcessedImage.objects.create(user=self.user, completion_model="gpt-3.5-turbo", prompt_version=PROMPT_VERSION)
+
+        run = reprocessing.start_run()
+        self.assertEqual((run.total, run.skipped), (1, 2))
+        self.run_all(run)
+
+        self.assertEqual((run.status, run.done, run.failed, run.cursor), (ReprocessRun.COMPLETED, 1, 0, kept.id))
+
+    def test_nothing_to_read_completes_the_run_at_once(self, schedule_batch, incr):
+        ProcessedImage.objects.create(user=self.user, completion_model="gpt-3.5-turbo", prompt_version=PROMPT_VERSION)
+
+        run = reprocessing.start_run()
+
+        self.assertEqual((run.status, run.total, run.skipped), (ReprocessRun.COMPLETED, 0, 1))
+        schedule_batch.assert_not_called()
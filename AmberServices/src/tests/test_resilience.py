@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import resilience
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@mock.patch("src.resilience.time.monotonic", new_callable=Clock)
+class CircuitBreakerTests(SimpleTestCase):
+    def breaker(self):
+        return resilience.CircuitBreaker(
+            resilience.LatencyTracker(10), min_calls=4, error_rate=0.5, slow_rate=0.5, slow_after=5, reset_after=60,
+        )
+
+    def open_breaker(self):
+        breaker = self.breaker()
+        for ok in (True, True, False, False):
+            breaker.record(1, ok)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        return breaker
+
+    def test_stays_closed_until_enough_calls(self, clock):
+        breaker = self.breaker()
+        for _ in range(3):
+            breaker.record(1, False)
+
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_opens_on_errors_or_slow_calls(self, clock):
+        self.open_breaker()
+
+        breaker = self.breaker()
+        for duration in (1, 1, 5, 9):
+            breaker.record(duration, True)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_half_open_lets_one_probe_through(self, clock):
+        breaker = self.open_breaker()
+        clock.now += 59
+        self.assertFalse(breaker.allow())
+
+        clock.now += 1
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_successful_probe_closes(self, clock):
+        breaker = self.open_breaker()
+        clock.now += 60
+        breaker.allow()
+
+        breaker.record(1, True)
+
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.tracker.snapshot(), [])
+        self.assertTrue(breaker.allow())
+
+    def test_failed_or_slow_probe_trips_again(self, clock):
+        for duration, ok in ((1, False), (5, True)):
+            breaker = self.open_breaker()
+            clock.now += 60
+            breaker.allow()
+
+            breaker.record(duration, ok)
+
+            self.assertEqual((breaker.state, breaker.opened_at), (breaker.OPEN, clock.now))
+            self.assertFalse(breaker.allow())
+
+    def test_released_probe_lets_the_next_call_probe(self, clock):
+        breaker = self.open_breaker()
+        clock.now += 60
+        breaker.allow()
+
+        breaker.release_probe()
+
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+
+
+@override_settings(
+    OCR_HEDGE_ENABLED=True,
+    OCR_HEDGE_MIN_DELAY=0.05,
+    OCR_HEDGE_MAX_DELAY=0.05,
+    OCR_DEADLINE_SECONDS=1,
+    OCR_BREAKER_MIN_CALLS=2,
+    OCR_BREAKER_ERROR_RATE=0.5,
+    OCR_SLOW_CALL_SECONDS=10,
+    OCR_BREAKER_RESET_SECONDS=60,
+)
+class ExtractTextTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(resilience, "_breaker", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.local_text = mock.Mock(return_value="local text")
+        patcher = mock.patch("src.resilience.local_text", self.local_text)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def eventually(self, condition):
+        """Wait for a Vision call's done callback, which may run on its worker thread after the answer is used."""
+        deadline = time.monotonic() + 1
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def recorded(self, count=1):
+        tracker = resilience.get_breaker().tracker
+        self.eventually(lambda: len(tracker.snapshot()) >= count)
+        return [ok for _, ok in tracker.snapshot()]
+
+    def probing(self):
+        """A breaker open long enough for the next call to be its half-open probe."""
+        breaker = resilience.get_breaker()
+        breaker.trip()
+        breaker.opened_at -= 60
+        return breaker
+
+
+class ExtractTextTests(ExtractTextTestCase):
+    def slow_vision(self):
+        answered = threading.Event()
+        self.addCleanup(answered.set)
+        return lambda: answered.wait(5) and "vision text"
+
+    def test_vision_answer_is_used(self):
+        self.assertEqual(resilience.extract_text("receipt.png", lambda: "vision text"), "vision text")
+
+        self.local_text.assert_not_called()
+        self.assertEqual(self.recorded(), [True])
+
+    def test_hedges_after_the_hedge_delay(self):
+        started = time.monotonic()
+
+        self.assertEqual(resilience.extract_text("receipt.png", self.slow_vision()), "local text")
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.local_text.assert_called_once_with("receipt.png")
+
+    def test_failed_vision_call_is_hedged_and_recorded(self):
+        def vision():
+            raise ConnectionError("Vision unavailable")
+
+        self.assertEqual(resilience.extract_text("receipt.png", vision), "local text")
+        self.assertEqual(self.recorded(), [False])
+
+    @override_settings(OCR_HEDGE_ENABLED=False, OCR_DEADLINE_SECONDS=0.1)
+    def test_nothing_within_the_deadline(self):
+        started = time.monotonic()
+
+        self.assertIsNone(resilience.extract_text("receipt.png", self.slow_vision()))
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.local_text.assert_not_called()
+
+    def test_open_circuit_goes_straight_to_local_ocr(self):
+        resilience.get_breaker().trip()
+        vision = mock.Mock()
+
+        self.assertEqual(resilience.extract_text("receipt.png", vision), "local text")
+        vision.assert_not_called()
+
+    def test_failures_open_the_circuit(self):
+        for _ in range(2):
+            resilience.extract_text("receipt.png", lambda: None)
+        self.assertEqual(self.recorded(2), [False, False])
+
+        vision = mock.Mock()
+        self.assertEqual(resilience.extract_text("receipt.png", vision), "local text")
+        vision.assert_not_called()
+
+    def test_half_open_probe_closes_the_circuit(self):
+        breaker = self.probing()
+
+        self.assertEqual(resilience.extract_text("receipt.png", lambda: "vision text"), "vision text")
+        self.eventually(lambda: breaker.state == breaker.CLOSED)
+
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+
+class ExtractTextAsyncTests(ExtractTextTestCase):
+    async def slow_vision(self):
+        await asyncio.sleep(5)
+        return "vision text"
+
+    def extract(self, vision):
+        return asyncio.run(resilience.extract_text_async("receipt.png", vision))
+
+    def test_vision_answer_is_used(self):
+        async def vision():
+            return "vision text"
+
+        self.assertEqual(self.extract(vision), "vision text")
+        self.local_text.assert_not_called()
+        self.assertEqual(self.recorded(), [True])
+
+    def test_hedge_answers_and_the_cancelled_vision_call_is_not_recorded(self):
+        started = time.monotonic()
+
+        self.assertEqual(self.extract(self.slow_vision), "local text")
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertLess(time.monotonic() - started, 1)
+        self.local_text.assert_called_once_with("receipt.png")
+        self.assertEqual(resilience.get_breaker().tracker.snapshot(), [])
+
+    def test_cancelled_probe_leaves_the_circuit_probing(self):
+        breaker = self.probing()
+
+        self.assertEqual(self.extract(self.slow_vision), "local text")
+
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_vision_call_is_recorded(self):
+        async def vision():
+            raise ConnectionError("Vision unavailable")
+
+        self.assertEqual(self.extract(vision), "local text")
+        self.assertEqual(self.recorded(), [False])
+
+    @override_settings(OCR_HEDGE_ENABLED=False, OCR_DEADLINE_SECONDS=0.1)
+    def test_nothing_within_the_deadline(self):
+        self.assertIsNone(self.extract(self.slow_vision))
+        self.local_text.assert_not_called()
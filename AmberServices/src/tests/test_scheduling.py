@@ -0,0 +1,148 @@
+import time
+from collections import Counter
+from unittest import mock
+
+import fakeredis
+from celery import signature
+from celery.canvas import Signature
+from django.test import SimpleTestCase, override_settings
+
+from .. import scheduling
+
+
+def task(tenant, number):
+    task_signature = signature("src.tasks.process_image_task", args=(f"/media/{tenant}/{number}.png", number, tenant))
+    task_signature.freeze()
+    return task_signature
+
+
+@override_settings(
+    SCHEDULER_BULK_MAX_IN_FLIGHT=50,
+    SCHEDULER_TENANT_MAX_IN_FLIGHT=50,
+    SCHEDULER_TENANT_LIMITS={},
+    SCHEDULER_TENANT_WEIGHTS={},
+    SCHEDULER_SLOT_TIMEOUT=900,
+)
+class FairSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.sent = []
+        for patcher in (
+            mock.patch("src.scheduling.get_redis", return_value=self.redis),
+            # Record what would be sent to the bulk queue instead of sending it.
+            mock.patch.object(Signature, "apply_async", autospec=True, side_effect=lambda task_signature, **options: self.sent.append(task_signature)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def park(self, tenant, count):
+        tasks = [task(tenant, number) for number in range(count)]
+        scheduling.park(self.redis, tenant, tasks)
+        return tasks
+
+    def sent_tenants(self):
+        return Counter(task_signature.args[2] for task_signature in self.sent)
+
+    def test_tenants_share_the_bulk_lane(self):
+        self.park("acme", 20)
+        self.park("bob", 3)
+
+        with self.settings(SCHEDULER_BULK_MAX_IN_FLIGHT=4):
+            self.assertEqual(scheduling.dispatch(), 4)
+
+        self.assertEqual(self.sent_tenants(), {"acme": 2, "bob": 2})
+
+    def test_weights_set_each_tenants_share(self):
+        self.park("acme", 20)
+        self.park("bob", 20)
+
+        with self.settings(SCHEDULER_BULK_MAX_IN_FLIGHT=6, SCHEDULER_TENANT_WEIGHTS={"acme": 2}):
+            scheduling.dispatch()
+
+        self.assertEqual(self.sent_tenants(), {"acme": 4, "bob": 2})
+
+    def test_tenant_in_flight_limit(self):
+        self.park("acme", 5)
+        self.park("bob", 1)
+
+        with self.settings(SCHEDULER_TENANT_MAX_IN_FLIGHT=2):
+            self.assertEqual(scheduling.dispatch(), 3)
+            self.assertEqual(self.sent_tenants(), {"acme": 2, "bob": 1})
+            self.assertEqual(scheduling.dispatch(), 0)
+
+            # The release callback frees the slot for the next task.
+            acme_task = next(task_signature for task_signature in self.sent if task_signature.args[2] == "acme")
+            scheduling.release("acme", acme_task.id)
+            self.assertEqual(scheduling.dispatch(), 1)
+        self.assertEqual(self.sent_tenants(), {"acme": 3, "bob": 1})
+
+    def test_drained_tenants_leave_the_ring(self):
+        self.park("acme", 1)
+        scheduling.dispatch()
+
+        self.assertEqual(self.redis.lrange(scheduling.RING_KEY, 0, -1), [])
+        self.assertFalse(self.redis.sismember(scheduling.ACTIVE_KEY, "acme"))
+
+        self.park("acme", 1)
+        self.assertEqual(self.redis.lrange(scheduling.RING_KEY, 0, -1), [b"acme"])
+
+    def test_expired_slots_are_reclaimed(self):
+        self.park("acme", 2)
+        with self.settings(SCHEDULER_TENANT_MAX_IN_FLIGHT=1):
+            scheduling.dispatch()
+            lost = self.sent[0].id
+            # The worker died: its release callback never comes, and the slot's deadline passes.
+            for key in (scheduling.INFLIGHT_KEY, scheduling.inflight_key("acme")):
+                self.redis.zadd(key, {lost: time.time() - 1})
+
+            self.assertEqual(scheduling.dispatch(), 1)
+
+        self.assertIsNone(self.redis.zscore(scheduling.inflight_key("acme"), lost))
+        self.assertEqual(len(self.sent), 2)
+
+    def test_held_lock_leaves_the_work_pending(self):
+        self.park("acme", 1)
+        self.redis.set(scheduling.LOCK_KEY, "other-dispatcher", ex=scheduling.LOCK_TIMEOUT)
+
+        self.assertEqual(scheduling.dispatch(), 0)
+        self.assertTrue(self.redis.exists(scheduling.PENDING_KEY))
+        self.assertEqual(self.sent, [])
+
+    def test_lock_holder_reruns_for_pending_dispatches(self):
+        self.park("acme", 1)
+        dispatch_round = scheduling.dispatch_round
+
+        def round_with_concurrent_dispatch(redis, deactivate):
+            dispatched = dispatch_round(redis, deactivate)
+            if len(self.sent) == 1:
+                # Work parked while this round runs; its dispatch finds the lock taken.
+                self.park("bob", 1)
+                self.assertEqual(scheduling.dispatch(), 0)
+            return dispatched
+
+        with mock.patch("src.scheduling.dispatch_round", side_effect=round_with_concurrent_dispatch):
+            self.assertEqual(scheduling.dispatch(), 2)
+        self.assertEqual(self.sent_tenants(), {"acme": 1, "bob": 1})
+        self.assertFalse(self.redis.exists(scheduling.LOCK_KEY))
+
+    def test_expired_lock_is_taken_over(self):
+        self.park("acme", 1)
+        self.redis.set(scheduling.LOCK_KEY, "stalled-dispatcher", px=50)
+        self.assertEqual(scheduling.dispatch(), 0)
+
+        time.sleep(0.1)
+        self.assertEqual(scheduling.dispatch(), 1)
+
+    def test_lock_is_only_released_by_its_holder(self):
+        self.redis.set(scheduling.LOCK_KEY, "new-holder")
+        release_lock = self.redis.register_script(scheduling.RELEASE_LOCK_SCRIPT)
+
+        self.assertEqual(release_lock(keys=[scheduling.LOCK_KEY], args=["stalled-dispatcher"]), 0)
+        self.assertEqual(self.redis.get(scheduling.LOCK_KEY), b"new-holder")
+        self.assertEqual(release_lock(keys=[scheduling.LOCK_KEY], args=["new-holder"]), 1)
+
+    def test_resubmitted_retry_is_dispatched_in_the_tenants_lane(self):
+        task_id = scheduling.resubmit("acme", task("acme", 1))
+
+        self.assertEqual([task_signature.id for task_signature in self.sent], [task_id])
+        self.assertIsNotNone(self.redis.zscore(scheduling.inflight_key("acme"), task_id))
@@ -0,0 +1,155 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from .. import search
+from ..models import Images, ProcessedImage, ProcessingState, Providers
+from ..views import sign
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="secret")
+        self.bob = User.objects.create_user("bob", password="secret")
+
+    def receipt(self, user, company_name, ocr_text=None, **fields):
+        image = None
+        if ocr_text is not None:
+            provider, _ = Providers.objects.get_or_create(client=user, defaults={"signature": f"{user.username}-signature"})
+            image = Images.objects.create(provider=provider, client=user, name="receipt", image="receipt.png")
+            ProcessingState.objects.create(image=image, ocr_text=ocr_text)
+        processed = ProcessedImage.objects.create(user=user, image=image, company_name=company_name, **fields)
+        search.index_receipts([processed.id])
+        return processed
+
+    def search(self, user, query, limit=20):
+        return [processed_id for processed_id, _ in search.search(user.id, query, limit)]
+
+
+class IndexTests(SearchTestCase):
+    def indexed(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid, user_id, vendor, items, dates, ocr_text FROM {search.TABLE} ORDER BY rowid")
+            return cursor.fetchall()
+
+    def test_indexes_receipt_fields_and_ocr_text(self):
+        processed = self.receipt(
+            self.alice, "Tesco", ocr_text="TESCO EXPRESS\nTOTAL 3.50",
+            items=[{"description": "Coffee", "gross_price": 3.5, "category": "restaurant"}],
+            transaction_date=date(2024, 3, 15),
+        )
+
+        [(rowid, owner, vendor, items, dates, ocr_text)] = self.indexed()
+        self.assertEqual((rowid, owner, vendor), (processed.id, f"u{self.alice.id}", "Tesco"))
+        self.assertEqual(items, "Coffee restaurant")
+        self.assertIn("March", dates)
+        self.assertIn("15/03/2024", dates)
+        self.assertEqual(ocr_text, "TESCO EXPRESS\nTOTAL 3.50")
+
+    def test_reindexing_replaces_the_row(self):
+        processed = self.receipt(self.alice, "Tesco")
+        ProcessedImage.objects.filter(pk=processed.pk).update(company_name="Lidl")
+
+        self.assertEqual(search.index_receipts([processed.id]), 1)
+
+        self.assertEqual([row[2] for row in self.indexed()], ["Lidl"])
+        self.assertEqual(self.search(self.alice, "tesco"), [])
+        self.assertEqual(self.search(self.alice, "lidl"), [processed.id])
+
+    def test_removed_and_pruned_receipts_are_dropped(self):
+        removed = self.receipt(self.alice, "Tesco")
+        orphaned = self.receipt(self.alice, "Lidl")
+        search.remove_receipts([removed.id])
+        ProcessedImage.objects.filter(pk=orphaned.pk).delete()
+        search.index_receipts([orphaned.id])
+        search.prune()
+
+        self.assertEqual(self.indexed(), [])
+
+
+class SearchTests(SearchTestCase):
+    def test_only_the_owners_receipts_match(self):
+        mine = self.receipt(self.alice, "Tesco")
+        self.receipt(self.bob, "Tesco")
+
+        self.assertEqual(self.search(self.alice, "tesco"), [mine.id])
+        self.assertEqual(self.search(self.bob, f"u{self.alice.id}"), [])
+
+    def test_terms_match_as_prefixes(self):
+        tesco = self.receipt(self.alice, "Tesco Express", transaction_date=date(2024, 3, 15))
+        self.receipt(self.alice, "Lidl", transaction_date=date(2024, 4, 2))
+
+        self.assertEqual(self.search(self.alice, "tes"), [tesco.id])
+        self.assertEqual(self.search(self.alice, "mar 2024"), [tesco.id])
+        self.assertEqual(self.search(self.alice, "Tesco!"), [tesco.id])
+
+    def test_every_term_must_match(self):
+        self.receipt(self.alice, "Tesco", items=[{"description": "Coffee"}])
+
+        self.assertEqual(self.search(self.alice, "tesco tea"), [])
+
+    def test_vendor_matches_rank_above_ocr_text(self):
+        in_text = self.receipt(self.alice, "Corner Shop", ocr_text="Tesco voucher accepted")
+        vendor = self.receipt(self.alice, "Tesco")
+
+        self.assertEqual(self.search(self.alice, "tesco"), [vendor.id, in_text.id])
+
+    def test_limit(self):
+        receipts = [self.receipt(self.alice, "Tesco") for _ in range(3)]
+
+        self.assertEqual(len(self.search(self.alice, "tesco", limit=2)), 2)
+        self.assertEqual(set(self.search(self.alice, "tesco")), {receipt.id for receipt in receipts})
+
+    def test_queries_without_words_match_nothing(self):
+        self.receipt(self.alice, "Tesco")
+
+        self.assertEqual(self.search(self.alice, "*:& |!"), [])
+
+
+class QueryTests(SimpleTestCase):
+    def test_terms_are_lowercased_words(self):
+        self.assertEqual(search.query_terms("Tesco's MILK | bread:* & !"), ["tesco", "s", "milk", "bread"])
+        self.assertEqual(len(search.query_terms("a " * 20)), search.MAX_TERMS)
+
+    def test_postgres_query_prefix_matches_every_term(self):
+        self.assertEqual(search.postgres_query(["tesco", "mar"]), "tesco:* & mar:*")
+        self.assertEqual(search.postgres_query(search.query_terms("Café & !bread")), "café:* & bread:*")
+
+    def test_sqlite_query_is_scoped_to_the_owner(self):
+        self.assertEqual(
+            search.sqlite_query(7, ["tesco", "mar"]),
+            'user_id : "u7" AND {vendor address items dates ocr_text} : ("tesco"* "mar"*)',
+        )
+
+
+class ReceiptSearchViewTests(SearchTestCase):
+    def get(self, **params):
+        return self.client.get(reverse("receipt_search"), {"username": "alice", "signature": sign("alice"), **params})
+
+    def test_returns_the_users_matches_with_rank(self):
+        mine = self.receipt(self.alice, "Tesco", total_gross="3.50")
+        self.receipt(self.bob, "Tesco")
+
+        response = self.get(q="tesco")
+
+        self.assertEqual(response.status_code, 200)
+        [result] = response.json()["results"]
+        self.assertEqual((result["id"], result["company_name"], result["total_gross"]), (mine.id, "Tesco", 3.5))
+        self.assertGreater(result["rank"], 0)
+
+    def test_limit_is_capped(self):
+        for _ in range(3):
+            self.receipt(self.alice, "Tesco")
+
+        with self.settings(SEARCH_MAX_RESULTS=2):
+            self.assertEqual(len(self.get(q="tesco", limit=50).json()["results"]), 2)
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self.get(q="").status_code, 400)
+        self.assertEqual(self.get(q="tesco", limit="ten").status_code, 400)
+        self.assertEqual(self.get(q="tesco", limit=0).status_code, 400)
+        self.assertEqual(self.get(q="tesco", signature="forged").status_code, 401)
+        self.assertEqual(self.client.get(reverse("receipt_search"), {"q": "tesco"}).status_code, 400)
@@ -0,0 +1,172 @@
+import os
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.db import transaction
+from django.test import override_settings
+from django.utils.timezone import now
+
+from .. import maintenance
+from ..models import Blob, Images
+from .utils import StorageTestCase, png, upload
+
+
+class ContentAddressedStorageTests(StorageTestCase):
+    def create_image(self, content, name="receipt.png"):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Images.objects.create(provider=self.provider, client=self.user, name=name, image=upload(content, name))
+
+    def delete(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+
+    def backdate_releases(self):
+        Blob.objects.filter(released_at__isnull=False).update(released_at=now() - timedelta(days=1))
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.create_image(png(), "first.png")
+        second = self.create_image(png(), "second.png")
+
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(first.image.name.startswith("blobs/"))
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(self.storage.exists(blob.name))
+
+    def test_different_uploads_get_their_own_blobs(self):
+        self.create_image(png((255, 255, 255)))
+        self.create_image(png((0, 0, 0)))
+
+        self.assertEqual(Blob.objects.count(), 2)
+        self.assertEqual(set(Blob.objects.values_list("ref_count", flat=True)), {1})
+
+    def test_delete_releases_reference_but_keeps_file(self):
+        first = self.create_image(png())
+        self.create_image(png())
+
+        self.delete(first)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 1)
+
+        self.delete(Images.objects.get())
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertIsNotNone(blob.released_at)
+        self.assertTrue(self.storage.exists(blob.name))
+
+    def test_release_never_goes_below_zero(self):
+        image = self.create_image(png())
+        name = image.image.name
+
+        self.delete(image)
+        self.storage.delete(name)
+        self.assertEqual(Blob.objects.get().ref_count, 0)
+
+    def test_replacing_the_file_releases_the_previous_blob(self):
+        image = self.create_image(png((255, 255, 255)))
+        previous = image.image.name
+
+        image.image = upload(png((0, 0, 0)), "replacement.png")
+        with self.captureOnCommitCallbacks(execute=True):
+            image.save()
+
+        self.assertNotEqual(image.image.name, previous)
+        self.assertEqual(Blob.objects.get(name=previous).ref_count, 0)
+        self.assertEqual(Blob.objects.get(name=image.image.name).ref_count, 1)
+
+    def test_saving_without_a_new_file_keeps_the_reference(self):
+        image = self.create_image(png())
+        image.name = "renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            image.save()
+
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+    def test_garbage_collection_skips_referenced_blobs(self):
+        kept = self.create_image(png((255, 255, 255)))
+        dropped = self.create_image(png((0, 0, 0)))
+        dropped_name = dropped.image.name
+        self.delete(dropped)
+        self.backdate_releases()
+
+        self.assertEqual(self.storage.collect_garbage(grace=timedelta(0)), 1)
+        self.assertEqual(list(Blob.objects.values_list("name", flat=True)), [kept.image.name])
+        self.assertTrue(self.storage.exists(kept.image.name))
+        self.assertFalse(self.storage.exists(dropped_name))
+
+    def test_garbage_collection_waits_for_the_grace_period(self):
+        image = self.create_image(png())
+        name = image.image.name
+        self.delete(image)
+
+        self.assertEqual(self.storage.collect_garbage(grace=timedelta(hours=1)), 0)
+        self.assertTrue(self.storage.exists(name))
+
+    def test_reupload_revives_a_released_blob(self):
+        image = self.create_image(png())
+        self.delete(image)
+        self.backdate_releases()
+
+        again = self.create_image(png())
+        self.assertEqual(self.storage.collect_garbage(grace=timedelta(0)), 0)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertIsNone(blob.released_at)
+        self.assertTrue(self.storage.exists(again.image.name))
+
+    def test_adopt_moves_a_file_into_the_store(self):
+        path = os.path.join(self.media_root, "staged.part")
+        with open(path, "wb") as staged:
+            staged.write(png())
+
+        name = self.storage.adopt(path, "staged.png")
+
+        self.assertTrue(name.startswith("blobs/"))
+        self.assertTrue(self.storage.exists(name))
+        self.assertFalse(os.path.exists(path))
+        # The row created for it takes the reference.
+        self.assertEqual(Blob.objects.get(name=name).ref_count, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            Images.objects.create(provider=self.provider, client=self.user, name="staged", image=name)
+        self.assertEqual(Blob.objects.get(name=name).ref_count, 1)
+
+    def test_reference_is_only_taken_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            image = Images.objects.create(provider=self.provider, client=self.user, name="receipt", image=upload(png(), "receipt.png"))
+        blob = Blob.objects.get(name=image.image.name)
+        self.assertEqual(blob.ref_count, 0)
+        self.assertIsNotNone(blob.released_at)
+
+        for callback in callbacks:
+            callback()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertIsNone(blob.released_at)
+
+    def test_rolled_back_row_takes_no_reference(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Images.objects.create(provider=self.provider, client=self.user, name="receipt", image=upload(png(), "receipt.png"))
+                raise RuntimeError("row save failed")
+
+        self.assertFalse(Blob.objects.exists())
+
+    def test_blob_files_without_a_row_are_collected(self):
+        kept = self.create_image(png((255, 255, 255)))
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            stray = Images.objects.create(provider=self.provider, client=self.user, name="receipt", image=upload(png((0, 0, 0)), "receipt.png"))
+            raise RuntimeError("row save failed")
+        kept_path, stray_path = self.storage.path(kept.image.name), self.storage.path(stray.image.name)
+        self.assertTrue(os.path.exists(stray_path))
+        old = time.time() - 7200
+        for path in (kept_path, stray_path):
+            os.utime(path, (old, old))
+
+        with override_settings(MEDIA_ROOT=self.media_root, MEDIA_ORPHAN_GRACE_SECONDS=3600), \
+                mock.patch("src.maintenance.get_redis") as get_redis:
+            get_redis.return_value.get.return_value = None
+            self.assertEqual(maintenance.collect_orphaned_media(), 1)
+
+        self.assertFalse(os.path.exists(stray_path))
+        self.assertTrue(os.path.exists(kept_path))
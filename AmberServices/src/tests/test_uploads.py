@@ -0,0 +1,100 @@
+import base64
+from types import SimpleNamespace
+from unittest import mock
+
+from django.urls import reverse
+
+from ..models import UploadSession
+from .utils import StorageTestCase, png
+
+
+def metadata(**values):
+    return ",".join(f"{key} {base64.b64encode(str(value).encode()).decode()}" for key, value in values.items())
+
+
+class UploadTests(StorageTestCase):
+    def headers(self, **headers):
+        return {"HTTP_TUS_RESUMABLE": "1.0.0", "HTTP_AUTHORIZATION": "Bearer alice-signature", **headers}
+
+    def create(self, length, **values):
+        return self.client.post(reverse("uploads"), **self.headers(HTTP_UPLOAD_LENGTH=str(length), HTTP_UPLOAD_METADATA=metadata(**values)))
+
+    def send(self, upload_id, content, offset=0, **headers):
+        return self.client.generic(
+            "PATCH",
+            reverse("upload_detail", args=[upload_id]),
+            content,
+            content_type="application/offset+octet-stream",
+            **self.headers(HTTP_UPLOAD_OFFSET=str(offset), **headers),
+        )
+
+    def upload(self, content, **values):
+        upload_id = self.create(len(content), **values).json()["upload_id"]
+        return upload_id, self.send(upload_id, content)
+
+    def status(self, upload_id):
+        return self.client.get(reverse("upload_detail", args=[upload_id]), **self.headers()).json()
+
+    def test_malformed_lengths_are_rejected(self):
+        for length in ("abc", "-5", "1e3"):
+            self.assertEqual(self.create(length, filename="receipt.png").status_code, 400, length)
+
+        upload_id = self.create(10, filename="receipt.png").json()["upload_id"]
+        for length in ("abc", "-1"):
+            response = self.send(upload_id, b"x", CONTENT_LENGTH=length)
+            self.assertEqual(response.status_code, 400, length)
+            self.assertIn("Content-Length", response.json()["error"])
+
+    @mock.patch("src.uploads.submit_image", return_value=({"image_path": "/media/receipt.png", "task_id": "task"}, None))
+    def test_single_image_is_submitted(self, submit_image):
+        upload_id, response = self.upload(png(), filename="receipt.png")
+
+        self.assertEqual(response.status_code, 204)
+        submit_image.assert_called_once()
+        self.assertEqual(self.status(upload_id)["result"]["task_id"], "task")
+
+    @mock.patch("src.uploads.submit_image", side_effect=ConnectionError("broker unavailable"))
+    def test_processing_failure_is_reported_on_the_session(self, submit_image):
+        upload_id, response = self.upload(png(), filename="receipt.png")
+
+        self.assertEqual(response.status_code, 204)
+        status = self.status(upload_id)
+        self.assertTrue(status["completed"])
+        self.assertIsNotNone(status["image"])
+        self.assertIsNone(status["result"])
+        self.assertIn("broker unavailable", status["error"])
+
+    @mock.patch("src.uploads.enqueue_bulk", return_value=SimpleNamespace(id="progress"))
+    def test_batch_is_queued_once_complete(self, enqueue_bulk):
+        first, _ = self.upload(png(), filename="a.png", batch="march", batch_size=3)
+        second, response = self.upload(png((0, 0, 0)), filename="b.png", batch="march", batch_size=3)
+
+        self.assertEqual(response.status_code, 204)
+        enqueue_bulk.assert_not_called()
+        self.assertIsNone(self.status(first)["result"])
+
+        # A broken file still completes its batch.
+        third, response = self.upload(b"not an image", filename="c.png", batch="march", batch_size=3)
+
+        self.assertEqual(response.status_code, 422)
+        enqueue_bulk.assert_called_once()
+        tenant, images = enqueue_bulk.call_args.args
+        self.assertEqual(tenant, "alice")
+        self.assertEqual({image.pk for image in images}, set(UploadSession.objects.filter(image__isnull=False).values_list("image", flat=True)))
+        for upload_id in (first, second):
+            self.assertEqual(self.status(upload_id)["result"], {"batch": "march", "images": 2, "progress_id": "progress"})
+        self.assertEqual(self.status(third)["error"], "Uploaded file is not a readable image")
+
+    def test_batch_size_is_checked(self):
+        self.assertEqual(self.create(10, filename="a.png", batch="march").status_code, 400)
+        self.assertEqual(self.create(10, filename="a.png", batch="march", batch_size="two").status_code, 400)
+        self.assertEqual(self.create(10, filename="a.png", batch="march", batch_size=1).status_code, 201)
+        self.assertEqual(self.create(10, filename="b.png", batch="march", batch_size=2).status_code, 409)
+        self.assertEqual(self.create(10, filename="b.png", batch="march", batch_size=1).status_code, 409)
+
+    @mock.patch("src.uploads.enqueue_bulk", side_effect=ConnectionError("broker unavailable"))
+    def test_batch_queueing_failure_is_reported(self, enqueue_bulk):
+        upload_id, response = self.upload(png(), filename="a.png", batch="march", batch_size=1)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertIn("broker unavailable", self.status(upload_id)["error"])
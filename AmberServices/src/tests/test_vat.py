@@ -0,0 +1,108 @@
+from decimal import Decimal
+
+from django.test import SimpleTestCase
+
+from .. import vat
+
+
+def receipt(items, **totals):
+    return {"items": items, "totals": totals}
+
+
+class ToDecimalTests(SimpleTestCase):
+    def test_parses_printed_amounts(self):
+        self.assertEqual(vat.to_decimal("12,50"), Decimal("12.50"))
+        self.assertEqual(vat.to_decimal("€ 3.20"), Decimal("3.20"))
+        self.assertEqual(vat.to_decimal("13.5%"), Decimal("13.5"))
+        self.assertEqual(vat.to_decimal(7), Decimal("7"))
+
+    def test_rejects_non_numbers(self):
+        for value in (None, True, "", "n/a", "12.5.0"):
+            self.assertIsNone(vat.to_decimal(value), value)
+
+    def test_rejects_non_finite_values(self):
+        for value in ("NaN", "sNaN", "Infinity", "-inf", float("nan"), float("inf")):
+            self.assertIsNone(vat.to_decimal(value), value)
+
+    def test_non_finite_totals_do_not_break_calculation(self):
+        calculation = vat.calculate(receipt([{"gross_price": "NaN"}], total_gross="Infinity", total_vat="NaN"))
+        self.assertIsNone(calculation.total_gross)
+        self.assertFalse(calculation.reconciled)
+
+
+class RateTests(SimpleTestCase):
+    def test_printed_rate_wins(self):
+        self.assertEqual(vat.item_rate({"vat_rate": "13.5", "category": "food"}), (Decimal("13.5"), False))
+
+    def test_unknown_printed_rate_falls_back_to_category(self):
+        self.assertEqual(vat.item_rate({"vat_rate": 21, "category": "Food "}), (Decimal("0"), False))
+
+    def test_standard_rate_is_assumed(self):
+        self.assertEqual(vat.item_rate({"description": "Widget"}), (vat.STANDARD_RATE, True))
+        calculation = vat.calculate(receipt([{"description": "Widget", "gross_price": 12.30}]))
+        self.assertEqual(calculation.assumptions, ["Assumed 23% VAT for item 'Widget'"])
+        self.assertTrue(calculation.reconciled)
+
+
+class RoundingTests(SimpleTestCase):
+    def test_split_rounds_half_up(self):
+        # 0.05 * 9 / 109 = 0.00413 -> 0.00; 1.09 * 9 / 109 = 0.09 exactly.
+        self.assertEqual(vat.split_gross(Decimal("0.05"), Decimal("9")), (Decimal("0.00"), Decimal("0.05")))
+        self.assertEqual(vat.split_gross(Decimal("1.09"), Decimal("9")), (Decimal("0.09"), Decimal("1.00")))
+        # 10.00 * 13.5 / 113.5 = 1.18942 -> 1.19
+        self.assertEqual(vat.split_gross(Decimal("10.00"), Decimal("13.5")), (Decimal("1.19"), Decimal("8.81")))
+
+    def test_item_gross_from_quantity_and_unit_price(self):
+        self.assertEqual(vat.item_gross({"quantity": "30.5", "unit_price": "1.699"}), Decimal("51.82"))
+
+    def test_derives_totals_without_printed_ones(self):
+        calculation = vat.calculate(receipt([
+            {"description": "Diesel", "gross_price": 61.50, "category": "fuel"},
+            {"description": "Sandwich", "gross_price": 4.50, "category": "restaurant"},
+        ]))
+        self.assertEqual(calculation.total_gross, Decimal("66.00"))
+        self.assertEqual(calculation.total_vat, Decimal("11.50") + Decimal("0.54"))
+        self.assertEqual(calculation.total_net, calculation.total_gross - calculation.total_vat)
+        self.assertEqual(calculation.items[0]["vat_amount"], 11.5)
+        self.assertTrue(calculation.reconciled)
+
+
+class ReconciliationTests(SimpleTestCase):
+    items = [
+        {"description": "Diesel", "gross_price": 61.50, "vat_rate": 23},
+        {"description": "Milk", "gross_price": 1.99, "vat_rate": 0},
+    ]
+
+    def test_matching_totals_reconcile(self):
+        calculation = vat.calculate(receipt(self.items, total_gross=63.49, total_vat=11.50, total_net=51.99))
+        self.assertTrue(calculation.reconciled)
+        self.assertEqual(calculation.total_net, Decimal("51.99"))
+
+    def test_gross_within_tolerance(self):
+        self.assertTrue(vat.calculate(receipt(self.items, total_gross=63.51)).reconciled)
+
+    def test_gross_beyond_tolerance(self):
+        calculation = vat.calculate(receipt(self.items, total_gross=63.52))
+        self.assertEqual(calculation.issues, ["Items add up to 63.49 but the printed total is 63.52"])
+        self.assertEqual(calculation.total_gross, Decimal("63.52"))
+
+    def test_vat_tolerance_grows_with_items(self):
+        items = [{"description": f"Item {n}", "gross_price": 1.00, "vat_rate": 23} for n in range(5)]
+        # Each item rounds to 0.19; a whole-receipt VAT figure would be 0.93.
+        self.assertTrue(vat.calculate(receipt(items, total_gross=5.00, total_vat=0.93)).reconciled)
+        self.assertFalse(vat.calculate(receipt(items, total_gross=5.00, total_vat=0.89)).reconciled)
+
+    def test_net_must_match_gross_less_vat(self):
+        calculation = vat.calculate(receipt(self.items, total_gross=63.49, total_vat=11.50, total_net=50.00))
+        self.assertEqual(len(calculation.issues), 1)
+        self.assertIn("Printed net", calculation.issues[0])
+
+    def test_item_without_amount_is_flagged(self):
+        calculation = vat.calculate(receipt([*self.items, {"description": "Coffee"}], total_gross=66.69))
+        self.assertEqual(calculation.issues, ["No amount for item 'Coffee'"])
+
+    def test_printed_total_without_items_is_flagged(self):
+        calculation = vat.calculate(receipt([], total_gross=20.00))
+        self.assertEqual(calculation.total_gross, Decimal("20.00"))
+        self.assertFalse(calculation.reconciled)
+        self.assertIn("No items extracted", calculation.issues[0])
@@ -0,0 +1,147 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from .. import vendors
+from ..models import VendorTemplate
+
+
+def fuel_receipt(date, time, litres, price, extra=None):
+    """OCR text of an Applegreen fuel receipt and the LLM result for it."""
+    gross = round(litres * price, 2)
+    lines = [
+        "APPLEGREEN", "Main Street", "Lucan, Co. Dublin", "VAT No: IE6388047V", "---------------",
+        f"{date}  {time}  Till 3",
+        f"DIESEL {litres:.2f}L @ {price:.3f} {gross:.2f} A",
+    ]
+    items = [{"description": "Diesel", "quantity": 1, "gross_price": gross, "vat_rate": 23, "tax_deductible": True}]
+    total, vat = gross, gross - gross / 1.23
+    if extra:
+        description, amount = extra
+        lines.append(f"{description} {amount:.2f} B")
+        items.append({"description": description.title(), "gross_price": amount, "vat_rate": 13.5, "tax_deductible": False})
+        total, vat = total + amount, vat + amount - amount / 1.135
+    total, vat = round(total, 2), round(vat, 2)
+    lines += ["---------------", f"TOTAL EUR {total:.2f}", f"VAT {vat:.2f}", "VISA CONTACTLESS", "Thank you"]
+
+    day, month, year = date.split("/")
+    result = {
+        "company_details": {"name": "Applegreen", "address": "Main Street, Lucan, Co. Dublin", "vat_number": "IE6388047V"},
+        "transaction_details": {"date": f"{year}-{month}-{day}", "time": time, "payment_method": "Card"},
+        "items": items,
+        "fuel_type": "Diesel",
+        "is_invoice": False,
+        "totals": {"total_gross": total, "total_vat": vat, "total_net": round(total - vat, 2)},
+    }
+    return "\n".join(lines), result
+
+
+LEARNING_RECEIPTS = [
+    ("15/03/2024", "14:32", 30.5, 1.699),
+    ("16/03/2024", "09:05", 40.0, 1.709),
+    ("20/03/2024", "18:44", 22.25, 1.689),
+]
+
+
+@override_settings(VENDOR_TEMPLATE_MIN_CONFIRMATIONS=3)
+class VendorTemplateTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="secret").id
+        self.bob = User.objects.create_user("bob", password="secret").id
+
+    def learn_vendor(self):
+        for receipt in LEARNING_RECEIPTS:
+            template = vendors.learn(*fuel_receipt(*receipt), self.alice)
+        return template
+
+    def test_learns_and_confirms_a_layout(self):
+        confirmations = [vendors.learn(*fuel_receipt(*receipt), self.alice).confirmations for receipt in LEARNING_RECEIPTS]
+
+        self.assertEqual(confirmations, [1, 2, 3])
+        template = VendorTemplate.objects.get()
+        self.assertEqual(template.key, "vat:6388047V")
+        self.assertEqual(template.layout["date_format"], "%d/%m/%Y")
+        self.assertIn("DIESEL", template.catalog)
+
+    def test_untrusted_template_is_not_used(self):
+        vendors.learn(*fuel_receipt(*LEARNING_RECEIPTS[0]), self.alice)
+        ocr_text, _ = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+        self.assertIsNone(vendors.extract(ocr_text, self.alice))
+
+    def test_round_trip(self):
+        self.learn_vendor()
+        ocr_text, expected = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+
+        result = vendors.extract(ocr_text, self.alice)
+
+        self.assertIsNotNone(result)
+        self.assertTrue(vendors.agrees(result, expected))
+        self.assertEqual(result["company_details"]["vat_number"], "IE6388047V")
+        self.assertEqual(result["transaction_details"], {"date": "2024-04-02", "time": "07:15", "payment_method": "Card"})
+        self.assertEqual(result["items"][0]["description"], "Diesel")
+        self.assertEqual(result["template"], VendorTemplate.objects.get().id)
+        self.assertEqual(VendorTemplate.objects.get().hits, 1)
+
+    def test_template_that_no_longer_matches(self):
+        self.learn_vendor()
+        ocr_text, _ = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+        # The vendor changed its till software: new total label and date format.
+        changed = ocr_text.replace("TOTAL EUR", "AMOUNT DUE").replace("02/04/2024", "2024-04-02")
+
+        self.assertIsNone(vendors.extract(changed, self.alice))
+        self.assertEqual(VendorTemplate.objects.get().misses, 1)
+
+    def test_changed_layout_is_relearned_and_must_earn_trust(self):
+        self.learn_vendor()
+        ocr_text, result = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+        changed = ocr_text.replace("TOTAL EUR", "AMOUNT DUE")
+
+        template = vendors.learn(changed, result, self.alice)
+
+        self.assertEqual(template.confirmations, 1)
+        self.assertIsNone(vendors.extract(changed, self.alice))
+
+    def test_figures_that_do_not_add_up(self):
+        self.learn_vendor()
+        ocr_text, _ = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+        self.assertIsNone(vendors.extract(ocr_text.replace("TOTAL EUR 85.95", "TOTAL EUR 99.99"), self.alice))
+
+    def test_unknown_item_falls_back_until_learned(self):
+        self.learn_vendor()
+        ocr_text, result = fuel_receipt("03/04/2024", "07:15", 10.0, 1.719, extra=("COFFEE", 3.20))
+
+        self.assertIsNone(vendors.extract(ocr_text, self.alice))
+        vendors.learn(ocr_text, result, self.alice)
+
+        ocr_text, expected = fuel_receipt("04/04/2024", "08:30", 12.0, 1.719, extra=("COFFEE", 3.20))
+        extracted = vendors.extract(ocr_text, self.alice)
+        self.assertTrue(vendors.agrees(extracted, expected))
+        self.assertEqual([item["description"] for item in extracted["items"]], ["Diesel", "Coffee"])
+
+    def test_unreconciled_extraction_is_not_learned(self):
+        ocr_text, result = fuel_receipt(*LEARNING_RECEIPTS[0])
+        result["totals"]["total_gross"] += 1
+
+        self.assertIsNone(vendors.learn(ocr_text, result, self.alice))
+        self.assertFalse(VendorTemplate.objects.exists())
+
+    def test_unrecognised_vendor_is_not_learned(self):
+        ocr_text, result = fuel_receipt(*LEARNING_RECEIPTS[0])
+        result["company_details"] = {"name": "Somewhere Else", "vat_number": "IE9999999X"}
+
+        self.assertIsNone(vendors.learn(ocr_text, result, self.alice))
+
+    def test_templates_are_kept_per_client(self):
+        self.learn_vendor()
+        ocr_text, _ = fuel_receipt("02/04/2024", "07:15", 50.0, 1.719)
+
+        self.assertIsNone(vendors.extract(ocr_text, self.bob))
+
+        # Bob's diesel is not deductible; learning that leaves Alice's template alone.
+        for receipt in LEARNING_RECEIPTS:
+            bobs_text, bobs_result = fuel_receipt(*receipt)
+            bobs_result["items"][0]["tax_deductible"] = False
+            vendors.learn(bobs_text, bobs_result, self.bob)
+
+        self.assertEqual(VendorTemplate.objects.count(), 2)
+        self.assertFalse(vendors.extract(ocr_text, self.bob)["items"][0]["tax_deductible"])
+        self.assertTrue(vendors.extract(ocr_text, self.alice)["items"][0]["tax_deductible"])
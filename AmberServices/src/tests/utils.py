@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+from io import BytesIO
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from PIL import Image, ImageDraw
+
+from ..models import Providers, receipt_storage
+
+
+def png(color=(255, 255, 255), size=(64, 64)):
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def receipt_png(lines, size=(320, 480)):
+    """A white receipt with ``lines`` printed top to bottom."""
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for row, line in enumerate(lines):
+        draw.text((20, 20 + row * 24), line, fill=0)
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def receipt_result(**overrides):
+    """A schema-valid, reconciling completion result for a one-item receipt."""
+    result = {
+        "company_details": {"name": "Tesco", "address": "Baggot Street, Dublin 2", "vat_number": ""},
+        "transaction_details": {"date": "2024-03-15", "time": "12:30", "payment_method": "Card"},
+        "items": [{"description": "Coffee", "quantity": 1, "gross_price": 3.5, "vat_rate": 13.5, "category": "restaurant", "tax_deductible": False}],
+        "fuel_type": None,
+        "is_invoice": False,
+        "totals": {"total_gross": 3.5, "total_vat": 0.42, "total_net": 3.08},
+    }
+    result.update(overrides)
+    return result
+
+
+def upload(content, name="receipt.png"):
+    return SimpleUploadedFile(name, content, content_type="image/png")
+
+
+class StorageTestCase(TestCase):
+    """Points the receipt storage at a temporary directory and creates a client with a provider."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.storage = receipt_storage()
+        for attribute in ("base_location", "location"):
+            self.storage.__dict__[attribute] = self.media_root
+        self.addCleanup(self.storage._clear_cached_properties, "MEDIA_ROOT")
+
+        self.user = User.objects.create_user("alice", password="secret")
+        self.provider = Providers.objects.create(client=self.user, signature="alice-signature")
@@ -0,0 +1,292 @@
+"""
+Resumable uploads following the tus 1.0 protocol (core, plus the creation,
+checksum, expiration and termination extensions).
+
+Each chunk is streamed from the request straight onto the end of a staging
+file kept inside the receipt storage, so a dropped connection only costs the
+chunk in flight and no request body is ever held in memory. The staging file
+lives on the same filesystem as the blobs, which lets the finished upload be
+moved into the store with ``ContentAddressedStorage.adopt`` instead of being
+copied. Sessions and staging files expire after ``UPLOAD_EXPIRY_SECONDS``
+without progress.
+
+Images uploaded with ``batch`` and ``batch_size`` metadata are queued on the
+bulk lane together when the last of the batch finishes, under one progress
+handle like an archive's.
+"""
+
+import base64
+import binascii
+import fcntl
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+from PIL import Image, UnidentifiedImageError
+
+from .archives import COPY_BUFFER_SIZE, IMAGE_EXTENSIONS
+from .models import Images, PDFs, UploadSession, receipt_storage
+from .tasks import enqueue_bulk, submit_image
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,checksum,expiration,termination"
+CHECKSUM_ALGORITHMS = ("sha256", "sha1", "md5")
+STAGING_DIR = "uploads"
+# tus-specific status for a chunk whose Upload-Checksum does not match
+CHECKSUM_MISMATCH = 460
+
+
+class UploadError(Exception):
+    """A request the upload protocol refuses; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_metadata(header):
+    """Decode an ``Upload-Metadata`` header: comma separated ``key base64value`` pairs."""
+    metadata = {}
+    for pair in filter(None, (part.strip() for part in (header or "").split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode() if value else ""
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(f"Upload-Metadata value for {key!r} is not valid base64")
+    return metadata
+
+
+def parse_count(value, name):
+    """A non-negative integer header or metadata ``value``; ``None`` when absent."""
+    if value is None or value == "":
+        return None
+    if not (value.isascii() and value.isdigit()):
+        raise UploadError(f"{name} must be a non-negative integer")
+    return int(value)
+
+
+def parse_checksum(header):
+    if not header:
+        return None
+    algorithm, _, encoded = header.partition(" ")
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError(f"Unsupported checksum algorithm {algorithm!r}")
+    try:
+        return algorithm, base64.b64decode(encoded, validate=True)
+    except binascii.Error:
+        raise UploadError("Upload-Checksum is not valid base64")
+
+
+def staging_path(session):
+    return receipt_storage().path(f"{STAGING_DIR}/{session.upload_id}.part")
+
+
+def expiry():
+    return now() + timedelta(seconds=settings.UPLOAD_EXPIRY_SECONDS)
+
+
+def create_session(provider, length, metadata):
+    filename = os.path.basename(metadata.get("filename", "")).strip()
+    lowered = filename.lower()
+    if lowered.endswith(IMAGE_EXTENSIONS):
+        kind, max_size = UploadSession.IMAGE, settings.UPLOAD_MAX_IMAGE_SIZE
+    elif lowered.endswith(".pdf"):
+        kind, max_size = UploadSession.PDF, settings.UPLOAD_MAX_PDF_SIZE
+    else:
+        raise UploadError(f"filename metadata must end in one of: {', '.join(IMAGE_EXTENSIONS + ('.pdf',))}.")
+
+    if length <= 0:
+        raise UploadError("Upload-Length must be positive")
+    if length > max_size:
+        raise UploadError(f"Upload-Length exceeds the {max_size} byte limit", 413)
+
+    batch = metadata.get("batch", "")[:100] if kind == UploadSession.IMAGE else ""
+    batch_size = check_batch(provider.client, batch, metadata.get("batch_size")) if batch else None
+
+    session = UploadSession.objects.create(
+        provider=provider,
+        client=provider.client,
+        kind=kind,
+        filename=filename,
+        batch=batch,
+        batch_size=batch_size,
+        length=length,
+        expires_at=expiry(),
+    )
+    path = staging_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+    return session
+
+
+def check_batch(client, batch, batch_size):
+    batch_size = parse_count(batch_size, "batch_size metadata")
+    if not batch_size or batch_size > settings.UPLOAD_MAX_BATCH_FILES:
+        raise UploadError(f"batch_size metadata between 1 and {settings.UPLOAD_MAX_BATCH_FILES} is required with batch")
+    sessions = UploadSession.objects.filter(client=client, batch=batch)
+    declared = sessions.values_list("batch_size", flat=True).first()
+    if declared is not None and declared != batch_size:
+        raise UploadError(f"Batch {batch!r} was opened with batch_size {declared}", 409)
+    if sessions.count() >= batch_size:
+        raise UploadError(f"Batch {batch!r} already has {batch_size} uploads", 409)
+    return batch_size
+
+
+def find_session(upload_id, provider):
+    session = UploadSession.objects.filter(upload_id=upload_id, provider=provider).first()
+    if session is None:
+        raise UploadError("Upload not found", 404)
+    if session.completed_at is None and session.expires_at < now():
+        raise UploadError("Upload expired", 410)
+    return session
+
+
+def append_chunk(session, offset, stream, length, checksum=None):
+    """
+    Append ``length`` bytes read from ``stream`` at ``offset``. Bytes that
+    arrived before a dropped connection are kept unless the chunk carried a
+    checksum. Returns the session, finalised once the last byte is in.
+    """
+    if session.completed_at is not None:
+        raise UploadError("Upload already completed", 409)
+    path = staging_path(session)
+
+    with open(path, "r+b") as staging:
+        try:
+            fcntl.flock(staging, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError("Another request is writing to this upload", 423)
+
+        # Re-read under the lock: a concurrent chunk may just have landed.
+        session.refresh_from_db()
+        if offset != session.offset:
+            raise UploadError(f"Upload-Offset {offset} does not match the current offset {session.offset}", 409)
+        if length is None:
+            length = session.length - session.offset
+        if session.offset + length > session.length:
+            raise UploadError("Chunk runs past Upload-Length", 413)
+
+        # Anything past the recorded offset is left over from an interrupted write.
+        staging.seek(session.offset)
+        staging.truncate()
+        digest = hashlib.new(checksum[0]) if checksum else None
+        written = 0
+        while written < length:
+            data = stream.read(min(COPY_BUFFER_SIZE, length - written))
+            if not data:
+                break
+            staging.write(data)
+            if digest:
+                digest.update(data)
+            written += len(data)
+        staging.flush()
+
+        if digest and (written < length or digest.digest() != checksum[1]):
+            staging.truncate(session.offset)
+            raise UploadError("Upload-Checksum does not match the chunk", CHECKSUM_MISMATCH)
+
+        session.offset += written
+        session.expires_at = expiry()
+        session.save(update_fields=["offset", "expires_at", "updated_at"])
+
+        if session.offset == session.length:
+            finalize(session, path)
+    return session
+
+
+def check_content(session, path):
+    if session.kind == UploadSession.PDF:
+        with open(path, "rb") as upload:
+            if upload.read(5) != b"%PDF-":
+                raise UploadError("Uploaded file is not a PDF", 422)
+        return
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except (OSError, UnidentifiedImageError, SyntaxError):
+        raise UploadError("Uploaded file is not a readable image", 422)
+
+
+def finalize(session, path):
+    """Validate the assembled file, move it into the receipt store and create its row."""
+    try:
+        check_content(session, path)
+    except UploadError as e:
+        UploadSession.objects.filter(pk=session.pk).update(error=str(e), completed_at=now())
+        os.remove(path)
+        if session.batch:
+            # It still counts towards its batch, which it may have completed.
+            start_processing(session, None)
+        raise
+
+    # The row takes its reference on the blob once committed; if it is never
+    # created the unreferenced blob is collected.
+    name = receipt_storage().adopt(path, session.filename)
+    model, field = (Images, "image") if session.kind == UploadSession.IMAGE else (PDFs, "pdf")
+    with transaction.atomic():
+        row = model.objects.create(
+            provider=session.provider,
+            client=session.client,
+            name=session.filename[:50],
+            **{field: name},
+        )
+        setattr(session, field, row)
+        session.completed_at = now()
+        session.save(update_fields=[field, "completed_at", "updated_at"])
+    logger.info(f"Upload {session.upload_id} completed as {model.__name__} {row.id}")
+
+    if session.kind == UploadSession.IMAGE:
+        start_processing(session, row)
+        session.refresh_from_db()
+
+
+def start_processing(session, image):
+    """
+    Queue a finished image, or its batch once complete. The upload itself has
+    succeeded, so a failure here is recorded on the session for the status
+    endpoint rather than raised.
+    """
+    sessions = batch_sessions(session) if session.batch else UploadSession.objects.filter(pk=session.pk)
+    try:
+        if session.batch:
+            enqueue_batch(session, sessions)
+        else:
+            image_path = image.image.url
+            result, reason = submit_image(image)
+            sessions.update(result=result or {"image_path": image_path, "rejected": reason}, updated_at=now())
+    except Exception as e:
+        logger.error(f"Could not start processing upload {session.upload_id}: {e}")
+        sessions.filter(error__isnull=True).update(error=f"Processing could not be started: {e}", updated_at=now())
+
+
+def batch_sessions(session):
+    return UploadSession.objects.filter(client=session.client, batch=session.batch)
+
+
+def enqueue_batch(session, sessions):
+    if sessions.filter(completed_at__isnull=False).count() < session.batch_size:
+        return
+    # Uploads finishing at the same time may both see a complete batch; only
+    # the one whose update claims the sessions queues it.
+    if not sessions.filter(result__isnull=True, error__isnull=True).update(result={"batch": session.batch}, updated_at=now()):
+        return
+
+    images = list(Images.objects.filter(pk__in=sessions.values("image")))
+    progress_id = enqueue_bulk(session.client.username, images).id if images else None
+    sessions.update(result={"batch": session.batch, "images": len(images), "progress_id": progress_id}, updated_at=now())
+    logger.info(f"Queued batch {session.batch!r} of {len(images)} uploaded images as {progress_id}")
+
+
+def terminate(session):
+    try:
+        os.remove(staging_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
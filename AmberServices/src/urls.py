@@ -2,7 +2,7 @@ from django.urls import path, re_path
 from django.urls import path
 from django.utils.text import slugify
 
-from .views import LogIn, RegisterClient, Images, PDFs, Logout, Permissions
+from .views import LogIn, RegisterClient, Images, PDFs, Logout, Permissions, ReceiptExport, ReceiptSearch, ArchiveUpload, ArchiveProgress, CompletionMetrics, Uploads, UploadDetail
 from .models import Providers
 
 # Base urlpatterns
@@ -13,6 +13,13 @@ urlpatterns = [
     path('images/', Images.as_view(), name='images'),
     path('pdfs/', PDFs.as_view(), name='pdfs'),
     path("permissions/", Permissions.as_view(), name="permissions"),
+    path('exports/receipts/', ReceiptExport.as_view(), name='receipt_export'),
+    path('receipts/search/', ReceiptSearch.as_view(), name='receipt_search'),
+    path('archives/', ArchiveUpload.as_view(), name='archives'),
+    path('archives/<str:progress_id>/', ArchiveProgress.as_view(), name='archive_progress'),
+    path('metrics/completions/', CompletionMetrics.as_view(), name='completion_metrics'),
+    path('uploads/', Uploads.as_view(), name='uploads'),
+    path('uploads/<uuid:upload_id>/', UploadDetail.as_view(), name='upload_detail'),
 ]
 
 def get_dynamic_routes():
@@ -0,0 +1,165 @@
+"""
+Irish VAT arithmetic for extracted receipts.
+
+The LLM only transcribes what is printed: item amounts, any printed VAT rate,
+a coarse item category and the printed totals. Rates, VAT and net amounts are
+derived here with ``Decimal`` and reconciled against the printed totals;
+anything that does not add up is reported as an issue rather than silently
+corrected.
+"""
+
+from dataclasses import dataclass, field
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from .exports import item_value
+
+
+STANDARD_RATE = Decimal("23")
+RATES = (Decimal("0"), Decimal("9"), Decimal("13.5"), STANDARD_RATE)
+
+# Rate per item category the prompt asks the LLM to choose from.
+CATEGORY_RATES = {
+    "fuel": Decimal("23"),
+    "heating_fuel": Decimal("13.5"),
+    "electricity": Decimal("9"),
+    "gas": Decimal("9"),
+    "food": Decimal("0"),
+    "restaurant": Decimal("13.5"),
+    "accommodation": Decimal("13.5"),
+    "newspapers": Decimal("9"),
+    "books": Decimal("0"),
+    "children_clothing": Decimal("0"),
+    "medicine": Decimal("0"),
+    "alcohol": Decimal("23"),
+    "general": STANDARD_RATE,
+}
+
+CENT = Decimal("0.01")
+TOLERANCE = Decimal("0.02")
+
+
+def to_decimal(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = Decimal(str(value).replace(",", ".").replace("€", "").replace("%", "").strip())
+    except InvalidOperation:
+        return None
+    # "NaN" and "Infinity" parse, but cannot be compared or quantized.
+    return number if number.is_finite() else None
+
+
+def to_cents(value):
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def item_rate(item):
+    """Return ``(rate, assumed)`` for an extracted item."""
+    printed = to_decimal(item_value(item, ("vat_rate",)))
+    if printed is not None and printed in RATES:
+        return printed, False
+    category = str(item.get("category") or "").strip().lower()
+    if category in CATEGORY_RATES:
+        return CATEGORY_RATES[category], False
+    return STANDARD_RATE, True
+
+
+def item_gross(item):
+    gross = to_decimal(item_value(item, ("gross_price", "gross", "price")))
+    if gross is not None:
+        return to_cents(gross)
+    quantity = to_decimal(item_value(item, ("quantity", "qty")))
+    unit_price = to_decimal(item_value(item, ("unit_price",)))
+    if quantity is not None and unit_price is not None:
+        return to_cents(quantity * unit_price)
+    return None
+
+
+def split_gross(gross, rate):
+    vat = to_cents(gross * rate / (100 + rate))
+    return vat, gross - vat
+
+
+@dataclass
+class Calculation:
+    items: list
+    total_gross: Decimal = None
+    total_vat: Decimal = None
+    total_net: Decimal = None
+    issues: list = field(default_factory=list)
+    assumptions: list = field(default_factory=list)
+
+    @property
+    def reconciled(self):
+        return not self.issues
+
+
+def calculate(result):
+    """
+    Derive per-item and total VAT for an extraction ``result`` and reconcile
+    them with its printed totals. Printed totals win when present, since they
+    are what the vendor charged.
+    """
+    printed = result.get("totals") or {}
+    printed_gross = to_decimal(printed.get("total_gross"))
+    printed_vat = to_decimal(printed.get("total_vat"))
+    printed_net = to_decimal(printed.get("total_net"))
+
+    items = []
+    issues = []
+    assumptions = []
+    gross_sum = vat_sum = Decimal("0")
+    complete = True
+    for item in result.get("items") or []:
+        if not isinstance(item, dict):
+            continue
+        gross = item_gross(item)
+        if gross is None:
+            complete = False
+            issues.append(f"No amount for item {item_value(item, ('description', 'name'))!r}")
+            items.append(item)
+            continue
+
+        rate, assumed = item_rate(item)
+        if assumed:
+            assumptions.append(f"Assumed {rate}% VAT for item {item_value(item, ('description', 'name'))!r}")
+        vat, net = split_gross(gross, rate)
+        gross_sum += gross
+        vat_sum += vat
+        items.append({
+            **item,
+            "gross_price": float(gross),
+            "vat_rate": float(rate),
+            "vat_amount": float(vat),
+            "net_price": float(net),
+        })
+
+    calculation = Calculation(items=items, issues=issues, assumptions=assumptions)
+    if not items:
+        complete = False
+
+    if printed_gross is not None:
+        calculation.total_gross = to_cents(printed_gross)
+        if not items:
+            issues.append(f"No items extracted to check the printed total {calculation.total_gross} against")
+        elif complete and abs(gross_sum - calculation.total_gross) > TOLERANCE:
+            issues.append(f"Items add up to {gross_sum} but the printed total is {calculation.total_gross}")
+    elif complete:
+        calculation.total_gross = gross_sum
+
+    # Per-item rounding may drift a cent per item from a VAT total computed
+    # on the whole receipt.
+    vat_tolerance = max(TOLERANCE, CENT * len(items))
+    if printed_vat is not None:
+        calculation.total_vat = to_cents(printed_vat)
+        if complete and abs(vat_sum - calculation.total_vat) > vat_tolerance:
+            issues.append(f"Item VAT adds up to {vat_sum} but the printed VAT is {calculation.total_vat}")
+    elif complete:
+        calculation.total_vat = vat_sum
+
+    if calculation.total_gross is not None and calculation.total_vat is not None:
+        calculation.total_net = calculation.total_gross - calculation.total_vat
+        if printed_net is not None and abs(to_cents(printed_net) - calculation.total_net) > TOLERANCE:
+            issues.append(f"Printed net {to_cents(printed_net)} does not match gross less VAT {calculation.total_net}")
+
+    return calculation
@@ -0,0 +1,522 @@
+"""
+Learned per-vendor extraction templates.
+
+Most receipts come from a few hundred vendors whose layouts never change. When
+an LLM extraction reconciles (items add up to the total, net plus VAT to gross)
+and the vendor can be recognised in the OCR text by its VAT number or company
+name line, ``learn`` records how that receipt is laid out:
+
+* the label in front of each printed total, e.g. ``TOTAL EUR``;
+* the printed date format;
+* the line just above the first item, and the non-item lines seen between
+  items and totals (item lines themselves are read with ``ITEM_GRAMMARS``);
+* which lines hold the address;
+* a catalog mapping each printed item description to the attributes the LLM
+  gave it (clean description, VAT rate, category, deductibility).
+
+Templates are kept per client. Category and deductibility depend on the
+business buying the item, and the address on the branch it shops at, so a
+template learned from one client's receipts is never applied to another's.
+
+A layout is only stored if applying it to the same OCR text reproduces the
+LLM's extraction. Each later LLM extraction for the vendor is compared with
+what the template would have produced; after
+``VENDOR_TEMPLATE_MIN_CONFIRMATIONS`` agreements the template is trusted and
+``extract`` answers without the LLM. Any line the template cannot account
+for, an unknown item, or figures that do not add up make ``extract`` return
+``None``, and the LLM extraction that follows refreshes the template.
+"""
+
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .exports import item_value
+from .models import VendorTemplate
+from . import vat
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CENT = Decimal("0.01")
+HEADER_LINES = 10
+
+AMOUNT = r"-?\d{1,7}[.,]\d{2}"
+VAT_CODE = r"(?:\s+[A-Z*]{1,2})?\s*$"
+# Most specific first; every item line must match one of them.
+ITEM_GRAMMARS = [
+    rf"^(?P<description>.+?)\s+(?P<quantity>\d+[.,]\d+)\s*L?\s*@\s*(?P<unit_price>\d+[.,]\d{{2,3}})\s+(?P<gross>{AMOUNT}){VAT_CODE}",
+    rf"^(?P<description>.+?)\s+(?P<quantity>\d+)\s*[xX@]\s*(?P<unit_price>{AMOUNT})\s+(?P<gross>{AMOUNT}){VAT_CODE}",
+    rf"^(?P<quantity>\d+)\s+(?P<description>\D.*?)\s+(?P<gross>{AMOUNT}){VAT_CODE}",
+    rf"^(?P<description>.+?)\s+(?P<gross>{AMOUNT}){VAT_CODE}",
+]
+ITEM_PATTERNS = [re.compile(grammar) for grammar in ITEM_GRAMMARS]
+
+DATE_FORMATS = ["%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y", "%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d", "%d %b %Y", "%d%b%y"]
+DATE_PATTERNS = {"%d": r"\d{2}", "%m": r"\d{2}", "%Y": r"\d{4}", "%y": r"\d{2}", "%b": r"[A-Za-z]{3}"}
+TIME_PATTERN = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\b")
+VAT_PATTERN = re.compile(r"\b(?:IE\s?)?(\d[\dA-Z+*]\d{5}[A-Z]{1,2})\b")
+INVOICE_PATTERN = re.compile(r"\b(invoice|bill)\b", re.IGNORECASE)
+CARD_PATTERN = re.compile(r"\b(card|visa|mastercard|debit|credit|contactless|amex|maestro)\b", re.IGNORECASE)
+CASH_PATTERN = re.compile(r"\bcash\b", re.IGNORECASE)
+NAME_SUFFIXES = re.compile(r"\b(LTD|LIMITED|PLC|DAC|TEO|CLG|UC)\b")
+
+AMOUNT_KEYS = {"quantity", "qty", "unit_price", "gross_price", "gross", "price", "vat_amount", "vat", "net_price", "net"}
+TOTAL_FIELDS = ("total_gross", "total_vat", "total_net")
+
+
+def normalize(text):
+    return " ".join(str(text).upper().split())
+
+
+def compact(text):
+    return re.sub(r"[^A-Z0-9]", "", normalize(text))
+
+
+def vat_key(vat_number):
+    value = compact(vat_number)
+    if value.startswith("IE"):
+        value = value[2:]
+    return f"vat:{value}" if len(value) >= 8 else None
+
+
+def name_key(company_name):
+    value = compact(NAME_SUFFIXES.sub("", normalize(company_name)))
+    return f"name:{value}" if len(value) >= 3 else None
+
+
+def ocr_lines(ocr_text):
+    return [line.strip() for line in (ocr_text or "").splitlines() if line.strip()]
+
+
+def candidate_keys(lines):
+    keys = [vat_key(match) for line in lines for match in VAT_PATTERN.findall(line.upper())]
+    keys += [name_key(line) for line in lines[:HEADER_LINES]]
+    return [key for key in dict.fromkeys(keys) if key]
+
+
+def to_amount(value):
+    if value is None or value == "":
+        return None
+    try:
+        return Decimal(str(value).replace(",", ".").replace("€", "").strip()).quantize(CENT)
+    except InvalidOperation:
+        return None
+
+
+def anchor(line):
+    # Digits vary between receipts of one vendor (dates, till numbers).
+    pattern = re.escape(normalize(line))
+    pattern = re.sub(r"\d+", r"\\d+", pattern)
+    return pattern.replace(r"\ ", r"\s*")
+
+
+def matches_anchor(pattern, line):
+    return re.fullmatch(pattern, normalize(line)) is not None
+
+
+def date_regex(date_format):
+    pattern = re.escape(date_format)
+    for directive, regex in DATE_PATTERNS.items():
+        pattern = pattern.replace(re.escape(directive), regex)
+    return pattern
+
+
+def detect_payment_method(lines):
+    text = "\n".join(lines)
+    if CARD_PATTERN.search(text):
+        return "Card"
+    if CASH_PATTERN.search(text):
+        return "Cash"
+    return None
+
+
+def detect_fuel_type(items):
+    descriptions = " ".join(normalize(item_value(item, ("description", "name")) or "") for item in items)
+    if "DIESEL" in descriptions:
+        return "Diesel"
+    if "PETROL" in descriptions or "UNLEADED" in descriptions:
+        return "Petrol"
+    return None
+
+
+def clean(value):
+    if value is None or str(value).strip().lower() in ("", "none", "null", "n/a"):
+        return None
+    return str(value).strip()
+
+
+# Reading a receipt with a layout.
+
+def read_total(lines, rule):
+    pattern = re.compile(rf"^{rule['label']}[^\d-]*(?P<amount>{AMOUNT})")
+    # Bottom up, as learned: the totals follow the items.
+    for index in range(len(lines) - 1, -1, -1):
+        line = lines[index]
+        if rule["offset"]:
+            if matches_anchor(rule["label"], line) and index + 1 < len(lines):
+                match = re.search(AMOUNT, lines[index + 1])
+                if match:
+                    return index, to_amount(match.group(0))
+        else:
+            match = pattern.match(normalize(line))
+            if match:
+                return index, to_amount(match.group("amount"))
+    return None, None
+
+
+def read_date(lines, date_format):
+    match = re.search(date_regex(date_format), "\n".join(lines))
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(0), date_format).date().isoformat()
+    except ValueError:
+        return None
+
+
+def read_time(lines):
+    match = TIME_PATTERN.search("\n".join(lines))
+    return f"{int(match.group(1)):02d}:{match.group(2)}" if match else None
+
+
+def read_items(lines, layout, end):
+    items_layout = layout["items"]
+    start = 0
+    if items_layout["start"] is not None:
+        start = next((index + 1 for index, line in enumerate(lines[:end]) if matches_anchor(items_layout["start"], line)), None)
+        if start is None:
+            return None
+
+    items = []
+    for line in lines[start:end]:
+        if any(matches_anchor(skip, line) for skip in items_layout["skip"]):
+            continue
+        item = parse_item(line)
+        if item is None:
+            return None
+        items.append(item)
+    return items
+
+
+def parse_item(line):
+    for pattern in ITEM_PATTERNS:
+        match = pattern.match(normalize(line))
+        if match:
+            return match.groupdict()
+    return None
+
+
+def read_receipt(lines, layout):
+    """
+    Read the raw fields of a receipt laid out as ``layout``. Returns ``None``
+    if a required field is missing or a line in the item block is unexpected.
+    """
+    totals = {}
+    total_lines = []
+    for field, rule in layout["totals"].items():
+        index, amount = read_total(lines, rule)
+        if amount is None:
+            return None
+        totals[field] = amount
+        total_lines.append(index)
+
+    items = read_items(lines, layout, min(total_lines))
+    if not items:
+        return None
+
+    date = read_date(lines, layout["date_format"]) if layout["date_format"] else None
+    if layout["date_format"] and date is None:
+        return None
+
+    address = None
+    if layout["address_lines"]:
+        if max(layout["address_lines"]) >= len(lines):
+            return None
+        address = ", ".join(lines[index] for index in layout["address_lines"])
+
+    return {
+        "totals": totals,
+        "items": items,
+        "date": date,
+        "time": read_time(lines) if layout["time"] else None,
+        "address": address,
+    }
+
+
+def build_result(template, lines, raw):
+    items = []
+    for raw_item in raw["items"]:
+        attributes = template.catalog.get(normalize(raw_item["description"]))
+        if attributes is None:
+            return None
+        item = {**attributes, "gross_price": float(to_amount(raw_item["gross"]))}
+        if raw_item.get("quantity"):
+            item["quantity"] = float(raw_item["quantity"].replace(",", "."))
+        if raw_item.get("unit_price"):
+            item["unit_price"] = float(raw_item["unit_price"].replace(",", "."))
+        items.append(item)
+
+    return {
+        "company_details": {
+            "name": template.company_name,
+            "address": raw["address"] or template.address,
+            "vat_number": template.vat_number,
+        },
+        "transaction_details": {
+            "date": raw["date"],
+            "time": raw["time"],
+            "payment_method": detect_payment_method(lines) if template.layout["payment_method"] else None,
+        },
+        "items": items,
+        "fuel_type": detect_fuel_type(items),
+        "is_invoice": bool(INVOICE_PATTERN.search("\n".join(lines))),
+        "totals": {field: float(value) for field, value in raw["totals"].items()},
+        "template": template.id,
+    }
+
+
+def reconciles(result):
+    calculation = vat.calculate(result)
+    return bool(calculation.items) and calculation.total_gross is not None and calculation.reconciled
+
+
+def agrees(template_result, llm_result):
+    def fields(result):
+        company = result.get("company_details") or {}
+        details = result.get("transaction_details") or {}
+        totals = result.get("totals") or {}
+        items = [item for item in result.get("items") or [] if isinstance(item, dict)]
+        return (
+            compact(company.get("vat_number") or ""),
+            clean(details.get("date")),
+            clean(details.get("time")),
+            (clean(details.get("payment_method")) or "").lower(),
+            (clean(result.get("fuel_type")) or "").lower(),
+            bool(result.get("is_invoice")),
+            to_amount(totals.get("total_gross")),
+            sorted(to_amount(item_value(item, ("gross_price", "gross", "price"))) for item in items),
+        )
+
+    return fields(template_result) == fields(llm_result)
+
+
+def extract(ocr_text, client_id):
+    """
+    Extract a receipt of ``client_id`` with its vendor's trusted template.
+    Returns a result in the shape of an LLM completion, or ``None`` to fall
+    back to the LLM.
+    """
+    lines = ocr_lines(ocr_text)
+    keys = candidate_keys(lines)
+    templates = {
+        template.key: template
+        for template in VendorTemplate.objects.filter(
+            client_id=client_id, key__in=keys, confirmations__gte=settings.VENDOR_TEMPLATE_MIN_CONFIRMATIONS,
+        )
+    }
+    # VAT numbers come first in ``keys`` and identify a vendor best.
+    template = next((templates[key] for key in keys if key in templates), None)
+    if template is None:
+        return None
+
+    raw = read_receipt(lines, template.layout)
+    result = build_result(template, lines, raw) if raw else None
+    if result is None or not reconciles(result):
+        VendorTemplate.objects.filter(pk=template.pk).update(misses=F("misses") + 1)
+        logger.info(f"Vendor template {template.key} did not fit, falling back to the LLM")
+        return None
+
+    VendorTemplate.objects.filter(pk=template.pk).update(hits=F("hits") + 1)
+    return result
+
+
+# Learning a layout from an LLM extraction.
+
+def find_amount_line(lines, amount, end=None):
+    for index, line in enumerate(lines[:end]):
+        for match in re.finditer(AMOUNT, line):
+            if to_amount(match.group(0)) == amount:
+                return index, match.start()
+    return None, None
+
+
+def learn_totals(lines, result):
+    totals = result.get("totals") or {}
+    rules = {}
+    for field in TOTAL_FIELDS:
+        amount = to_amount(totals.get(field))
+        if amount is None:
+            continue
+        # Search upwards from the bottom: the totals follow the items.
+        reversed_index, position = find_amount_line(lines[::-1], amount)
+        if reversed_index is None:
+            if field == "total_gross":
+                return None
+            continue
+        index = len(lines) - 1 - reversed_index
+        label = lines[index][:position].strip(" :€")
+        if re.search(r"[A-Za-z]", label):
+            rules[field] = {"label": anchor(label), "offset": 0}
+        elif index > 0 and re.search(r"[A-Za-z]", lines[index - 1]):
+            rules[field] = {"label": anchor(lines[index - 1]), "offset": 1}
+        elif field == "total_gross":
+            return None
+    return rules
+
+
+def learn_items(lines, result, end):
+    remaining = sorted(
+        to_amount(item_value(item, ("gross_price", "gross", "price")))
+        for item in result.get("items") or [] if isinstance(item, dict)
+    )
+    matched = {}
+    # Items sit right above the totals, so match from there upwards.
+    for index in range(end - 1, -1, -1):
+        if not remaining:
+            break
+        item = parse_item(lines[index])
+        amount = to_amount(item["gross"]) if item else None
+        if amount is not None and amount in remaining:
+            remaining.remove(amount)
+            matched[index] = item
+    if remaining or not matched:
+        return None, None
+
+    first = min(matched)
+    skip = [anchor(lines[index]) for index in range(first, end) if index not in matched]
+    return {
+        "start": anchor(lines[first - 1]) if first > 0 else None,
+        "skip": list(dict.fromkeys(skip)),
+    }, matched
+
+
+def learn_address(lines, address):
+    words = set(compact_words(address))
+    if not words:
+        return []
+    indexes = [
+        index for index, line in enumerate(lines[:HEADER_LINES])
+        if compact_words(line) and set(compact_words(line)) <= words
+    ]
+    covered = set(word for index in indexes for word in compact_words(lines[index]))
+    return indexes if len(covered) >= 0.8 * len(words) else []
+
+
+def compact_words(text):
+    return [compact(word) for word in normalize(text).split() if compact(word)]
+
+
+def learn_catalog(result, raw_items):
+    catalog = {}
+    items = [item for item in result.get("items") or [] if isinstance(item, dict)]
+    for raw_item in raw_items:
+        gross = to_amount(raw_item["gross"])
+        words = set(compact_words(raw_item["description"]))
+        candidates = [item for item in items if to_amount(item_value(item, ("gross_price", "gross", "price"))) == gross]
+        if not candidates:
+            continue
+        # Same-priced items are told apart by their descriptions.
+        item = max(candidates, key=lambda item: len(words & set(compact_words(item_value(item, ("description", "name")) or ""))))
+        items.remove(item)
+        catalog[normalize(raw_item["description"])] = {key: value for key, value in item.items() if key not in AMOUNT_KEYS}
+    return catalog
+
+
+def learn_layout(lines, result):
+    details = result.get("transaction_details") or {}
+    company = result.get("company_details") or {}
+
+    totals = learn_totals(lines, result)
+    if not totals:
+        return None, None
+    end = min(read_total(lines, rule)[0] for rule in totals.values())
+
+    items, matched = learn_items(lines, result, end)
+    if items is None:
+        return None, None
+
+    date_format = None
+    if clean(details.get("date")):
+        text = "\n".join(lines)
+        date_format = next((
+            date_format for date_format in DATE_FORMATS
+            if read_date([text], date_format) == clean(details.get("date"))
+        ), None)
+        if date_format is None:
+            return None, None
+
+    layout = {
+        "totals": totals,
+        "items": items,
+        "date_format": date_format,
+        "time": clean(details.get("time")) is not None,
+        "payment_method": clean(details.get("payment_method")) is not None,
+        "address_lines": learn_address(lines, company.get("address") or ""),
+    }
+    return layout, learn_catalog(result, matched.values())
+
+
+def vendor_key(lines, result):
+    company = result.get("company_details") or {}
+    keys = set(candidate_keys(lines))
+    for key in (vat_key(company.get("vat_number") or ""), name_key(company.get("name") or "")):
+        if key and key in keys:
+            return key
+    return None
+
+
+def learn(ocr_text, result, client_id):
+    """
+    Update ``client_id``'s vendor template from an LLM extraction ``result``
+    of ``ocr_text``. Returns the template, or ``None`` if nothing was learned.
+    """
+    if not isinstance(result, dict) or not reconciles(result):
+        return None
+
+    lines = ocr_lines(ocr_text)
+    key = vendor_key(lines, result)
+    if key is None:
+        return None
+
+    with transaction.atomic():
+        template = VendorTemplate.objects.select_for_update().filter(client_id=client_id, key=key).first()
+        if template is not None:
+            raw = read_receipt(lines, template.layout)
+            if raw is not None:
+                # Same layout, possibly with products the catalog has not seen.
+                template.catalog = {**learn_catalog(result, raw["items"]), **template.catalog}
+                current = build_result(template, lines, raw)
+                if current is not None and agrees(current, result):
+                    template.confirmations += 1
+                    template.save(update_fields=["catalog", "confirmations", "updated_at"])
+                    return template
+                template.refresh_from_db()
+
+        layout, catalog = learn_layout(lines, result)
+        if layout is None:
+            return None
+
+        company = result.get("company_details") or {}
+        candidate = template or VendorTemplate(client_id=client_id, key=key)
+        candidate.company_name = company.get("name")
+        candidate.vat_number = company.get("vat_number")
+        candidate.address = company.get("address")
+        candidate.layout = layout
+        candidate.catalog = {**(template.catalog if template else {}), **catalog}
+
+        raw = read_receipt(lines, layout)
+        learned = build_result(candidate, lines, raw) if raw else None
+        if learned is None or not agrees(learned, result):
+            return None
+
+        # A changed layout has to earn trust again.
+        candidate.confirmations = 1
+        candidate.save()
+        logger.info(f"Learned vendor template {key}")
+        return candidate
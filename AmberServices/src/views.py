@@ -1,4 +1,5 @@
 import base64
+import io
 import hashlib
 import hmac
 import asyncio
@@ -9,7 +10,7 @@ logger = logging.getLogger(__name__)
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import status
+from rest_framework import serializers, status
 
 from django.db import transaction
 from django.contrib.auth import login, logout
@@ -18,11 +19,19 @@ from django.utils.timezone import now
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
+from django.urls import reverse
 
-from .serializers import SerializeLoginClient, SerializeSignInClient, SerializeImages, SerializePDF
+
+from .serializers import SerializeLoginClient, SerializeSignInClient, SerializeImages, SerializePDF, SerializeArchive
 from .models import Images, PDFs, Providers, ProcessedImage
 from .tesseract import GoogleVisionOCR
-from .tasks import process_image_task
+from .tasks import bulk_progress, enqueue_bulk, submit_image
+from .archives import ingest_archive
+from .exports import RECEIPT_FIELDS, receipt_rows, stream_csv, stream_xlsx
+from . import cascade, search, uploads
 
 
 
@@ -47,6 +56,13 @@ def verify_signature(username, signature):
     return hmac.compare_digest(expected_signature, signature)
 
 
+def bearer_provider(request):
+    signature = request.headers.get("Authorization", "").replace("Bearer ", "").strip()
+    if not signature:
+        return None
+    return Providers.objects.filter(signature=signature, is_active=True).select_related("client").first()
+
+
 # API Views
 class LogIn(APIView):
     def post(self, request):
@@ -154,16 +170,43 @@ class Images(APIView):
             saved_data = serializer.save()
 
             image_objects = saved_data if is_bulk else [saved_data]
-            results = []
 
+            # Small uploads are someone waiting on a phone; larger batches
+            # share the bulk lane fairly with every other tenant.
+            if len(image_objects) > settings.SCHEDULER_INTERACTIVE_MAX_IMAGES:
+                progress = enqueue_bulk(image_objects[0].client.username, image_objects)
+                return Response(
+                    {
+                        "message": "Images uploaded successfully. Processing has been scheduled.",
+                        "images": [image.image.url for image in image_objects],
+                        "progress_id": progress.id,
+                    },
+                    status=status.HTTP_201_CREATED,
+                )
+
+            results, rejected = [], []
             for image in image_objects:
-                task = process_image_task.delay(".." + image.image.url)
-                results.append({"image_path": image.image.url, "task_id": task.id})
+                image_path = image.image.url
+                result, reason = submit_image(image)
+                if reason:
+                    rejected.append({"image_path": image_path, "reason": reason})
+                    continue
+                results.append(result)
+
+            if not results:
+                return Response(
+                    {
+                        "error": "Image rejected before processing.",
+                        "rejected": rejected,
+                    },
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
 
             return Response(
                 {
                     "message": "Images uploaded successfully. Processing has started.",
                     "tasks": results,
+                    "rejected": rejected,
                 },
                 status=status.HTTP_201_CREATED,
             )
@@ -282,3 +325,277 @@ class PDFs(APIView):
     #         results.append(processed_image)
 
     #     return results
+
+
+class ReceiptExport(APIView):
+    content_types = {
+        "csv": "text/csv",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    }
+
+    def get(self, request):
+        username = request.query_params.get('username')
+        signature = request.query_params.get('signature')
+
+        if not username or not signature:
+            return Response({"error": "Username and signature are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not verify_signature(username, signature):
+            return Response({"error": "Invalid signature"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Not "format": DRF reserves that parameter for renderer negotiation.
+        file_format = request.query_params.get('file_format', 'csv').lower()
+        if file_format not in self.content_types:
+            return Response({"error": "file_format must be 'csv' or 'xlsx'"}, status=status.HTTP_400_BAD_REQUEST)
+
+        receipts = ProcessedImage.objects.filter(user__username=username)
+
+        for param, lookup in (('date_from', 'transaction_date__gte'), ('date_to', 'transaction_date__lte')):
+            value = request.query_params.get(param)
+            if value:
+                try:
+                    parsed = parse_date(value)
+                except ValueError:
+                    # Well formed but not a real day, e.g. 2024-02-30.
+                    parsed = None
+                if parsed is None:
+                    return Response({"error": f"{param} must be a date in YYYY-MM-DD format"}, status=status.HTTP_400_BAD_REQUEST)
+                receipts = receipts.filter(**{lookup: parsed})
+
+        vendor = request.query_params.get('vendor')
+        if vendor:
+            receipts = receipts.filter(company_name__icontains=vendor)
+
+        deductible = request.query_params.get('deductible')
+        if deductible is not None:
+            deductible = deductible.lower() in ('true', '1', 'yes')
+
+        rows = receipt_rows(
+            receipts.order_by('transaction_date', 'id')
+            .values(*RECEIPT_FIELDS)
+            .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE),
+            deductible=deductible,
+        )
+        stream = stream_xlsx(rows) if file_format == 'xlsx' else stream_csv(rows)
+
+        response = StreamingHttpResponse(stream, content_type=self.content_types[file_format])
+        response['Content-Disposition'] = f'attachment; filename="receipts.{file_format}"'
+        return response
+
+
+class ReceiptSearch(APIView):
+    fields = ('id', 'image_id', 'company_name', 'address', 'transaction_date', 'total_gross', 'total_vat', 'total_net')
+
+    def get(self, request):
+        username = request.query_params.get('username')
+        signature = request.query_params.get('signature')
+        query = request.query_params.get('q', '').strip()
+
+        if not username or not signature:
+            return Response({"error": "Username and signature are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not verify_signature(username, signature):
+            return Response({"error": "Invalid signature"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        if not search.query_terms(query):
+            return Response({"error": "Search query q is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            limit = min(int(request.query_params.get('limit', settings.SEARCH_DEFAULT_RESULTS)), settings.SEARCH_MAX_RESULTS)
+        except ValueError:
+            return Response({"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({"error": "limit must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        matches = search.search(user.id, query, limit)
+        receipts = {
+            receipt['id']: receipt
+            for receipt in ProcessedImage.objects.filter(id__in=[processed_id for processed_id, _ in matches]).values(*self.fields)
+        }
+        results = [
+            {**receipts[processed_id], "rank": rank}
+            for processed_id, rank in matches
+            if processed_id in receipts
+        ]
+        return Response({"query": query, "results": results}, status=status.HTTP_200_OK)
+
+
+class ArchiveUpload(APIView):
+    def post(self, request):
+        serializer = SerializeArchive(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            images, pdfs, rejected = ingest_archive(
+                serializer.validated_data['archive'],
+                serializer.validated_data['provider'],
+                serializer.validated_data['client'],
+            )
+        except serializers.ValidationError as e:
+            return Response({"archive": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+
+        progress_id = None
+        if images:
+            progress_id = enqueue_bulk(serializer.validated_data['client'].username, images).id
+
+        return Response(
+            {
+                "message": "Archive uploaded successfully. Processing has started.",
+                "images": len(images),
+                "pdfs": len(pdfs),
+                "rejected": rejected,
+                "progress_id": progress_id,
+            },
+            status=status.HTTP_201_CREATED if images or pdfs else status.HTTP_400_BAD_REQUEST,
+        )
+
+
+class ArchiveProgress(APIView):
+    def get(self, request, progress_id):
+        username = request.query_params.get('username')
+        signature = request.query_params.get('signature')
+
+        if not username or not signature:
+            return Response({"error": "Username and signature are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not verify_signature(username, signature):
+            return Response({"error": "Invalid signature"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        progress = bulk_progress(progress_id, username)
+        if progress is None:
+            return Response({"error": "Progress not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress, status=status.HTTP_200_OK)
+
+
+class CompletionMetrics(APIView):
+    def get(self, request):
+        provider = bearer_provider(request)
+        if provider is None:
+            return Response({"error": "Invalid or expired signature"}, status=status.HTTP_401_UNAUTHORIZED)
+        if not provider.client.is_staff:
+            return Response({"error": "Admin access required"}, status=status.HTTP_403_FORBIDDEN)
+
+        return Response(
+            {
+                "fast_model": settings.COMPLETION_FAST_MODEL,
+                "model": settings.COMPLETION_MODEL,
+                "models": cascade.summary(),
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class TusView(APIView):
+    """Shared request checks and response headers of the resumable upload endpoints."""
+
+    def tus_headers(self, session=None, **headers):
+        headers["Tus-Resumable"] = uploads.TUS_VERSION
+        headers["Cache-Control"] = "no-store"
+        if session is not None:
+            headers["Upload-Offset"] = str(session.offset)
+            headers["Upload-Length"] = str(session.length)
+            if session.completed_at is None:
+                headers["Upload-Expires"] = http_date(session.expires_at.timestamp())
+        return headers
+
+    def error(self, e, session=None):
+        return Response({"error": str(e)}, status=e.status, headers=self.tus_headers(session))
+
+    def authorize(self, request):
+        if request.method != "OPTIONS" and request.headers.get("Tus-Resumable") != uploads.TUS_VERSION:
+            raise uploads.UploadError(f"Tus-Resumable {uploads.TUS_VERSION} is required", status.HTTP_412_PRECONDITION_FAILED)
+        provider = bearer_provider(request)
+        if provider is None:
+            raise uploads.UploadError("Invalid or expired signature", status.HTTP_401_UNAUTHORIZED)
+        return provider
+
+
+class Uploads(TusView):
+    def options(self, request):
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=self.tus_headers(**{
+            "Tus-Version": uploads.TUS_VERSION,
+            "Tus-Extension": uploads.TUS_EXTENSIONS,
+            "Tus-Max-Size": str(max(settings.UPLOAD_MAX_IMAGE_SIZE, settings.UPLOAD_MAX_PDF_SIZE)),
+            "Tus-Checksum-Algorithm": ",".join(uploads.CHECKSUM_ALGORITHMS),
+        }))
+
+    def post(self, request):
+        try:
+            provider = self.authorize(request)
+            length = uploads.parse_count(request.headers.get("Upload-Length"), "Upload-Length")
+            if length is None:
+                raise uploads.UploadError("Upload-Length header is required")
+            session = uploads.create_session(provider, length, uploads.parse_metadata(request.headers.get("Upload-Metadata")))
+        except uploads.UploadError as e:
+            return self.error(e)
+
+        location = request.build_absolute_uri(reverse("upload_detail", args=[session.upload_id]))
+        return Response(
+            {"upload_id": session.upload_id, "location": location},
+            status=status.HTTP_201_CREATED,
+            headers=self.tus_headers(session, Location=location),
+        )
+
+
+class UploadDetail(TusView):
+    def head(self, request, upload_id):
+        try:
+            session = uploads.find_session(upload_id, self.authorize(request))
+        except uploads.UploadError as e:
+            return Response(status=e.status, headers=self.tus_headers())
+        return Response(status=status.HTTP_200_OK, headers=self.tus_headers(session))
+
+    def get(self, request, upload_id):
+        try:
+            session = uploads.find_session(upload_id, self.authorize(request))
+        except uploads.UploadError as e:
+            return self.error(e)
+        return Response(
+            {
+                "upload_id": session.upload_id,
+                "filename": session.filename,
+                "offset": session.offset,
+                "length": session.length,
+                "completed": session.completed_at is not None,
+                "image": session.image_id,
+                "pdf": session.pdf_id,
+                "result": session.result,
+                "error": session.error,
+            },
+            status=status.HTTP_200_OK,
+            headers=self.tus_headers(session),
+        )
+
+    def patch(self, request, upload_id):
+        session = None
+        try:
+            session = uploads.find_session(upload_id, self.authorize(request))
+            if request.content_type != "application/offset+octet-stream":
+                raise uploads.UploadError("Content-Type must be application/offset+octet-stream", status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+            offset = uploads.parse_count(request.headers.get("Upload-Offset"), "Upload-Offset")
+            if offset is None:
+                raise uploads.UploadError("Upload-Offset header is required")
+            session = uploads.append_chunk(
+                session,
+                offset,
+                # The body is streamed, never read into memory by a parser.
+                request.stream or io.BytesIO(),
+                uploads.parse_count(request.headers.get("Content-Length"), "Content-Length"),
+                uploads.parse_checksum(request.headers.get("Upload-Checksum")),
+            )
+        except uploads.UploadError as e:
+            return self.error(e, session)
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=self.tus_headers(session))
+
+    def delete(self, request, upload_id):
+        try:
+            session = uploads.find_session(upload_id, self.authorize(request))
+        except uploads.UploadError as e:
+            return self.error(e)
+        uploads.terminate(session)
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=self.tus_headers())